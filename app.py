@@ -1,11 +1,27 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, make_response, Response, stream_with_context, g, has_request_context
 from flask_cors import CORS
 import requests
 import json
 import os
+import re
 import io
 import tempfile
+import threading
+import asyncio
+import heapq
+import time
+import functools
+import contextlib
+import contextvars
+import hashlib
+import atexit
+import sqlite3
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # Azure OpenAI
 try:
@@ -15,20 +31,18 @@ except ImportError:
     AZURE_OPENAI_AVAILABLE = False
     print("Warning: Azure OpenAI library not available. Please install: pip install openai")
 
-# File parsing libraries
+# Token counting for the conversation history budget (falls back to an estimate)
 try:
-    import PyPDF2
-    PDF_AVAILABLE = True
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
 except ImportError:
-    PDF_AVAILABLE = False
-    print("Warning: PyPDF2 not available. PDF parsing will be disabled.")
+    TIKTOKEN_AVAILABLE = False
+
+# File parsing (PDF/DOCX/TXT text extraction and its parser process pool)
+import document_parser
+# Record/replay of Azure OpenAI and LDS traffic (CASSETTE_MODE)
+import cassettes
 
-try:
-    from docx import Document
-    DOCX_AVAILABLE = True
-except ImportError:
-    DOCX_AVAILABLE = False
-    print("Warning: python-docx not available. DOCX parsing will be disabled.")
 
 app = Flask(__name__)
 
@@ -69,13 +83,174 @@ OPENAI_ENDPOINT = os.getenv("ENDPOINT_URL", "https://cite-icdevai04-openai-andy-
 if not OPENAI_ENDPOINT.endswith("/"):
     OPENAI_ENDPOINT += "/"
 
+# How run_chat_with_optional_tools talks to the model:
+#   single_pass - tools and response_format in the same call; a 2nd call only when a tool is used
+#   two_stage   - tools first without response_format, then a separate call enforcing the schema
+CHAT_EXECUTION_MODE = os.getenv("CHAT_EXECUTION_MODE", "single_pass")
+
+# Seconds a learned deployment capability (e.g. "json_schema rejected") is trusted before re-checking
+AZURE_CAPABILITY_TTL = float(os.getenv("AZURE_CAPABILITY_TTL", "3600"))
+# Set to 1 to probe the deployment's capabilities in the background at startup
+AZURE_CAPABILITY_PROBE = os.getenv("AZURE_CAPABILITY_PROBE", "0") == "1"
+
+# Expose Prometheus metrics (request/stage latency histograms, LDS and Azure errors) at /metrics
+ENABLE_METRICS = os.getenv("ENABLE_METRICS", "1") == "1"
+
+# Token usage of every Azure OpenAI call (tagged by route, stage and conversation) is totalled
+# in memory and appended to this SQLite file every USAGE_FLUSH_SECONDS ("" keeps totals only);
+# read it with usage_report.py
+USAGE_LEDGER_DB = os.getenv("USAGE_LEDGER_DB", os.path.join(tempfile.gettempdir(), "lds_token_usage.sqlite3"))
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+
+# Upstream cassettes (see cassettes.py): "record" appends every Azure OpenAI and LDS call to
+# JSONL files in CASSETTE_DIR, "replay" answers from them without the network. CASSETTE_MATCH=shape
+# lets replay use a recording of the same kind of call when the exact request was not recorded;
+# CASSETTE_REPLAY_TIMING=1 keeps the recorded latencies
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").strip().lower()
+CASSETTE_DIR = os.getenv("CASSETTE_DIR", "cassettes")
+CASSETTE_MATCH = os.getenv("CASSETTE_MATCH", "exact")
+CASSETTE_REPLAY_TIMING = os.getenv("CASSETTE_REPLAY_TIMING", "0") == "1"
+
+# /api/generate_ilos result cache: max entries (LRU) and seconds an entry is reused
+ILO_CACHE_SIZE = int(os.getenv("ILO_CACHE_SIZE", "2000"))
+ILO_CACHE_TTL = float(os.getenv("ILO_CACHE_TTL", str(7 * 24 * 3600)))
+# Bump whenever the ILO prompts in generate_ilo_statements() change, to invalidate cached results
+ILO_PROMPT_VERSION = "2"
+# /api/generate_ilos/batch: max contexts per request and how many are generated at once
+ILO_BATCH_MAX_ITEMS = int(os.getenv("ILO_BATCH_MAX_ITEMS", "30"))
+ILO_BATCH_CONCURRENCY = int(os.getenv("ILO_BATCH_CONCURRENCY", "4"))
+
+# /api/chat history: token budget for past messages, cap per message, and the rolling
+# summary that replaces older messages (max tokens, cached summaries, seconds kept)
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "2000"))
+CHAT_HISTORY_MESSAGE_TOKENS = int(os.getenv("CHAT_HISTORY_MESSAGE_TOKENS", str(max(1, CHAT_HISTORY_TOKEN_BUDGET // 3))))
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "300"))
+CHAT_SUMMARY_CACHE_SIZE = int(os.getenv("CHAT_SUMMARY_CACHE_SIZE", "1000"))
+CHAT_SUMMARY_TTL = float(os.getenv("CHAT_SUMMARY_TTL", str(24 * 3600)))
+# Bump whenever the summary prompt in summarize_history() changes
+CHAT_SUMMARY_PROMPT_VERSION = "1"
+
+# /api/chat conversation sessions: "memory" (per worker) or "sqlite" (shared by workers on
+# one host, stored in CHAT_SESSION_DB); idle sessions expire after CHAT_SESSION_TTL seconds
+CHAT_SESSION_BACKEND = os.getenv("CHAT_SESSION_BACKEND", "memory")
+CHAT_SESSION_DB = os.getenv("CHAT_SESSION_DB", os.path.join(tempfile.gettempdir(), "lds_chat_sessions.sqlite3"))
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", str(6 * 3600)))
+CHAT_SESSION_MAX_ENTRIES = int(os.getenv("CHAT_SESSION_MAX_ENTRIES", "10000"))
+
+# Characters of an uploaded document sent for analysis (about 2500-3000 tokens);
+# extraction stops once this much text is read
+DOCUMENT_TEXT_BUDGET = int(os.getenv("DOCUMENT_TEXT_BUDGET", "10000"))
+# Longer documents (up to DOCUMENT_MAX_CHARS characters) are analysed map-reduce style:
+# split into chunks of at least DOCUMENT_CHUNK_TOKENS (larger for long documents, so there
+# are at most DOCUMENT_MAX_CHUNKS), each summarised (DOCUMENT_MAP_CONCURRENCY at once,
+# DOCUMENT_MAP_MAX_TOKENS per summary), then one call answers from the summaries.
+# With DOCUMENT_MAX_CHUNKS <= DOCUMENT_MAP_CONCURRENCY the map step is one round of calls,
+# so a request takes about two LLM calls' time (keep it under the server's worker timeout).
+# Opt-in: up to DOCUMENT_MAX_CHUNKS + 1 calls per upload instead of one. The default
+# (DOCUMENT_MAX_CHARS = DOCUMENT_TEXT_BUDGET) keeps the truncate-only behaviour
+DOCUMENT_MAX_CHARS = int(os.getenv("DOCUMENT_MAX_CHARS", str(DOCUMENT_TEXT_BUDGET)))
+DOCUMENT_CHUNK_TOKENS = int(os.getenv("DOCUMENT_CHUNK_TOKENS", "3000"))
+DOCUMENT_MAX_CHUNKS = int(os.getenv("DOCUMENT_MAX_CHUNKS", "4"))
+DOCUMENT_MAP_CONCURRENCY = int(os.getenv("DOCUMENT_MAP_CONCURRENCY", "4"))
+DOCUMENT_MAP_MAX_TOKENS = int(os.getenv("DOCUMENT_MAP_MAX_TOKENS", "500"))
+DOCUMENT_CHUNK_CACHE_SIZE = int(os.getenv("DOCUMENT_CHUNK_CACHE_SIZE", "2000"))
+DOCUMENT_CHUNK_CACHE_TTL = float(os.getenv("DOCUMENT_CHUNK_CACHE_TTL", str(24 * 3600)))
+# Bump when the chunk summary prompt changes so cached summaries are not reused
+DOCUMENT_MAP_PROMPT_VERSION = "1"
+# Document parsing runs in separate processes: how many at once (0 = in the request thread),
+# seconds before a parse is killed, and the memory cap per parser process (MB, POSIX only)
+DOCUMENT_PARSE_WORKERS = int(os.getenv("DOCUMENT_PARSE_WORKERS", "2"))
+DOCUMENT_PARSE_TIMEOUT = float(os.getenv("DOCUMENT_PARSE_TIMEOUT", "20"))
+DOCUMENT_PARSE_MEMORY_MB = int(os.getenv("DOCUMENT_PARSE_MEMORY_MB", "512"))
+# Extracted text of uploads, keyed by file hash, in a SQLite file shared by the workers on
+# one host; least recently used entries go once it holds DOCUMENT_CACHE_MAX_MB (0 = off)
+DOCUMENT_CACHE_DB = os.getenv("DOCUMENT_CACHE_DB", os.path.join(tempfile.gettempdir(), "lds_document_text.sqlite3"))
+DOCUMENT_CACHE_MAX_MB = int(os.getenv("DOCUMENT_CACHE_MAX_MB", "256"))
+# Largest accepted upload; bigger requests are refused (413) before they are read.
+# Uploads are spooled to files in UPLOAD_SPOOL_DIR (default: system temp dir) unless the
+# whole request is at most UPLOAD_MEMORY_KB
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "20"))
+UPLOAD_MAX_BYTES = int(UPLOAD_MAX_MB * 1024 * 1024)
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+UPLOAD_MEMORY_KB = int(os.getenv("UPLOAD_MEMORY_KB", "512"))
+
 LDS_TOKEN = os.getenv("LDS_TOKEN")  # if needed
 LARAVEL_HOST_API = os.getenv("LDS_BASE", "https://lds.cite.hku.hk/api")
 
+# LDS endpoints, keyed by the route name used for timeouts and client statistics
+LDS_ENDPOINTS = {
+    "subjects": f"{LARAVEL_HOST_API}/chatbot/options/courses/subjects",
+    "grade_levels": f"{LARAVEL_HOST_API}/chatbot/options/courses/grade-levels",
+    "ilo_categories": f"{LARAVEL_HOST_API}/chatbot/options/intended-learning-outcomes/types",
+    "ilo_patterns": f"{LARAVEL_HOST_API}/chatbot/patterns/intended-learning-outcomes",
+    "bloom_taxonomy_levels": f"{LARAVEL_HOST_API}/chatbot/options/intended-learning-outcomes/bloom-taxonomy-levels",
+}
+
+# Reference-data cache for option lists: seconds fresh, then seconds served stale while revalidating
+LDS_CACHE_TTL = float(os.getenv("LDS_CACHE_TTL", "600"))
+LDS_CACHE_STALE_TTL = float(os.getenv("LDS_CACHE_STALE_TTL", "86400"))
+
+# Connection pool size per worker (max keep-alive connections to the LDS host)
+LDS_POOL_SIZE = int(os.getenv("LDS_POOL_SIZE", "10"))
+
+# (connect, read) timeouts per LDS route; override with e.g. LDS_TIMEOUTS='{"subjects": [3, 10]}'
+LDS_TIMEOUTS = {
+    "default": (5, 30),
+    "health": (5, 10),
+}
+try:
+    for _route, _timeout in json.loads(os.getenv("LDS_TIMEOUTS", "{}")).items():
+        LDS_TIMEOUTS[_route] = tuple(_timeout) if isinstance(_timeout, (list, tuple)) else float(_timeout)
+except (ValueError, TypeError, AttributeError) as e:
+    print(f"Warning: Ignoring invalid LDS_TIMEOUTS: {e}")
+
+# Azure OpenAI admission control (per worker process): concurrent calls, max queued calls,
+# and seconds a call may wait in the queue per priority before a 503
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "32"))
+# Queue order: interactive chat (and ILOs) first, then suggestions, then document analysis
+LLM_PRIORITIES = {"chat": 0, "suggestions": 1, "document": 2}
+# Override with e.g. LLM_QUEUE_TIMEOUTS='{"chat": 5, "document": 60}'
+LLM_QUEUE_TIMEOUTS = {
+    "chat": 10.0,
+    "suggestions": 3.0,
+    "document": 30.0,
+}
+try:
+    for _priority, _timeout in json.loads(os.getenv("LLM_QUEUE_TIMEOUTS", "{}")).items():
+        LLM_QUEUE_TIMEOUTS[_priority] = float(_timeout)
+except (ValueError, TypeError, AttributeError) as e:
+    print(f"Warning: Ignoring invalid LLM_QUEUE_TIMEOUTS: {e}")
+
+# Circuit breakers (per worker process): one for LDS, one per Azure deployment. A breaker opens
+# when, of its last `window` calls (at least `min_calls`), the share `failure_rate` failed - an
+# error, a 5xx/429 answer or a call slower than `slow_call_s`. While open, calls fail at once
+# for `open_seconds`; then `half_open_calls` trial calls decide whether it closes or reopens.
+# Override with e.g. CIRCUIT_BREAKERS='{"lds": {"slow_call_s": 3}, "azure": {"open_seconds": 60}}'
+CIRCUIT_BREAKERS = {
+    "lds": {"enabled": True, "window": 20, "min_calls": 10, "failure_rate": 0.5,
+            "slow_call_s": 5.0, "open_seconds": 30.0, "half_open_calls": 3},
+    "azure": {"enabled": True, "window": 20, "min_calls": 10, "failure_rate": 0.5,
+              "slow_call_s": 60.0, "open_seconds": 30.0, "half_open_calls": 3},
+}
+try:
+    for _upstream, _settings in json.loads(os.getenv("CIRCUIT_BREAKERS", "{}")).items():
+        CIRCUIT_BREAKERS[_upstream].update(_settings)
+except (ValueError, TypeError, AttributeError, KeyError) as e:
+    print(f"Warning: Ignoring invalid CIRCUIT_BREAKERS: {e}")
+
+# Tools the model can call. Cache policy per tool:
+#   cacheable    - reuse results per canonicalised arguments
+#   cache_ttl    - seconds a cached result is reused
+#   option_route - LDS_ENDPOINTS route with the same data; a locale-only call is served
+#                  through that route's option-list cache (shared with the /api routes)
 SYSTEM_APIS = {
     "ILO_get_category": {
-        "url": f"{LARAVEL_HOST_API}/chatbot/options/intended-learning-outcomes/types",
-        "method": "POST"
+        "url": LDS_ENDPOINTS["ilo_categories"],
+        "method": "POST",
+        "cacheable": True,
+        "cache_ttl": 600,
+        "option_route": "ilo_categories",
     }
 }
 
@@ -117,6 +292,973 @@ if LDS_TOKEN:
         # Otherwise add Bearer prefix
         lds_headers["Authorization"] = f"Bearer {token}"
 
+
+# =========================
+# Single-flight (request coalescing)
+# =========================
+def canonical_json(obj):
+    """Stable JSON encoding used for cache and coalescing keys."""
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+class SingleFlight:
+    """
+    Collapse concurrent identical calls into one.
+    The first caller for a key (the leader) runs the function; callers arriving
+    while it is in flight wait and receive the same result or exception.
+    Works across threads (gthread) and greenlets (gevent patches threading).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self._stats["leaders"] += 1
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop: the leader awaits `fn()`, callers
+    arriving while it is in flight await the same asyncio.Future. If the leader is
+    cancelled, a waiter retries (and becomes the next leader) instead of being cancelled.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._stats = {"leaders": 0, "coalesced": 0}
+
+    async def do(self, key, fn):
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            self._stats["coalesced"] += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this waiter was cancelled, not the leader
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self._stats["leaders"] += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved: no "never retrieved" warning when nobody waited
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._calls.pop(key, None)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["in_flight"] = len(self._calls)
+        return stats
+
+
+# =========================
+# Metrics (Prometheus) and stage timing
+# =========================
+class Metrics:
+    """
+    In-process counters and histograms, rendered in the Prometheus text format by /metrics.
+    Values are per worker process (each gunicorn worker keeps its own).
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    HELP = {
+        "lds_chatbot_request_duration_seconds": ("histogram", "Request duration by route, method and status"),
+        "lds_chatbot_stage_duration_seconds": ("histogram", "Duration of each stage of a request (LLM calls, tools, LDS, ...)"),
+        "lds_chatbot_lds_responses_total": ("counter", "LDS API responses by LDS route and status code (or error class)"),
+        "lds_chatbot_azure_errors_total": ("counter", "Failed Azure OpenAI calls by error class and status code"),
+        "lds_chatbot_llm_tokens_total": ("counter", "Azure OpenAI tokens by route, stage and kind (prompt, cached, completion)"),
+        "lds_chatbot_circuit_transitions_total": ("counter", "Circuit breaker state changes by upstream and new state"),
+        "lds_chatbot_circuit_rejected_total": ("counter", "Calls refused by an open circuit breaker, by upstream"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._counters = {}  # (name, labels) -> value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += seconds
+
+    def observe_since(self, name, started, **labels):
+        self.observe(name, time.perf_counter() - started, **labels)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+            for k, v in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        for name, (kind, help_text) in self.HELP.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS, values):
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', f'{bound:g}')])} {count}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {values[-2]}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {values[-1]:.6f}")
+                    lines.append(f"{name}_count{self._labels(labels)} {values[-2]}")
+            else:
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+# Stages timed so far in the current request: {"route", "started", "stages": [(name, seconds)]}.
+# A ContextVar rather than flask.g so asgi.py's async routes (and asyncio.to_thread) share it
+request_timing = contextvars.ContextVar("request_timing", default=None)
+# Innermost stage() being run, so token usage can be attributed to it
+stage_name = contextvars.ContextVar("stage_name", default=None)
+
+
+def start_request_timing(route):
+    """Begin collecting stage timings for a request; returns the timing dict"""
+    timing = {"route": route, "started": time.perf_counter(), "stages": [], "request_id": uuid.uuid4().hex[:16]}
+    request_timing.set(timing)
+    return timing
+
+
+def current_request_timing():
+    timing = request_timing.get()
+    if timing is None and has_request_context():
+        # A streamed Flask response runs after the request's own teardown
+        timing = g.get("request_timing")
+    return timing
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time a stage of the current request: added to its Server-Timing header and to the
+    stage histogram (route "background" outside a request, e.g. in pool threads).
+    """
+    started = time.perf_counter()
+    outer = stage_name.get()
+    stage_name.set(name)
+    try:
+        yield
+    finally:
+        stage_name.set(outer)
+        elapsed = time.perf_counter() - started
+        timing = current_request_timing()
+        metrics.observe(
+            "lds_chatbot_stage_duration_seconds", elapsed,
+            route=timing["route"] if timing else "background", stage=name,
+        )
+        if timing is not None:
+            timing["stages"].append((name, elapsed))
+
+
+def server_timing_header(timing):
+    """Server-Timing value: each stage's total duration (a stage may run more than once), then the total"""
+    totals = {}
+    for name, elapsed in timing["stages"]:
+        totals[name] = totals.get(name, 0.0) + elapsed
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items()]
+    parts.append(f"total;dur={(time.perf_counter() - timing['started']) * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def bind_request_timing(fn):
+    """
+    fn, to be run in a pool thread, with the calling request's timing and current stage
+    (threads otherwise count as "background"); Flask's request context is not carried over.
+    """
+    timing, name = current_request_timing(), stage_name.get()
+
+    def run(*args, **kwargs):
+        context = contextvars.Context()
+        context.run(request_timing.set, timing)
+        context.run(stage_name.set, name)
+        return context.run(fn, *args, **kwargs)
+    return run
+
+
+def tag_conversation(conversation_id):
+    """Attribute the current request's token usage to a conversation"""
+    timing = current_request_timing()
+    if timing is not None and isinstance(conversation_id, str) and CONVERSATION_ID_RE.match(conversation_id):
+        timing["conversation_id"] = conversation_id
+
+
+def record_azure_error(error):
+    metrics.inc(
+        "lds_chatbot_azure_errors_total",
+        error=type(error).__name__,
+        status=getattr(error, "status_code", None) or "",
+    )
+
+
+# =========================
+# Token usage ledger
+# =========================
+class UsageLedger:
+    """
+    Token usage of every Azure OpenAI call. Running totals per route and stage are kept in
+    memory (/api/health, this worker only); each call is also queued as a row and appended
+    to a SQLite file shared by the workers on the host, by a background thread every
+    `flush_interval` seconds and at exit. path=None keeps the totals only.
+    """
+
+    FIELDS = ("prompt_tokens", "cached_tokens", "completion_tokens", "total_tokens")
+    MAX_PENDING = 10000  # rows kept while the file can't be written; the oldest are dropped
+
+    def __init__(self, path, flush_interval=10.0):
+        self.path = path or None
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._totals = {}  # (route, stage) -> {"calls": n, "prompt_tokens": n, ...}
+        self._stats = {"flushed": 0, "dropped": 0, "flush_errors": 0}
+        self._conn = None
+        self._flusher = None
+
+    @classmethod
+    def counts(cls, usage):
+        """The FIELDS of an OpenAI usage object (cached_tokens from prompt_tokens_details)"""
+        details = getattr(usage, "prompt_tokens_details", None)
+        return (
+            getattr(usage, "prompt_tokens", 0) or 0,
+            getattr(details, "cached_tokens", 0) or 0,
+            getattr(usage, "completion_tokens", 0) or 0,
+            getattr(usage, "total_tokens", 0) or 0,
+        )
+
+    def record(self, usage, route, stage, conversation_id=None, request_id=None):
+        counts = self.counts(usage)
+        with self._lock:
+            totals = self._totals.get((route, stage))
+            if totals is None:
+                totals = self._totals[(route, stage)] = dict.fromkeys(("calls",) + self.FIELDS, 0)
+            totals["calls"] += 1
+            for field, count in zip(self.FIELDS, counts):
+                totals[field] += count
+            if self.path is None:
+                return counts
+            self._pending.append((time.time(), request_id, route, stage, conversation_id, DEPLOYMENT_ID) + counts)
+            if len(self._pending) > self.MAX_PENDING:
+                del self._pending[0]
+                self._stats["dropped"] += 1
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, name="usage-ledger", daemon=True)
+                self._flusher.start()
+        return counts
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_usage (ts REAL NOT NULL, request_id TEXT, route TEXT, "
+                "stage TEXT, conversation_id TEXT, model TEXT, prompt_tokens INTEGER, cached_tokens INTEGER, "
+                "completion_tokens INTEGER, total_tokens INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS token_usage_ts ON token_usage (ts)")
+            self._conn = conn
+        return self._conn
+
+    def flush(self):
+        """Append the queued rows to the ledger file; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            try:
+                with self._connect() as conn:
+                    conn.executemany("INSERT INTO token_usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                app.logger.warning(f"Token usage ledger {self.path} not written ({len(rows)} rows kept): {e}")
+                with self._lock:
+                    self._pending[:0] = rows
+                    overflow = len(self._pending) - self.MAX_PENDING
+                    if overflow > 0:
+                        del self._pending[:overflow]
+                        self._stats["dropped"] += overflow
+                    self._stats["flush_errors"] += 1
+                return 0
+            with self._lock:
+                self._stats["flushed"] += len(rows)
+            return len(rows)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.exception(e)
+
+    def stats(self):
+        with self._lock:
+            by_route = {}
+            for (route, stage_key), totals in sorted(self._totals.items()):
+                by_route.setdefault(route, {})[stage_key] = dict(totals)
+            return dict(self._stats, path=self.path, pending=len(self._pending), by_route=by_route)
+
+
+usage_ledger = UsageLedger(USAGE_LEDGER_DB, flush_interval=USAGE_FLUSH_SECONDS)
+atexit.register(usage_ledger.flush)
+
+
+# =========================
+# Record/replay cassettes
+# =========================
+upstream_cassettes = cassettes.Cassettes(
+    CASSETTE_DIR, CASSETTE_MODE, replay_timing=CASSETTE_REPLAY_TIMING, match=CASSETTE_MATCH
+)
+if upstream_cassettes.mode:
+    print(f"Cassettes: {upstream_cassettes.mode} ({CASSETTE_DIR})")
+
+
+def azure_cassette_key(params):
+    """
+    (key, shape) of a chat.completions.create() call, from the parameters before capability
+    rewriting (the deployment name is left out, so recordings replay against any deployment)
+    """
+    response_format = params.get("response_format") or {}
+    response_kind = (response_format.get("json_schema") or {}).get("name") or response_format.get("type") or "text"
+    timing = current_request_timing() or {}
+    shape = " ".join(filter(None, (
+        timing.get("route", "background"),
+        stage_name.get() or "llm",
+        response_kind,
+        "tools" if params.get("tools") else "",
+        "stream" if params.get("stream") else "",
+    )))
+    return cassettes.request_key("azure", {k: v for k, v in params.items() if k != "model"}), shape
+
+
+def lds_cassette_key(method, url, body):
+    """(key, shape) of an LDS call; keyed by URL path so recordings replay against any LDS_BASE"""
+    path = cassettes.url_path(url)
+    return cassettes.request_key("lds", method.upper(), path, body), f"{method.upper()} {path}"
+
+
+def replay_lds_response(entry, url):
+    resp = requests.Response()
+    resp.status_code = entry["status"]
+    resp._content = entry["body"].encode("utf-8")
+    resp.encoding = "utf-8"
+    resp.headers["Content-Type"] = entry.get("content_type") or "application/json"
+    resp.url = url
+    return resp
+
+
+def send_lds_request(session, method, url, body, timeout):
+    """session.request() to LDS, recorded or replayed per CASSETTE_MODE"""
+    if not upstream_cassettes.mode:
+        return session.request(method, url, json=body, timeout=timeout)
+    key, shape = lds_cassette_key(method, url, body)
+    if upstream_cassettes.replaying:
+        entry = upstream_cassettes.lookup("lds", key, shape)
+        time.sleep(upstream_cassettes.delay(entry["duration"]))
+        return replay_lds_response(entry, url)
+    started = time.perf_counter()
+    resp = session.request(method, url, json=body, timeout=timeout)
+    upstream_cassettes.record_lds(
+        key, shape, resp.status_code, resp.text, resp.headers.get("Content-Type"), time.perf_counter() - started
+    )
+    return resp
+
+
+# =========================
+# Circuit breakers
+# =========================
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """
+    A call refused without being sent: the upstream's circuit breaker is open.
+    A ConnectionError, so LDS callers handle it like an unreachable host (503 / fallback).
+    """
+
+    def __init__(self, upstream, retry_after):
+        super().__init__(f"{upstream} is unavailable (circuit open), retry after {retry_after}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def upstream_failure(error=None, status=None):
+    """
+    Why a call counts against its circuit breaker, or None if it doesn't: exceptions
+    (timeouts, refused connections) and 429/5xx answers do; other answers, including
+    4xx rejections of a request, show the upstream is up. Cassette misses never count.
+    """
+    if error is not None:
+        if isinstance(error, cassettes.CassetteMiss):
+            return None
+        status = getattr(error, "status_code", None)
+        if status is None:
+            return type(error).__name__
+    if status is not None and (status == 429 or status >= 500):
+        return f"HTTP {status}"
+    return None
+
+
+class CircuitBreaker:
+    """
+    Fail fast while an upstream is down instead of tying up workers for its full timeout.
+      closed    - calls go through; the outcomes of the last `window` calls are kept
+      open      - calls raise CircuitOpen for `open_seconds`
+      half_open - up to `half_open_calls` trial calls go through; they all succeeding closes
+                  the breaker, any of them failing opens it again
+    A call slower than `slow_call_s` counts as failed even when it succeeds.
+    """
+
+    def __init__(self, name, enabled=True, window=20, min_calls=10, failure_rate=0.5,
+                 slow_call_s=30.0, open_seconds=30.0, half_open_calls=3):
+        self.name = name
+        self.enabled = bool(enabled)
+        self.min_calls = max(1, int(min_calls))
+        self.failure_rate = float(failure_rate)
+        self.slow_call_s = float(slow_call_s)
+        self.open_seconds = float(open_seconds)
+        self.half_open_calls = max(1, int(half_open_calls))
+        self.state = "closed"
+        self._outcomes = deque(maxlen=max(int(window), self.min_calls))  # True = failed
+        self._opened_at = 0.0
+        self._trials = 0  # trial calls let through while half-open
+        self._trial_successes = 0
+        self._last_failure = None
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "opened": 0}
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may be sent now; returns its start time for after_call()"""
+        if self.enabled:
+            with self._lock:
+                if self.state == "open":
+                    remaining = self._opened_at + self.open_seconds - time.monotonic()
+                    if remaining > 0:
+                        self._reject(remaining)
+                    self._transition("half_open")
+                if self.state == "half_open":
+                    if self._trials >= self.half_open_calls:
+                        # Trial calls still running: wait for their verdict
+                        self._reject(1)
+                    self._trials += 1
+        return time.perf_counter()
+
+    def after_call(self, started, failure=None):
+        """Record a call's outcome; `failure` is a reason (see upstream_failure()) or None"""
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - started
+        slow = failure is None and elapsed > self.slow_call_s
+        if slow:
+            failure = f"slower than {self.slow_call_s:g}s ({elapsed:.1f}s)"
+        with self._lock:
+            self._stats["calls"] += 1
+            if failure:
+                self._stats["failures"] += 1
+                self._stats["slow_calls"] += slow
+                self._last_failure = {"reason": failure, "at": time.time()}
+            if self.state == "half_open":
+                if failure:
+                    self._transition("open")
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= self.half_open_calls:
+                        self._transition("closed")
+            elif self.state == "closed":
+                self._outcomes.append(bool(failure))
+                failed = sum(self._outcomes)
+                if len(self._outcomes) >= self.min_calls and failed >= self.failure_rate * len(self._outcomes):
+                    self._transition("open")
+            # Open: a call sent before the breaker opened; its outcome changes nothing
+
+    def release(self):
+        """A call let through by before_call() ended without an outcome (cancelled, not admitted)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == "half_open" and self._trials > self._trial_successes:
+                self._trials -= 1
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        before_call() / after_call() around a block; exceptions are classified by
+        upstream_failure(), and the block may set outcome["failure"] for an answer
+        that failed (e.g. upstream_failure(status=resp.status_code)).
+        """
+        started = self.before_call()
+        outcome = {"failure": None}
+        try:
+            yield outcome
+        except Exception as e:
+            self.after_call(started, upstream_failure(e))
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.after_call(started, outcome["failure"])
+
+    def _reject(self, retry_after):
+        self._stats["rejected"] += 1
+        metrics.inc("lds_chatbot_circuit_rejected_total", upstream=self.name)
+        raise CircuitOpen(self.name, max(1, int(retry_after + 0.999)))
+
+    def _transition(self, state):
+        # Called with self._lock held
+        self.state = state
+        if state == "open":
+            self._opened_at = time.monotonic()
+            self._stats["opened"] += 1
+            reason = (self._last_failure or {}).get("reason")
+            app.logger.warning(
+                f"Circuit breaker {self.name} opened for {self.open_seconds:g}s "
+                f"({sum(self._outcomes)}/{len(self._outcomes)} recent calls failed; last: {reason})"
+            )
+        elif state == "half_open":
+            self._trials = self._trial_successes = 0
+            app.logger.info(f"Circuit breaker {self.name} half-open: letting {self.half_open_calls} trial calls through")
+        else:
+            app.logger.warning(f"Circuit breaker {self.name} closed: upstream recovered")
+        self._outcomes.clear()
+        metrics.inc("lds_chatbot_circuit_transitions_total", upstream=self.name, state=state)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = self.state if self.enabled else "disabled"
+            stats["recent_calls"] = len(self._outcomes)
+            stats["recent_failure_rate"] = round(sum(self._outcomes) / len(self._outcomes), 3) if self._outcomes else 0.0
+            stats["last_failure"] = dict(self._last_failure) if self._last_failure else None
+            if self.state == "open":
+                stats["retry_after"] = round(max(0.0, self._opened_at + self.open_seconds - time.monotonic()), 1)
+            return stats
+
+
+lds_breaker = CircuitBreaker("lds", **CIRCUIT_BREAKERS["lds"])
+azure_breakers = {}  # deployment -> CircuitBreaker, created on first use
+azure_breakers_lock = threading.Lock()
+
+
+def azure_circuit(params):
+    """
+    The breaker of the deployment params go to, once it lets a call through;
+    an open circuit raises LLMOverloaded (503 + Retry-After) like a saturated queue.
+    """
+    deployment = params.get("model") or DEPLOYMENT_ID
+    with azure_breakers_lock:
+        breaker = azure_breakers.get(deployment)
+        if breaker is None:
+            breaker = azure_breakers[deployment] = CircuitBreaker(f"azure:{deployment}", **CIRCUIT_BREAKERS["azure"])
+    try:
+        breaker.before_call()
+    except CircuitOpen as e:
+        raise LLMOverloaded(503, e.retry_after, f"circuit open for Azure deployment {deployment}") from e
+    return breaker
+
+
+def circuit_breaker_stats():
+    with azure_breakers_lock:
+        breakers = [lds_breaker] + list(azure_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+# =========================
+# LDS HTTP client (pooled)
+# =========================
+class LDSClient:
+    """
+    Keep-alive HTTP client for the LDS API.
+    Each worker process gets its own requests.Session (re-created after fork),
+    so repeated calls reuse TCP/TLS connections instead of handshaking every time.
+    Concurrent identical requests (method, URL, JSON body) share one upstream call.
+    """
+
+    def __init__(self, headers, pool_size=10, timeouts=None):
+        self.headers = dict(headers)
+        self.headers.setdefault("Accept-Encoding", "gzip, deflate")
+        self.pool_size = pool_size
+        self.timeouts = dict(timeouts or {})
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "errors": 0, "in_flight": 0, "routes": {}}
+        self._single_flight = SingleFlight()
+        self._async_single_flights = []
+
+    def _get_session(self):
+        # Sessions must not be shared across forked gunicorn workers
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update(self.headers)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def timeout_for(self, route):
+        return self.timeouts.get(route, self.timeouts.get("default", (5, 30)))
+
+    def request(self, method, url, route="default", json=None, timeout=None):
+        """Send a request to LDS. Returns requests.Response; network errors are raised as usual."""
+        body = json if json is not None else {}
+        key = (method.upper(), url, canonical_json(body))
+        with stage("lds"):
+            return self._single_flight.do(key, lambda: self._send(method, url, route, body, timeout))
+
+    def _send(self, method, url, route, body, timeout):
+        # Inside the single flight: a call refused by the breaker is refused for all its waiters
+        with lds_breaker.guard() as outcome:
+            resp = self._send_counted(method, url, route, body, timeout)
+            outcome["failure"] = upstream_failure(status=resp.status_code)
+            return resp
+
+    def _send_counted(self, method, url, route, body, timeout):
+        session = self._get_session()
+        with self.counted(route) as outcome:
+            resp = send_lds_request(session, method, url, body, timeout or self.timeout_for(route))
+            outcome["status"] = resp.status_code
+            return resp
+
+    @contextlib.contextmanager
+    def counted(self, route):
+        """
+        Count one upstream LDS call in stats() and the responses metric; the body sets
+        outcome["status"]. asgi.AsyncLDSClient counts its calls here too.
+        """
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["in_flight"] += 1
+            route_stats = self._stats["routes"].setdefault(route, {"requests": 0, "errors": 0})
+            route_stats["requests"] += 1
+        outcome = {}
+        try:
+            yield outcome
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+                route_stats["errors"] += 1
+            metrics.inc("lds_chatbot_lds_responses_total", route=route, status=type(e).__name__)
+            raise
+        else:
+            metrics.inc("lds_chatbot_lds_responses_total", route=route, status=outcome.get("status"))
+        finally:
+            with self._lock:
+                self._stats["in_flight"] -= 1
+
+    def async_single_flight(self):
+        """An AsyncSingleFlight reported in stats() (for asgi.AsyncLDSClient)"""
+        flight = AsyncSingleFlight()
+        self._async_single_flights.append(flight)
+        return flight
+
+    def post(self, url, route="default", json=None, timeout=None):
+        return self.request("POST", url, route=route, json=json, timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "requests": self._stats["requests"],
+                "errors": self._stats["errors"],
+                "in_flight": self._stats["in_flight"],
+                "routes": {k: dict(v) for k, v in self._stats["routes"].items()},
+                "pool_size": self.pool_size,
+            }
+        stats["single_flight"] = self._single_flight.stats()
+        for flight in self._async_single_flights:
+            for name, value in flight.stats().items():
+                stats["single_flight"][name] += value
+        pools = []
+        session = self._session if self._pid == os.getpid() else None
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                for key in list(adapter.poolmanager.pools.keys()):
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool is None:
+                        continue
+                    pools.append({
+                        "host": pool.host,
+                        "connections_opened": pool.num_connections,
+                        "requests_sent": pool.num_requests,
+                        # The pool queue is pre-filled with None placeholders; count real connections only
+                        "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                    })
+        stats["pools"] = pools
+        return stats
+
+
+lds_client = LDSClient(lds_headers, pool_size=LDS_POOL_SIZE, timeouts=LDS_TIMEOUTS)
+
+
+# =========================
+# TTL cache (stale-while-revalidate)
+# =========================
+class TTLCache:
+    """
+    Thread-safe in-process cache with TTL and stale-while-revalidate.
+      - fresh   (age < ttl):                   served directly ("hit")
+      - stale   (ttl <= age < ttl + stale_ttl): served directly, refreshed in background ("stale")
+      - expired (older):                       treated as a miss, kept only as last good value
+    """
+
+    def __init__(self, ttl, stale_ttl=0, max_entries=256):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "fallbacks": 0, "refreshes": 0, "refresh_errors": 0}
+
+    def lookup(self, key):
+        """Return (value, state) where state is "hit", "stale" or "miss"."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = now - stored_at
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value, "hit"
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["stale"] += 1
+                    return value, "stale"
+            self._stats["misses"] += 1
+            return None, "miss"
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def last_good(self, key):
+        """Return the last stored value regardless of age (for serving when upstream is down)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._stats["fallbacks"] += 1
+            return entry[0]
+
+    def refresh_async(self, key, loader):
+        """Revalidate key in a background thread; concurrent refreshes of the same key are collapsed."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def _refresh():
+            try:
+                self.put(key, loader())
+                with self._lock:
+                    self._stats["refreshes"] += 1
+            except Exception as e:
+                with self._lock:
+                    self._stats["refresh_errors"] += 1
+                app.logger.warning(f"Background refresh failed for {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+lds_option_cache = TTLCache(LDS_CACHE_TTL, LDS_CACHE_STALE_TTL)
+
+# One result cache per cacheable tool in SYSTEM_APIS
+tool_result_caches = {
+    name: TTLCache(api.get("cache_ttl", 300))
+    for name, api in SYSTEM_APIS.items()
+    if api.get("cacheable")
+}
+
+
+def request_locale(default="zh_HK"):
+    """Locale from the JSON body (POST) or query string, as accepted by the option routes."""
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        return data.get("locale") or request.args.get("locale", default)
+    return request.args.get("locale", default)
+
+
+class LDSNotAList(RuntimeError):
+    """LDS answered an option endpoint, but not with a list (unlike a network error, worth a direct call)"""
+
+
+def fetch_lds_option_list(route, locale):
+    """POST to an LDS option endpoint and return the list, raising on any non-list answer."""
+    resp = lds_client.post(LDS_ENDPOINTS[route], route=route, json={"locale": locale} if locale else {})
+    return lds_option_list(resp)
+
+
+def lds_option_list(resp):
+    """The option list in an LDS response (requests or httpx); RuntimeError on an error status."""
+    if not 200 <= resp.status_code < 300:
+        raise RuntimeError(f"LDS API error {resp.status_code}")
+    try:
+        data = resp.json()
+    except ValueError as e:
+        raise LDSNotAList(f"LDS API returned non-JSON data: {e}") from e
+    if not isinstance(data, list):
+        raise LDSNotAList(f"LDS API returned non-list data: {type(data).__name__}")
+    return data
+
+
+def lds_option_lookup(route, locale):
+    """
+    (cache key, cached list or None) from lds_option_cache, for get_lds_option_list()
+    and its async version; a stale list is returned and refreshed in the background
+    """
+    key = (route, locale)
+    value, state = lds_option_cache.lookup(key)
+    if state == "stale":
+        lds_option_cache.refresh_async(key, lambda: fetch_lds_option_list(route, locale))
+    return key, value
+
+
+def get_lds_option_list(route, locale):
+    """Option list through lds_option_cache (same policy as the cached routes)."""
+    key, value = lds_option_lookup(route, locale)
+    if value is not None:
+        return value
+    try:
+        value = fetch_lds_option_list(route, locale)
+    except Exception:
+        fallback = lds_option_cache.last_good(key)
+        if fallback is None:
+            raise
+        return fallback
+    lds_option_cache.put(key, value)
+    return value
+
+
+def cached_lds_options(route):
+    """
+    Serve an option-list route from lds_option_cache, keyed by (route, locale).
+    Misses fall through to the view; successful list responses are stored, and
+    failed ones are replaced by the last good value when there is one.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == "OPTIONS":
+                return view(*args, **kwargs)
+
+            locale = request_locale()
+            key = (route, locale)
+            value, state = lds_option_cache.lookup(key)
+            if state == "stale":
+                lds_option_cache.refresh_async(key, lambda: fetch_lds_option_list(route, locale))
+            if value is not None:
+                resp = jsonify(value)
+                resp.headers["X-Cache"] = state.upper()
+                return resp
+
+            resp = make_response(view(*args, **kwargs))
+            data = resp.get_json(silent=True)
+            if resp.status_code == 200 and isinstance(data, list):
+                lds_option_cache.put(key, data)
+                resp.headers["X-Cache"] = "MISS"
+                return resp
+
+            fallback = lds_option_cache.last_good(key)
+            if fallback is not None:
+                app.logger.warning(f"LDS {route} failed with HTTP {resp.status_code}, serving last good value")
+                resp = jsonify(fallback)
+                resp.headers["X-Cache"] = "FALLBACK"
+            return resp
+        return wrapper
+    return decorator
+
+
 DP_DEFINITIONS = """
 1. Engineering Design: For creating solutions, prototypes, coding, or building systems.
 2. Scientific Investigation: For experiments, hypothesis testing, observing natural phenomena.
@@ -239,81 +1381,895 @@ TOOLS = [
 ]
 
 
-def call_lds_api(name: str, args: dict):
-    api = SYSTEM_APIS.get(name)
-    if not api:
-        return {"error": f"Unknown API tool: {name}"}
+class LDSToolCall:
+    """
+    Cache policy of one call_lds_api() call (see SYSTEM_APIS), shared with the async
+    version in asgi.py, which only sends the LDS requests differently.
+    `result` is set when no LDS call is needed (unknown tool or cache hit).
+    """
 
-    try:
-        resp = requests.request(
-            api["method"],
-            api["url"],
-            headers=lds_headers,
-            json=args if args else {},
-            timeout=(5, 30)
-        )
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args or {}
+        self.api = SYSTEM_APIS.get(name)
+        self.cache = tool_result_caches.get(name)
+        self.cache_key = canonical_json(self.args)
+        self.result = None
+        if not self.api:
+            self.result = {"error": f"Unknown API tool: {name}"}
+        elif self.cache is not None:
+            cached, state = self.cache.lookup(self.cache_key)
+            if state == "hit":
+                app.logger.info(f"Tool cache hit: {name} {self.cache_key}")
+                self.result = cached
+
+    @property
+    def option_route(self):
+        """The option-list route serving this call (a locale-only call), or None"""
+        option_route = self.api.get("option_route")
+        if self.cache is not None and option_route and set(self.args) <= {"locale"}:
+            return option_route
+        return None
+
+    def option_list_answered(self, option_list):
+        self.cache.put(self.cache_key, option_list)
+        return option_list
+
+    def option_list_failed(self, error):
+        """None to call LDS directly (the option list was unusable), else the result to return"""
+        if isinstance(error, LDSNotAList):
+            app.logger.warning(f"Option list for tool {self.name} unusable, calling LDS directly: {error}")
+            return None
+        # Timeout, open circuit or LDS error: sending again would only wait another timeout
+        return self.failed(error)
+
+    def answered(self, resp):
         if 200 <= resp.status_code < 300:
             try:
-                return resp.json()
+                result = resp.json()
             except Exception:
                 return {"raw": resp.text}
+            if self.cache is not None:
+                self.cache.put(self.cache_key, result)
+            return result
         return {"error": f"LDS API error {resp.status_code}", "details": resp.text}
-    except Exception as e:
-        return {"error": str(e)}
 
+    def failed(self, error):
+        return lds_tool_fallback(self.name, self.cache, self.cache_key, error)
+
+
+def call_lds_api(name: str, args: dict):
+    # Memoised tool results (see cache policy in SYSTEM_APIS)
+    call = LDSToolCall(name, args)
+    if call.result is not None:
+        return call.result
+
+    if call.option_route:
+        try:
+            return call.option_list_answered(get_lds_option_list(call.option_route, call.args.get("locale")))
+        except Exception as e:
+            result = call.option_list_failed(e)
+            if result is not None:
+                return result
 
-def call_openai(payload: dict):
-    """使用 Azure OpenAI client 調用 API"""
-    if not azure_openai_client:
-        raise RuntimeError("Azure OpenAI client not initialized. Please install: pip install openai azure-identity")
-    
     try:
-        # Extract parameters from payload
-        messages = payload.get("messages", [])
-        temperature = payload.get("temperature", 0.3)
-        max_tokens = payload.get("max_tokens", 600)
-        response_format = payload.get("response_format")
-        tools = payload.get("tools")
-        tool_choice = payload.get("tool_choice")
-        
-        # Build request parameters
-        completion_params = {
-            "model": DEPLOYMENT_ID,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-        }
-        
-        if response_format:
-            completion_params["response_format"] = response_format
-        if tools:
-            completion_params["tools"] = tools
-        if tool_choice:
-            completion_params["tool_choice"] = tool_choice
-        
-        # Call API
-        completion = azure_openai_client.chat.completions.create(**completion_params)
-        
-        # Convert to response format compatible with original format
-        choice = completion.choices[0]
-        result = {
-            "choices": [{
-                "message": {
-                    "content": choice.message.content,
-                    "tool_calls": [{
-                        "id": tc.id,
-                        "type": tc.type,
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    } for tc in (choice.message.tool_calls or [])]
+        resp = lds_client.request(
+            call.api["method"],
+            call.api["url"],
+            route=name,
+            json=call.args
+        )
+        return call.answered(resp)
+    except Exception as e:
+        return call.failed(e)
+
+
+def lds_tool_fallback(name, cache, cache_key, error):
+    """LDS down (or its circuit open): an expired result beats an error"""
+    fallback = cache.last_good(cache_key) if cache is not None else None
+    if fallback is not None:
+        app.logger.warning(f"Tool {name} failed, serving last good result: {error}")
+        return fallback
+    return {"error": str(error)}
+
+
+# =========================
+# LLM admission control
+# =========================
+class LLMOverloaded(Exception):
+    """An LLM call was not admitted: queue full (429) or queue wait deadline passed (503)"""
+
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _AdmissionTicket:
+    __slots__ = ("rank", "seq", "priority", "enqueued", "state", "notify")
+
+    def __init__(self, rank, seq, priority, notify):
+        self.rank = rank
+        self.seq = seq
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.state = "waiting"  # -> granted | evicted | cancelled
+        self.notify = notify
+
+    def __lt__(self, other):
+        return (self.rank, self.seq) < (other.rank, other.seq)
+
+
+class LLMAdmission:
+    """
+    Bounded concurrency for Azure OpenAI calls (per worker process).
+    At most `max_concurrency` calls run at once; the rest wait in a priority queue
+    (LLM_PRIORITIES, lower rank first, FIFO within a rank) of at most `queue_size`.
+      - queue full: a lower-priority waiter is evicted to make room, otherwise the
+        new call is rejected at once with 429
+      - a call not admitted within its queue timeout gets 503
+    Both carry a Retry-After estimate from the recent call duration.
+    acquire() blocks a thread; acquire_async() is the same queue for asgi.py.
+    """
+
+    def __init__(self, max_concurrency, queue_size, timeouts, priorities):
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_size = max(0, queue_size)
+        self.timeouts = dict(timeouts)
+        self.priorities = dict(priorities)
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = 0
+        self._in_flight = 0
+        self._waiting = {p: 0 for p in self.priorities}
+        self._avg_call_seconds = 5.0
+        self._counters = {p: {"admitted": 0, "rejected": 0, "evicted": 0, "timed_out": 0,
+                              "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+                          for p in self.priorities}
+
+    def retry_after(self):
+        """Seconds until a slot is likely free (caller holds the lock)"""
+        queued = sum(self._waiting.values())
+        estimate = self._avg_call_seconds * (queued / self.max_concurrency + 1)
+        return max(1, min(60, int(estimate + 0.999)))
+
+    def _admitted(self, priority, waited):
+        counters = self._counters[priority]
+        counters["admitted"] += 1
+        counters["wait_seconds_total"] += waited
+        counters["wait_seconds_max"] = max(counters["wait_seconds_max"], waited)
+
+    def _enqueue(self, priority, notify):
+        """Admit at once (returns None) or queue a ticket; raises LLMOverloaded when full"""
+        if priority not in self.priorities:
+            priority = "chat"
+        with self._lock:
+            if self._in_flight < self.max_concurrency and not any(self._waiting.values()):
+                self._in_flight += 1
+                self._admitted(priority, 0.0)
+                return None
+
+            rank = self.priorities[priority]
+            if sum(self._waiting.values()) >= self.queue_size:
+                victims = [t for t in self._heap if t.state == "waiting" and t.rank > rank]
+                if not victims:
+                    self._counters[priority]["rejected"] += 1
+                    raise LLMOverloaded(429, self.retry_after(), "LLM queue full")
+                victim = max(victims, key=lambda t: (t.rank, t.seq))
+                victim.state = "evicted"
+                self._waiting[victim.priority] -= 1
+                self._counters[victim.priority]["evicted"] += 1
+                victim.notify()
+
+            self._seq += 1
+            ticket = _AdmissionTicket(rank, self._seq, priority, notify)
+            heapq.heappush(self._heap, ticket)
+            self._waiting[priority] += 1
+            return ticket
+
+    def _settle(self, ticket):
+        """After waiting: admitted, or raise for an evicted / timed out ticket"""
+        with self._lock:
+            if ticket.state == "granted":
+                return
+            if ticket.state == "waiting":
+                ticket.state = "cancelled"
+                self._waiting[ticket.priority] -= 1
+                self._counters[ticket.priority]["timed_out"] += 1
+                raise LLMOverloaded(503, self.retry_after(), "LLM queue wait deadline exceeded")
+            raise LLMOverloaded(429, self.retry_after(), "LLM queue full")
+
+    def acquire(self, priority="chat", timeout=None):
+        """Block until a slot is free; pair with release()"""
+        event = threading.Event()
+        ticket = self._enqueue(priority, event.set)
+        if ticket is not None:
+            event.wait(self.timeouts.get(ticket.priority, 10) if timeout is None else timeout)
+            self._settle(ticket)
+        return time.monotonic()
+
+    async def acquire_async(self, priority="chat", timeout=None):
+        """acquire() for coroutines: waits on the event loop instead of a thread"""
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def _wake():
+            if not admitted.done():
+                admitted.set_result(None)
+
+        ticket = self._enqueue(priority, lambda: loop.call_soon_threadsafe(_wake))
+        if ticket is not None:
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(admitted),
+                    self.timeouts.get(ticket.priority, 10) if timeout is None else timeout,
+                )
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # Cancelled while queued: give the slot back if it was granted meanwhile
+                try:
+                    self._settle(ticket)
+                    self.release()
+                except LLMOverloaded:
+                    pass
+                raise
+            self._settle(ticket)
+        return time.monotonic()
+
+    def release(self, started=None):
+        """Free a slot, handing it straight to the next waiter (if any)"""
+        with self._lock:
+            if started is not None:
+                self._avg_call_seconds = 0.8 * self._avg_call_seconds + 0.2 * (time.monotonic() - started)
+            while self._heap:
+                ticket = heapq.heappop(self._heap)
+                if ticket.state != "waiting":
+                    continue
+                ticket.state = "granted"
+                self._waiting[ticket.priority] -= 1
+                self._admitted(ticket.priority, time.monotonic() - ticket.enqueued)
+                ticket.notify()
+                return
+            self._in_flight -= 1
+
+    def release_after(self, stream, started):
+        """Hold the slot while a streamed completion is consumed"""
+        try:
+            yield from stream
+        finally:
+            self.release(started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "queue_size": self.queue_size,
+                "in_flight": self._in_flight,
+                "queued": dict(self._waiting),
+                "avg_call_seconds": round(self._avg_call_seconds, 3),
+                "retry_after": self.retry_after(),
+                "priorities": {
+                    p: dict(c, wait_seconds_total=round(c["wait_seconds_total"], 3),
+                            wait_seconds_max=round(c["wait_seconds_max"], 3),
+                            timeout=self.timeouts.get(p))
+                    for p, c in self._counters.items()
+                },
+            }
+
+
+llm_admission = LLMAdmission(LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUTS, LLM_PRIORITIES)
+
+
+@app.errorhandler(LLMOverloaded)
+def llm_overloaded(e):
+    """Fast 429/503 instead of piling more calls onto a saturated deployment"""
+    app.logger.warning(f"{request.method} {request.path} not admitted: {e.reason} (retry after {e.retry_after}s)")
+    response = jsonify({"error": f"AI 服務繁忙，請 {e.retry_after} 秒後再試", "retry_after": e.retry_after})
+    response.status_code = e.status
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+# =========================
+# Deployment capabilities
+# =========================
+class DeploymentCapabilities:
+    """
+    Remembers which request features the Azure deployment (DEPLOYMENT_ID at
+    API_VERSION) rejects, so requests known to fail are rewritten up front instead
+    of paying a failed round trip every time. Learned on the first rejection (or by
+    an optional startup probe); entries expire after `ttl` seconds.
+
+    Features:
+      json_schema  - response_format {"type": "json_schema"} (else json_object is sent)
+      single_pass  - tools and response_format in the same call (else 2-stage chat)
+      tools        - function calling (else tools are dropped)
+      max_tokens   - the max_tokens parameter (else max_completion_tokens is sent)
+      temperature  - the temperature parameter (else it is omitted)
+      stream_usage - stream_options {"include_usage": true}, added to streamed calls so
+                     their token usage is reported (else streamed calls go unaccounted)
+    """
+
+    FEATURES = ("json_schema", "single_pass", "tools", "max_tokens", "temperature")
+    # 400s about the prompt itself rather than a request feature: nothing to learn from them
+    PROMPT_ERRORS = (
+        "content_filter", "content management policy", "responsibleaipolicyviolation",
+        "context_length", "context length", "maximum context", "too many tokens", "string_above_max_length",
+    )
+
+    def __init__(self, deployment, api_version, ttl=3600):
+        self.deployment = deployment
+        self.api_version = api_version
+        self.ttl = ttl
+        self._known = {}  # feature -> (supported, learned_at, reason)
+        self._lock = threading.Lock()
+
+    def supports(self, feature):
+        """True unless the feature is known (and not expired) to be rejected"""
+        with self._lock:
+            entry = self._known.get(feature)
+            if entry is None:
+                return True
+            if time.monotonic() - entry[1] > self.ttl:
+                del self._known[feature]
+                return True
+            return entry[0]
+
+    def mark(self, feature, supported, reason=""):
+        with self._lock:
+            previous = self._known.get(feature)
+            self._known[feature] = (supported, time.monotonic(), reason[:300])
+        if not supported and (previous is None or previous[0]):
+            app.logger.warning(
+                f"Azure deployment {self.deployment} ({self.api_version}) rejected {feature}, "
+                f"skipping it for {int(self.ttl)}s: {reason[:200]}"
+            )
+
+    def adapt(self, params):
+        """Rewrite chat.completions.create() kwargs to avoid features known to be rejected"""
+        params = dict(params)
+        response_format = params.get("response_format") or {}
+        if response_format.get("type") == "json_schema" and not self.supports("json_schema"):
+            params["response_format"] = {"type": "json_object"}
+        if "tools" in params and not self.supports("tools"):
+            params.pop("tools")
+            params.pop("tool_choice", None)
+        if "max_tokens" in params and not self.supports("max_tokens"):
+            params["max_completion_tokens"] = params.pop("max_tokens")
+        if "temperature" in params and not self.supports("temperature"):
+            params.pop("temperature")
+        if params.get("stream") and self.supports("stream_usage"):
+            params.setdefault("stream_options", {"include_usage": True})
+        return params
+
+    @staticmethod
+    def is_rejection(error):
+        """True if the error is the deployment refusing the request (not a transient failure)"""
+        cause = error.__cause__ or error
+        if isinstance(cause, cassettes.CassetteMiss):
+            # Replay had no recording: says nothing about the deployment
+            return False
+        status = getattr(cause, "status_code", None)
+        if status is not None:
+            return status in (400, 422)
+        return not any(word in type(cause).__name__ for word in ("Connection", "Timeout", "RateLimit"))
+
+    @classmethod
+    def rejection_text(cls, error):
+        """
+        Lowercased message (and `param`) of a rejection naming a request feature;
+        "" for transient failures and for errors about the prompt (content filter, context length)
+        """
+        if not cls.is_rejection(error):
+            return ""
+        cause = error.__cause__ or error
+        text = f"{error} {getattr(cause, 'param', None) or ''}".lower()
+        if any(word in text for word in cls.PROMPT_ERRORS):
+            return ""
+        return text
+
+    @classmethod
+    def rejects_single_pass(cls, error):
+        """True if the error rejects tools or response_format, i.e. sending them in one call"""
+        msg = cls.rejection_text(error)
+        return any(word in msg for word in ("tools", "tool_choice", "response_format"))
+
+    def learn(self, params, error):
+        """
+        Inspect a failed call; returns True if a rejected feature was learned (worth retrying).
+        A call carrying both tools and response_format can't tell which one (or only the
+        combination) was rejected, so neither is learned from it: the error reaches
+        run_chat_single_pass(), which marks single_pass instead.
+        """
+        msg = self.rejection_text(error)
+        if not msg:
+            return False
+        response_format = params.get("response_format") or {}
+        combined = bool(params.get("tools")) and bool(params.get("response_format"))
+        unsupported = any(w in msg for w in ("unsupported", "not supported", "does not support", "invalid"))
+        if combined and any(w in msg for w in ("json_schema", "response_format", "tools", "tool_choice", "function")):
+            return False
+        if response_format.get("type") == "json_schema" and ("json_schema" in msg or "response_format" in msg):
+            self.mark("json_schema", False, str(error))
+            return True
+        if "max_tokens" in params and "max_tokens" in msg and (unsupported or "max_completion_tokens" in msg):
+            self.mark("max_tokens", False, str(error))
+            return True
+        if "temperature" in params and "temperature" in msg and unsupported:
+            self.mark("temperature", False, str(error))
+            return True
+        if "stream_options" in params and ("stream_options" in msg or "include_usage" in msg):
+            self.mark("stream_usage", False, str(error))
+            return True
+        if "tools" in params and ("tools" in msg or "tool_choice" in msg or "function" in msg) and unsupported:
+            self.mark("tools", False, str(error))
+            return True
+        return False
+
+    def probe(self):
+        """Send one tiny request using json_schema together with tools and record the outcome"""
+        params = {
+            "model": self.deployment,
+            "messages": [{"role": "user", "content": 'Reply with the JSON {"ok": true}'}],
+            "max_tokens": 20,
+            "temperature": 0,
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "probe",
+                    "schema": {
+                        "type": "object",
+                        "additionalProperties": False,
+                        "properties": {"ok": {"type": "boolean"}},
+                        "required": ["ok"]
+                    }
                 }
-            }]
+            },
+            "tools": TOOLS,
+            "tool_choice": "none",
         }
-        return result
+        try:
+            create_chat_completion(**params)
+            # The request that succeeded tells us which features are usable as sent
+            for feature in self.FEATURES:
+                if self.supports(feature):
+                    self.mark(feature, True)
+        except Exception as e:
+            if self.rejects_single_pass(e):
+                self.mark("single_pass", False, str(e))
+            app.logger.warning(f"Azure capability probe failed: {e}")
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            known = {
+                feature: {"supported": supported, "age_seconds": int(now - learned_at), "reason": reason}
+                for feature, (supported, learned_at, reason) in self._known.items()
+                if now - learned_at <= self.ttl
+            }
+        return {"deployment": self.deployment, "api_version": self.api_version, "known": known}
+
+
+deployment_capabilities = DeploymentCapabilities(DEPLOYMENT_ID, API_VERSION, ttl=AZURE_CAPABILITY_TTL)
+
+
+class ChatCompletionCall:
+    """
+    Bookkeeping of one create_chat_completion() call, shared with the async version in
+    asgi.py (which only awaits the admission queue and the request instead):
+    the deployment's circuit breaker (checked on creation, see azure_circuit()),
+    the admission slot, retries for newly learned capabilities and usage accounting.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.breaker = azure_circuit(params)
+        self.started = None
+        self.call_started = None
+
+    def admitted(self, started):
+        self.started = started
+
+    def attempt(self):
+        """kwargs for the next request, with features known to be rejected rewritten"""
+        record_llm_call()
+        self.call_started = time.perf_counter()
+        return deployment_capabilities.adapt(self.params)
+
+    def failed(self, adapted, error):
+        """After a failed request: True to retry it (a rejected feature was just learned)"""
+        record_azure_error(error)
+        if deployment_capabilities.learn(adapted, error):
+            return True
+        self.breaker.after_call(self.call_started, upstream_failure(error))
+        return False
+
+    def succeeded(self):
+        self.breaker.after_call(self.call_started)
+
+    def abort(self, error):
+        """The call ends with `error`: while queueing, after a failed request or cancelled"""
+        if self.started is None or not isinstance(error, Exception):
+            self.breaker.release()
+        if self.started is not None:
+            llm_admission.release(self.started)
+
+    def finish(self, completion):
+        """Release the slot of a non-streamed completion and account its token usage"""
+        llm_admission.release(self.started)
+        record_llm_usage(getattr(completion, "usage", None))
+        return completion
+
+
+def create_chat_completion(priority="chat", **params):
+    """
+    azure_openai_client.chat.completions.create() with deployment capability handling:
+    features known to be rejected are rewritten before sending, and a call rejected
+    for a newly learned reason is retried once per learned feature.
+    The call first takes a slot from llm_admission at `priority` (see LLM_PRIORITIES);
+    a streamed completion keeps its slot until the stream is consumed.
+    The deployment's circuit breaker is checked before queueing (see azure_circuit()).
+    """
+    call = ChatCompletionCall(params)
+    try:
+        call.admitted(llm_admission.acquire(priority))
+        while True:
+            adapted = call.attempt()
+            try:
+                completion = send_chat_completion(params, adapted)
+            except Exception as e:
+                if call.failed(adapted, e):
+                    continue
+                raise
+            call.succeeded()
+            break
+    except BaseException as e:
+        call.abort(e)
+        raise
+    if params.get("stream"):
+        return llm_admission.release_after(completion, call.started)
+    return call.finish(completion)
+
+
+def send_chat_completion(params, adapted):
+    """azure_openai_client.chat.completions.create(**adapted), recorded or replayed per CASSETTE_MODE"""
+    if not upstream_cassettes.mode:
+        return azure_openai_client.chat.completions.create(**adapted)
+    key, shape = azure_cassette_key(params)
+    if upstream_cassettes.replaying:
+        delay, answer = upstream_cassettes.replay_azure(key, shape)
+        if isinstance(answer, list):
+            return replay_stream(answer)
+        time.sleep(delay)
+        return answer
+    started = time.perf_counter()
+    completion = azure_openai_client.chat.completions.create(**adapted)
+    if params.get("stream"):
+        return upstream_cassettes.recording_stream(key, shape, completion, started)
+    upstream_cassettes.record_completion(key, shape, completion, time.perf_counter() - started)
+    return completion
+
+
+def replay_stream(chunks):
+    for delay, chunk in chunks:
+        if delay:
+            time.sleep(delay)
+        yield chunk
+
+
+# Azure OpenAI calls made by the current asgi.py request (Flask requests count in g.llm_calls)
+llm_call_count = contextvars.ContextVar("llm_call_count", default=None)
+
+
+def record_llm_call():
+    """Count an upstream Azure OpenAI call against the current request (see X-LLM-Calls)"""
+    counter = llm_call_count.get()
+    if counter is not None:
+        counter[0] += 1
+    elif has_request_context():
+        g.llm_calls = g.get("llm_calls", 0) + 1
+
+
+_llm_usage_local = threading.local()
+
+
+@contextlib.contextmanager
+def llm_usage_scope():
+    """Add up the token usage of the Azure OpenAI calls this thread makes inside the block"""
+    usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    previous = getattr(_llm_usage_local, "usage", None)
+    _llm_usage_local.usage = usage
+    try:
+        yield usage
+    finally:
+        _llm_usage_local.usage = previous
+
+
+def record_llm_usage(usage):
+    """
+    Account one Azure OpenAI call's token usage: in the usage ledger and /metrics, tagged
+    with the current request's route, stage and conversation, and in the thread's
+    llm_usage_scope() if one is open
+    """
+    totals = getattr(_llm_usage_local, "usage", None)
+    if totals is not None:
+        totals["calls"] += 1
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            totals[field] += getattr(usage, field, 0) or 0
+    if usage is None:
+        return
+    timing = current_request_timing() or {}
+    route = timing.get("route", "background")
+    stage_key = stage_name.get() or "llm"
+    prompt, cached, completion, _ = usage_ledger.record(
+        usage, route, stage_key, timing.get("conversation_id"), timing.get("request_id")
+    )
+    for kind, count in (("prompt", prompt), ("cached", cached), ("completion", completion)):
+        if count:
+            metrics.inc("lds_chatbot_llm_tokens_total", count, route=route, stage=stage_key, kind=kind)
+
+
+def build_completion_params(payload: dict):
+    """Translate a call_openai payload into chat.completions.create() keyword arguments"""
+    # Extract parameters from payload
+    messages = payload.get("messages", [])
+    temperature = payload.get("temperature", 0.3)
+    max_tokens = payload.get("max_tokens", 600)
+    response_format = payload.get("response_format")
+    tools = payload.get("tools")
+    tool_choice = payload.get("tool_choice")
+    
+    # Build request parameters
+    completion_params = {
+        "model": DEPLOYMENT_ID,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+    
+    if response_format:
+        completion_params["response_format"] = response_format
+    if tools:
+        completion_params["tools"] = tools
+    if tool_choice:
+        completion_params["tool_choice"] = tool_choice
+    return completion_params
+
+
+def completion_message(completion):
+    """The assistant message of a chat completion as a dict (the call_openai() result shape)"""
+    message = completion.choices[0].message
+    return {
+        "role": "assistant",
+        "content": message.content,
+        "tool_calls": [{
+            "id": tc.id,
+            "type": tc.type,
+            "function": {
+                "name": tc.function.name,
+                "arguments": tc.function.arguments
+            }
+        } for tc in (message.tool_calls or [])]
+    }
+
+
+class StreamedReply:
+    """
+    Reads a streamed completion chunk by chunk (for call_openai_stream() and its async
+    version): feed() accounts the usage chunk and returns the chunk's text, if any;
+    tool calls are put together from their fragments in tool_calls.
+    """
+
+    def __init__(self):
+        self._tool_calls = {}
+
+    def feed(self, chunk):
+        # The last chunk carries the usage (stream_options include_usage), without choices
+        if getattr(chunk, "usage", None):
+            record_llm_usage(chunk.usage)
+        # Azure sends chunks without choices (e.g. prompt filter results)
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        if delta is None:
+            return None
+        for tc in (delta.tool_calls or []):
+            entry = self._tool_calls.setdefault(tc.index, {
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if tc.id:
+                entry["id"] = tc.id
+            if tc.function:
+                entry["function"]["name"] += tc.function.name or ""
+                entry["function"]["arguments"] += tc.function.arguments or ""
+        return delta.content or None
+
+    @property
+    def tool_calls(self):
+        return [self._tool_calls[i] for i in sorted(self._tool_calls)]
+
+
+def call_openai(payload: dict):
+    """使用 Azure OpenAI client 調用 API"""
+    if not azure_openai_client:
+        raise RuntimeError("Azure OpenAI client not initialized. Please install: pip install openai azure-identity")
+    
+    try:
+        completion = create_chat_completion(**build_completion_params(payload))
+        # Convert to response format compatible with original format
+        return {"choices": [{"message": completion_message(completion)}]}
+    except LLMOverloaded:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Azure OpenAI error: {str(e)}") from e
+
+
+def call_openai_stream(payload: dict):
+    """
+    Streaming variant of call_openai.
+    The request is sent immediately (so errors such as a rejected response_format
+    are raised here); returns an iterator yielding ("content", delta_text) as tokens
+    arrive, then ("tool_calls", [...]) once at the end if the model called tools.
+    """
+    if not azure_openai_client:
+        raise RuntimeError("Azure OpenAI client not initialized. Please install: pip install openai azure-identity")
+
+    try:
+        stream = create_chat_completion(stream=True, **build_completion_params(payload))
+    except LLMOverloaded:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Azure OpenAI error: {str(e)}") from e
+
+    def _events():
+        reply = StreamedReply()
+        try:
+            for chunk in stream:
+                content = reply.feed(chunk)
+                if content:
+                    yield "content", content
+        except Exception as e:
+            raise RuntimeError(f"Azure OpenAI error: {str(e)}") from e
+        if reply.tool_calls:
+            yield "tool_calls", reply.tool_calls
+
+    return _events()
+
+
+def tool_call_args(tc):
+    """The JSON arguments of a tool call ({} when missing or malformed)"""
+    args_str = tc["function"].get("arguments", "{}")
+    try:
+        return json.loads(args_str) if args_str else {}
+    except json.JSONDecodeError:
+        return {}
+
+
+def tool_message(tc, result):
+    return {
+        "role": "tool",
+        "tool_call_id": tc["id"],
+        "content": json.dumps(result, ensure_ascii=False),
+    }
+
+
+def execute_tool_calls(tool_calls):
+    """Run the model's tool calls against LDS and return the "tool" messages for the next stage"""
+    with stage("tools"):
+        return [tool_message(tc, call_lds_api(tc["function"]["name"], tool_call_args(tc))) for tc in tool_calls]
+
+
+def single_pass_payload(messages, temperature, max_tokens, response_format, tools):
+    """First call of run_chat_single_pass(): tools and response_format together"""
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "response_format": response_format,
+    }
+    if tools:
+        payload["tools"] = tools
+        payload["tool_choice"] = "auto"
+    return payload
+
+
+def single_pass_rejected(error, tools):
+    """
+    After the single-pass call failed: True if the deployment rejected it (the caller
+    falls back to 2-stage; single_pass is marked unsupported if tools/response_format
+    were named), False for errors to raise (transient failures, prompt errors)
+    """
+    if not DeploymentCapabilities.rejection_text(error):
+        return False
+    app.logger.warning(f"Single-pass chat rejected, falling back to 2-stage: {error}")
+    if tools and DeploymentCapabilities.rejects_single_pass(error):
+        deployment_capabilities.mark("single_pass", False, str(error))
+    return True
+
+
+def reply_tool_calls(data, tools):
+    """(message, tool calls to run) of a call_openai() result"""
+    message = data["choices"][0].get("message", {})
+    return message, (message.get("tool_calls", []) if tools else [])
+
+
+def final_answer_payload(payload, messages):
+    """Call after the tool results: `messages` in the first call's response_format, without tools"""
+    return {
+        "messages": messages,
+        "temperature": payload["temperature"],
+        "max_tokens": payload["max_tokens"],
+        "response_format": payload["response_format"],
+    }
+
+
+def run_chat_single_pass(
+    messages,
+    temperature=0.3,
+    max_tokens=600,
+    response_format=None,
+    tools=None,
+):
+    """
+    1-call strategy (CHAT_EXECUTION_MODE=single_pass):
+      - Send tools AND response_format together; if the model answers directly,
+        that answer already follows the schema and is returned as-is
+      - Only when a tool is called, run it and make one more call for the final answer
+    Falls back to json_object when json_schema isn't supported. Returns None when the
+    deployment rejects the first call (the caller then uses the 2-stage strategy);
+    transient errors (timeouts, 5xx) and errors of the final call are raised.
+    """
+    payload = single_pass_payload(messages, temperature, max_tokens, response_format, tools)
+    try:
+        data1 = call_openai_with_format_fallback(payload, "llm_single_pass")
+    except LLMOverloaded:
+        raise
+    except Exception as e:
+        if not single_pass_rejected(e, tools):
+            raise
+        return None
+
+    msg1, tool_calls = reply_tool_calls(data1, tools)
+    if not tool_calls:
+        return msg1
+
+    payload2 = final_answer_payload(payload, messages + [msg1] + execute_tool_calls(tool_calls))
+    data2 = call_openai_with_format_fallback(payload2, "llm_final")
+    return data2["choices"][0]["message"]
+
+
+def json_object_fallback(payload, error):
+    """
+    After call_openai(payload) failed: True if the deployment rejected it and
+    response_format was not json_object yet (payload is switched to json_object,
+    so later calls reuse it); False for errors to raise
+    """
+    if payload["response_format"].get("type") == "json_object" or not DeploymentCapabilities.rejection_text(error):
+        return False
+    payload["response_format"] = {"type": "json_object"}
+    return True
+
+
+def call_openai_with_format_fallback(payload, stage_name):
+    """
+    call_openai(payload) timed as stage_name. If the deployment rejects the call and
+    response_format is not json_object yet, it is retried once with json_object
+    (payload is updated, so later calls reuse it); other errors are raised.
+    """
+    try:
+        with stage(stage_name):
+            return call_openai(payload)
+    except LLMOverloaded:
+        raise
     except Exception as e:
-        raise RuntimeError(f"Azure OpenAI error: {str(e)}")
+        if not json_object_fallback(payload, e):
+            raise
+        with stage(f"{stage_name}_fallback"):
+            return call_openai(payload)
 
 
 def run_chat_with_optional_tools(
@@ -322,13 +2278,31 @@ def run_chat_with_optional_tools(
     max_tokens=600,
     response_format=None,
     tools=None,
+    allow_single_pass=True,
 ):
     """
     Safer 2-stage strategy:
       - Stage 1: allow tool calling WITHOUT forcing response_format (more compatible)
       - Stage 2: after tool results, enforce response_format (schema) for final output
     Also provides fallback when json_schema isn't supported.
+    In single_pass mode (default) run_chat_single_pass() is tried first and this
+    strategy is only used if the deployment rejects its first call.
     """
+    if (
+        allow_single_pass
+        and CHAT_EXECUTION_MODE == "single_pass"
+        and response_format
+        and deployment_capabilities.supports("single_pass")
+    ):
+        msg = run_chat_single_pass(
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format=response_format,
+            tools=tools,
+        )
+        if msg is not None:
+            return msg
 
     # -------------------------
     # Stage 1 (tools allowed)
@@ -342,7 +2316,8 @@ def run_chat_with_optional_tools(
         payload1["tools"] = tools
         payload1["tool_choice"] = "auto"
 
-    data1 = call_openai(payload1)
+    with stage("llm_stage1"):
+        data1 = call_openai(payload1)
     msg1 = data1["choices"][0].get("message", {})
     tool_calls = msg1.get("tool_calls", []) if tools else []
 
@@ -352,34 +2327,29 @@ def run_chat_with_optional_tools(
             try:
                 payload_schema = dict(payload1)
                 payload_schema["response_format"] = response_format
-                data_schema = call_openai(payload_schema)
+                if not deployment_capabilities.supports("single_pass"):
+                    # No tool was called; don't resend tools with response_format to a
+                    # deployment that rejects the two in one call
+                    payload_schema.pop("tools", None)
+                    payload_schema.pop("tool_choice", None)
+                with stage("llm_schema"):
+                    data_schema = call_openai(payload_schema)
                 return data_schema["choices"][0]["message"]
+            except LLMOverloaded:
+                raise
             except Exception:
                 # Fallback
-                payload_fallback = dict(payload1)
+                payload_fallback = dict(payload_schema)
                 payload_fallback["response_format"] = {"type": "json_object"}
-                data_fb = call_openai(payload_fallback)
+                with stage("llm_schema_fallback"):
+                    data_fb = call_openai(payload_fallback)
                 return data_fb["choices"][0]["message"]
         return msg1
 
     # -------------------------
     # Execute tools
     # -------------------------
-    tool_messages = []
-    for tc in tool_calls:
-        fn = tc["function"]["name"]
-        args_str = tc["function"].get("arguments", "{}")
-        try:
-            args = json.loads(args_str) if args_str else {}
-        except json.JSONDecodeError:
-            args = {}
-
-        result = call_lds_api(fn, args)
-        tool_messages.append({
-            "role": "tool",
-            "tool_call_id": tc["id"],
-            "content": json.dumps(result, ensure_ascii=False),
-        })
+    tool_messages = execute_tool_calls(tool_calls)
 
     # -------------------------
     # Stage 2 (final answer in schema)
@@ -394,17 +2364,73 @@ def run_chat_with_optional_tools(
     if response_format:
         try:
             payload2["response_format"] = response_format
-            data2 = call_openai(payload2)
+            with stage("llm_stage2"):
+                data2 = call_openai(payload2)
             return data2["choices"][0]["message"]
+        except LLMOverloaded:
+            raise
         except Exception:
             payload2["response_format"] = {"type": "json_object"}
-            data2 = call_openai(payload2)
+            with stage("llm_stage2_fallback"):
+                data2 = call_openai(payload2)
             return data2["choices"][0]["message"]
 
-    data2 = call_openai(payload2)
+    with stage("llm_stage2"):
+        data2 = call_openai(payload2)
     return data2["choices"][0]["message"]
 
 
+if AZURE_CAPABILITY_PROBE:
+    threading.Thread(target=deployment_capabilities.probe, daemon=True).start()
+
+
+@app.before_request
+def start_stage_timing():
+    g.request_timing = start_request_timing(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Server-Timing for the stages run so far (for a streamed response: those before the
+    first byte); the request duration is recorded once the response has been sent.
+    """
+    timing = current_request_timing()
+    if timing is not None:
+        response.headers["Server-Timing"] = server_timing_header(timing)
+        record = functools.partial(
+            metrics.observe_since, "lds_chatbot_request_duration_seconds", timing["started"],
+            route=timing["route"], method=request.method, status=response.status_code,
+        )
+        if response.is_streamed:
+            response.response = record_when_exhausted(response.response, record)
+        else:
+            record()
+    return response
+
+
+def record_when_exhausted(body, record):
+    try:
+        yield from body
+    finally:
+        record()
+
+
+@app.teardown_request
+def clear_stage_timing(exc):
+    request_timing.set(None)
+
+
+@app.after_request
+def add_llm_call_count(response):
+    """Report how many Azure OpenAI calls the request took"""
+    llm_calls = g.get("llm_calls", 0)
+    if llm_calls:
+        response.headers["X-LLM-Calls"] = str(llm_calls)
+        app.logger.info(f"{request.method} {request.path} used {llm_calls} LLM call(s)")
+    return response
+
+
 # =========================
 # Routes
 # =========================
@@ -418,6 +2444,14 @@ def home():
     return jsonify({"status": "ok", "message": "LDS Chatbot backend is running."})
 
 
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus scrape endpoint (this worker process only); disable with ENABLE_METRICS=0"""
+    if not ENABLE_METRICS:
+        return jsonify({"error": "Not found"}), 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/api/health", methods=["GET"])
 def health_check():
     """
@@ -435,12 +2469,11 @@ def health_check():
     
     # Test LDS API connection
     try:
-        test_url = f"{LARAVEL_HOST_API}/chatbot/options/courses/subjects"
-        test_resp = requests.post(
+        test_url = LDS_ENDPOINTS["subjects"]
+        test_resp = lds_client.post(
             test_url,
-            headers=lds_headers,
-            json={"locale": "zh_HK"},
-            timeout=(5, 10)
+            route="health",
+            json={"locale": "zh_HK"}
         )
         health_info["lds_api"] = {
             "status": "connected" if 200 <= test_resp.status_code < 300 else "error",
@@ -453,11 +2486,26 @@ def health_check():
             "error": str(e),
             "type": type(e).__name__
         }
+
+    health_info["azure_capabilities"] = deployment_capabilities.snapshot()
+    health_info["lds_client"] = lds_client.stats()
+    health_info["lds_cache"] = lds_option_cache.stats()
+    health_info["tool_cache"] = {name: cache.stats() for name, cache in tool_result_caches.items()}
+    health_info["ilo_cache"] = ilo_result_cache.stats()
+    health_info["llm_admission"] = llm_admission.stats()
+    health_info["history_summary_cache"] = history_summary_cache.stats()
+    health_info["conversation_store"] = conversation_store.stats()
+    health_info["document_parser"] = document_parser_pool.stats()
+    health_info["document_cache"] = extracted_text_cache.stats() if extracted_text_cache else None
+    health_info["token_usage"] = usage_ledger.stats()
+    health_info["cassettes"] = upstream_cassettes.stats() if upstream_cassettes.mode else None
+    health_info["circuit_breakers"] = circuit_breaker_stats()
     
     return jsonify(health_info)
 
 
 @app.route("/api/ilo-categories", methods=["GET", "POST", "OPTIONS"])
+@cached_lds_options("ilo_categories")
 def get_ilo_categories():
     """
     Get ILO Categories list from LDS API
@@ -474,7 +2522,7 @@ def get_ilo_categories():
             locale = request.args.get("locale", "zh_HK")
         
         # 呼叫 LDS API
-        categories_url = f"{LARAVEL_HOST_API}/chatbot/options/intended-learning-outcomes/types"
+        categories_url = LDS_ENDPOINTS["ilo_categories"]
         
         request_data = {}
         if locale:
@@ -482,11 +2530,10 @@ def get_ilo_categories():
         
         app.logger.info(f"Calling LDS API: {categories_url} with method: POST, data: {request_data}")
         
-        resp = requests.post(
+        resp = lds_client.post(
             categories_url,
-            headers=lds_headers,
-            json=request_data if request_data else {},
-            timeout=(5, 30)
+            route="ilo_categories",
+            json=request_data if request_data else {}
         )
         
         app.logger.info(f"LDS API response status: {resp.status_code}")
@@ -538,18 +2585,17 @@ def get_ilo_patterns():
 
     try:
         # Call LDS API
-        patterns_url = f"{LARAVEL_HOST_API}/chatbot/patterns/intended-learning-outcomes"
+        patterns_url = LDS_ENDPOINTS["ilo_patterns"]
         
         # Get request parameters (if any)
         request_data = request.json or {}
         
         app.logger.info(f"Calling LDS API: {patterns_url} with method: POST")
         
-        resp = requests.post(
+        resp = lds_client.post(
             patterns_url,
-            headers=lds_headers,
-            json=request_data if request_data else {},
-            timeout=(5, 30)
+            route="ilo_patterns",
+            json=request_data if request_data else {}
         )
         
         app.logger.info(f"LDS API response status: {resp.status_code}")
@@ -584,6 +2630,7 @@ def get_ilo_patterns():
 
 
 @app.route("/api/bloom-taxonomy-levels", methods=["GET", "POST", "OPTIONS"])
+@cached_lds_options("bloom_taxonomy_levels")
 def get_bloom_taxonomy_levels():
     """
     Get Bloom Taxonomy Levels list from LDS API
@@ -600,7 +2647,7 @@ def get_bloom_taxonomy_levels():
             locale = request.args.get("locale", "zh_HK")
         
         # 呼叫 LDS API
-        bloom_url = f"{LARAVEL_HOST_API}/chatbot/options/intended-learning-outcomes/bloom-taxonomy-levels"
+        bloom_url = LDS_ENDPOINTS["bloom_taxonomy_levels"]
         
         request_data = {}
         if locale:
@@ -608,11 +2655,10 @@ def get_bloom_taxonomy_levels():
         
         app.logger.info(f"Calling LDS API: {bloom_url} with method: POST, data: {request_data}")
         
-        resp = requests.post(
+        resp = lds_client.post(
             bloom_url,
-            headers=lds_headers,
-            json=request_data if request_data else {},
-            timeout=(5, 30)
+            route="bloom_taxonomy_levels",
+            json=request_data if request_data else {}
         )
         
         app.logger.info(f"LDS API response status: {resp.status_code}")
@@ -655,6 +2701,7 @@ def get_bloom_taxonomy_levels():
 
 
 @app.route("/api/grade-levels", methods=["GET", "POST", "OPTIONS"])
+@cached_lds_options("grade_levels")
 def get_grade_levels():
     """
     Get grade levels list from LDS API
@@ -671,7 +2718,7 @@ def get_grade_levels():
             locale = request.args.get("locale", "zh_HK")
         
         # 呼叫 LDS API
-        grade_levels_url = f"{LARAVEL_HOST_API}/chatbot/options/courses/grade-levels"
+        grade_levels_url = LDS_ENDPOINTS["grade_levels"]
         
         # 準備請求 body
         request_data = {}
@@ -680,11 +2727,10 @@ def get_grade_levels():
         
         app.logger.info(f"Calling LDS API: {grade_levels_url} with method: POST, data: {request_data}")
         
-        resp = requests.post(
+        resp = lds_client.post(
             grade_levels_url,
-            headers=lds_headers,
-            json=request_data if request_data else {},
-            timeout=(5, 30)
+            route="grade_levels",
+            json=request_data if request_data else {}
         )
         
         app.logger.info(f"LDS API response status: {resp.status_code}")
@@ -727,6 +2773,7 @@ def get_grade_levels():
 
 
 @app.route("/api/subjects", methods=["GET", "POST", "OPTIONS"])
+@cached_lds_options("subjects")
 def get_subjects():
     """
     Get subjects list from LDS API
@@ -745,7 +2792,7 @@ def get_subjects():
             locale = request.args.get("locale", "zh_HK")
         
         # 呼叫 LDS API
-        subjects_url = f"{LARAVEL_HOST_API}/chatbot/options/courses/subjects"
+        subjects_url = LDS_ENDPOINTS["subjects"]
         
         # Prepare request body (POST) or params (GET)
         request_data = {}
@@ -767,11 +2814,10 @@ def get_subjects():
         app.logger.info(f"LARAVEL_HOST_API: {LARAVEL_HOST_API}")
         
         # Try using POST (because other chatbot/options endpoints use POST)
-        resp = requests.post(
+        resp = lds_client.post(
             subjects_url,
-            headers=lds_headers,
-            json=request_data if request_data else {},
-            timeout=(5, 30)
+            route="subjects",
+            json=request_data if request_data else {}
         )
         
         app.logger.info(f"LDS API response status: {resp.status_code}")
@@ -840,48 +2886,81 @@ def get_subjects():
         return jsonify({"error": str(e), "type": type(e).__name__}), 500
 
 
-def generate_suggested_questions(user_message, bot_reply, conversation_history):
+@app.route("/api/bootstrap", methods=["GET", "POST", "OPTIONS"])
+def bootstrap():
     """
-    Generate 3 suggestions to help users know how to continue the conversation with the chatbot
-    These suggestions are presented in the user's tone when speaking to the chatbot (e.g., "I want to understand...", "My goal is...")
-    These suggestions are not restricted by the system prompt because they are suggested by the bot
-    Generate relevant suggestions based on the bot's response content
+    Fetch all option lists the frontend needs on load, in parallel.
+    Returns {"<section>": {"data": [...], "error": null}, ...}; a failing section
+    carries its own error and an empty list without failing the others.
     """
-    try:
-        # Build conversation context summary
-        context_summary = ""
-        if conversation_history:
-            # Get recent 3 rounds of conversation (user and bot)
-            recent_messages = conversation_history[-6:] if len(conversation_history) >= 6 else conversation_history
-            context_parts = []
-            for msg in recent_messages:
-                role = msg.get("role", "")
-                content = msg.get("content", "")
-                if content:
-                    context_parts.append(f"{'用戶' if role == 'user' else '機器人'}: {content[:100]}")
-            if context_parts:
-                context_summary = "\n".join(context_parts[-4:])  # Only take the most recent 4
-        
-        # Analyze bot response content type
-        bot_reply_lower = bot_reply.lower()
-        is_guiding = any(keyword in bot_reply_lower for keyword in ["希望", "您想", "可以", "建議", "例如", "什麼"])
-        is_providing_suggestions = any(keyword in bot_reply_lower for keyword in ["學習目標", "教學活動", "評量", "建議", "可以"])
-        is_asking_question = "?" in bot_reply or "？" in bot_reply
-        
-        # Build more detailed prompt
-        prompt = f"""你是一個教學設計助手，需要根據機器人的回應生成3個建議，幫助使用者知道如何繼續與聊天機器人對話。
+    if request.method == "OPTIONS":
+        return ("", 204)
 
-**當前對話：**
-使用者剛才說：{user_message[:150]}
+    locale = request_locale()
+    sections = {
+        "subjects": lambda: get_lds_option_list("subjects", locale),
+        "grade_levels": lambda: get_lds_option_list("grade_levels", locale),
+        "ilo_categories": lambda: get_lds_option_list("ilo_categories", locale),
+        "ilo_patterns": lambda: fetch_lds_option_list("ilo_patterns", None),
+        "bloom_taxonomy_levels": lambda: get_lds_option_list("bloom_taxonomy_levels", locale),
+    }
 
-機器人回應：
-{bot_reply[:400]}
+    result = {}
+    with ThreadPoolExecutor(max_workers=len(sections)) as executor:
+        futures = {name: executor.submit(bind_request_timing(fn)) for name, fn in sections.items()}
+        for name, future in futures.items():
+            try:
+                result[name] = {"data": future.result(), "error": None}
+            except Exception as e:
+                app.logger.error(f"Bootstrap section {name} failed: {e}")
+                result[name] = {"data": [], "error": str(e), "type": type(e).__name__}
 
-**對話歷史：**
-{context_summary if context_summary else "這是對話的開始"}
+    return jsonify(result)
 
-**任務：**
-根據機器人的回應內容，生成3個簡短、具體的建議（每個不超過25字）。這些建議應該：
+
+DEFAULT_SUGGESTED_QUESTIONS = [
+    "我想進一步細化這些學習目標",
+    "我想了解如何設計對應的教學活動",
+    "我想知道需要考慮哪些評量方式"
+]
+
+
+def build_suggestion_messages(user_message, bot_reply, conversation_history):
+    """Prompt messages for generate_suggested_questions()"""
+    # Build conversation context summary
+    context_summary = ""
+    if conversation_history:
+        # Get recent 3 rounds of conversation (user and bot)
+        recent_messages = conversation_history[-6:] if len(conversation_history) >= 6 else conversation_history
+        context_parts = []
+        for msg in recent_messages:
+            role = msg.get("role", "")
+            content = msg.get("content", "")
+            if content:
+                context_parts.append(f"{'用戶' if role == 'user' else '機器人'}: {content[:100]}")
+        if context_parts:
+            context_summary = "\n".join(context_parts[-4:])  # Only take the most recent 4
+    
+    # Analyze bot response content type
+    bot_reply_lower = bot_reply.lower()
+    is_guiding = any(keyword in bot_reply_lower for keyword in ["希望", "您想", "可以", "建議", "例如", "什麼"])
+    is_providing_suggestions = any(keyword in bot_reply_lower for keyword in ["學習目標", "教學活動", "評量", "建議", "可以"])
+    is_asking_question = "?" in bot_reply or "？" in bot_reply
+    
+    # Build more detailed prompt
+    prompt = f"""你是一個教學設計助手，需要根據機器人的回應生成3個建議，幫助使用者知道如何繼續與聊天機器人對話。
+
+**當前對話：**
+使用者剛才說：{user_message[:150]}
+
+機器人回應：
+{bot_reply[:400]}
+
+**對話歷史：**
+{context_summary if context_summary else "這是對話的開始"}
+
+**任務：**
+根據機器人的回應內容，生成3個簡短、具體的建議（每個不超過25字）。這些建議應該：
 1. 以「使用者對聊天機器人說話」的語氣呈現（例如：「我想了解...」、「我的目標是...」、「我考慮...」）
 2. 不是直接的問題，而是使用者可以對聊天機器人說的話
 3. 與機器人回應的內容直接相關，幫助使用者知道如何繼續對話
@@ -903,112 +2982,603 @@ def generate_suggested_questions(user_message, bot_reply, conversation_history):
 {{"questions": ["建議1（使用者可以說的話）", "建議2（使用者可以說的話）", "建議3（使用者可以說的話）"]}}
 
 只返回 JSON，不要其他文字。"""
+    
+    messages = [
+        {
+            "role": "system", 
+            "content": "你是一個教學設計助手，專門生成建議，幫助使用者知道如何繼續與聊天機器人對話。你必須返回有效的 JSON 格式，包含 'questions' 字段，值為包含3個建議的數組。每個建議應該：1) 以使用者對聊天機器人說話的語氣呈現（例如「我想了解...」、「我的目標是...」），2) 不是直接的問題，而是使用者可以說的話，3) 簡短（不超過25字）、具體、可操作。"
+        },
+        {"role": "user", "content": prompt}
+    ]
+    return messages
+
+
+def parse_suggested_questions(content):
+    """Extract 3 suggestions from the model's answer; None if nothing usable was found"""
+    try:
+        # Try to parse JSON
+        parsed = json.loads(content)
+        # May be {"questions": [...]} or directly an array
+        if isinstance(parsed, dict):
+            questions = parsed.get("questions", parsed.get("suggested_questions", []))
+        elif isinstance(parsed, list):
+            questions = parsed
+        else:
+            questions = []
         
-        messages = [
-            {
-                "role": "system", 
-                "content": "你是一個教學設計助手，專門生成建議，幫助使用者知道如何繼續與聊天機器人對話。你必須返回有效的 JSON 格式，包含 'questions' 字段，值為包含3個建議的數組。每個建議應該：1) 以使用者對聊天機器人說話的語氣呈現（例如「我想了解...」、「我的目標是...」），2) 不是直接的問題，而是使用者可以說的話，3) 簡短（不超過25字）、具體、可操作。"
-            },
-            {"role": "user", "content": prompt}
-        ]
-        
-        payload = {
-            "messages": messages,
-            "temperature": 0.8,  # Slightly increase temperature for more diverse questions
-            "max_tokens": 200,  # Increase token limit for better questions
-            "response_format": {"type": "json_object"}
-        }
+        # Ensure 3 questions are returned
+        if isinstance(questions, list) and len(questions) >= 3:
+            return questions[:3]
+        elif isinstance(questions, list) and len(questions) > 0:
+            # If less than 3, pad
+            while len(questions) < 3:
+                questions.append("")
+            return questions[:3]
+    except:
+        # If parsing fails, try to extract from text
+        questions = re.findall(r'["\']([^"\']+)["\']', content)
+        if len(questions) >= 3:
+            return questions[:3]
+    return None
+
+
+def generate_suggested_questions(user_message, bot_reply, conversation_history):
+    """
+    Generate 3 suggestions to help users know how to continue the conversation with the chatbot
+    These suggestions are presented in the user's tone when speaking to the chatbot (e.g., "I want to understand...", "My goal is...")
+    These suggestions are not restricted by the system prompt because they are suggested by the bot
+    Generate relevant suggestions based on the bot's response content
+    """
+    try:
+        messages = build_suggestion_messages(user_message, bot_reply, conversation_history)
         
         # Use Azure OpenAI client
         if not azure_openai_client:
             # If client not initialized, return default questions
-            return [
-                "我想進一步細化這些學習目標",
-                "我想了解如何設計對應的教學活動",
-                "我想知道需要考慮哪些評量方式"
-            ]
+            return list(DEFAULT_SUGGESTED_QUESTIONS)
         
         try:
-            completion = azure_openai_client.chat.completions.create(
-                model=DEPLOYMENT_ID,
-                messages=messages,
-                temperature=0.8,
-                max_tokens=200,
-                response_format={"type": "json_object"}
-            )
-            content = completion.choices[0].message.content
-            
-            try:
-                # Try to parse JSON
-                parsed = json.loads(content)
-                # May be {"questions": [...]} or directly an array
-                if isinstance(parsed, dict):
-                    questions = parsed.get("questions", parsed.get("suggested_questions", []))
-                elif isinstance(parsed, list):
-                    questions = parsed
-                else:
-                    questions = []
-                
-                # Ensure 3 questions are returned
-                if isinstance(questions, list) and len(questions) >= 3:
-                    return questions[:3]
-                elif isinstance(questions, list) and len(questions) > 0:
-                    # If less than 3, pad
-                    while len(questions) < 3:
-                        questions.append("")
-                    return questions[:3]
-            except:
-                # If parsing fails, try to extract from text
-                import re
-                questions = re.findall(r'["\']([^"\']+)["\']', content)
-                if len(questions) >= 3:
-                    return questions[:3]
+            with stage("suggestions"):
+                completion = create_chat_completion(
+                    priority="suggestions",
+                    model=DEPLOYMENT_ID,
+                    messages=messages,
+                    temperature=0.8,  # Slightly increase temperature for more diverse questions
+                    max_tokens=200,  # Increase token limit for better questions
+                    response_format={"type": "json_object"}
+                )
+            questions = parse_suggested_questions(completion.choices[0].message.content)
+            if questions:
+                return questions
         except Exception as e:
             app.logger.error(f"Error calling Azure OpenAI for suggested questions: {e}")
             # Return default suggestions
-            return [
-                "我想進一步細化這些學習目標",
-                "我想了解如何設計對應的教學活動",
-                "我想知道需要考慮哪些評量方式"
-            ]
+            return list(DEFAULT_SUGGESTED_QUESTIONS)
         
         # If generation fails, return default suggestions (in user's tone)
-        return [
-            "我想進一步細化這些學習目標",
-            "我想了解如何設計對應的教學活動",
-            "我想知道需要考慮哪些評量方式"
-        ]
+        return list(DEFAULT_SUGGESTED_QUESTIONS)
     except Exception as e:
         app.logger.error(f"Error generating suggested questions: {e}")
         # 返回默認建議（以用戶語氣）
-        return [
-            "我想進一步細化這些學習目標",
-            "我想了解如何設計對應的教學活動",
-            "我想知道需要考慮哪些評量方式"
-        ]
+        return list(DEFAULT_SUGGESTED_QUESTIONS)
 
 
-@app.route("/api/chat", methods=["POST", "OPTIONS"])
-def chat_general():
+class ReplyTextExtractor:
     """
-    Returns:
-    {
-      "chat_message_reply": {"text": "..."},
-      "actions": [...]
-    }
+    Incrementally pull chat_message_reply.text out of a streamed JSON answer,
+    so the text can be forwarded before the JSON document is complete.
+    Answers that are not JSON at all are passed through unchanged.
     """
-    if request.method == "OPTIONS":
-        return ("", 204)
 
-    data = request.json or {}
-    user_msg = (data.get("message") or "").strip()
-    
-    # If it's a BOT-suggested question, skip scope check and accept directly
-    is_suggested_question = data.get("is_suggested_question", False)
-    
-    if not is_suggested_question and not is_in_scope(user_msg):
-        return jsonify({"chat_message_reply": {"text": REFUSAL_TEXT}, "actions": []})
+    _TEXT_START = re.compile(r'"chat_message_reply"\s*:\s*\{[^{}]*?"text"\s*:\s*"')
+    _ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "/": "/", "\\": "\\", '"': '"'}
+
+    def __init__(self):
+        self.parts = []
+        self._buffer = ""
+        self._pos = None
+        self._plain = None
+        self._done = False
+
+    @property
+    def content(self):
+        return "".join(self.parts)
+
+    def json_content(self):
+        """The full answer as a JSON document (code fences stripped, plain text wrapped)."""
+        content = self.content.strip()
+        if self._plain:
+            return json.dumps({"chat_message_reply": {"text": content}}, ensure_ascii=False)
+        if content.startswith("```"):
+            content = re.sub(r"^```(?:json)?\s*|\s*```$", "", content)
+        return content
+
+    def feed(self, chunk):
+        """Add a streamed chunk; returns the newly decoded reply text (may be empty)."""
+        self.parts.append(chunk)
+        if self._plain is None:
+            head = self.content.lstrip()
+            if not head or "```".startswith(head):
+                # "`" or "``" may still become a code fence: decide on a later chunk
+                return ""
+            self._plain = not head.startswith(("{", "```"))
+            # Include the chunks held back while undecided
+            chunk = self.content
+        if self._plain:
+            return chunk
+        if self._done:
+            return ""
+
+        self._buffer += chunk
+        if self._pos is None:
+            match = self._TEXT_START.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        buf = self._buffer
+        i = self._pos
+        out = []
+        while i < len(buf):
+            c = buf[i]
+            if c == '"':
+                self._done = True
+                break
+            if c != "\\":
+                out.append(c)
+                i += 1
+                continue
+            # Escape sequence: wait until it is complete
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc != "u":
+                out.append(self._ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            try:
+                code = int(buf[i + 2:i + 6], 16)
+            except ValueError:
+                out.append(buf[i:i + 6])
+                i += 6
+                continue
+            if 0xD800 <= code < 0xDC00:
+                # Surrogate pair: needs the following \uXXXX too
+                if i + 12 > len(buf):
+                    break
+                try:
+                    low = int(buf[i + 8:i + 12], 16)
+                    out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                    i += 12
+                    continue
+                except ValueError:
+                    pass
+            out.append(chr(code))
+            i += 6
+        self._pos = i
+        return "".join(out)
+
+
+def wants_event_stream(data, accept_header):
+    """Streaming is opt-in: {"stream": true} in the body or Accept: text/event-stream"""
+    return bool(data.get("stream")) or "text/event-stream" in (accept_header or "")
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# =========================
+# Conversation history (token budget + rolling summary)
+# =========================
+_token_encoding = None
+
+
+def load_token_encoding():
+    """
+    Load the tiktoken encoding for DEPLOYMENT_ID (o200k_base for unknown deployment names).
+    tiktoken downloads its BPE file on first use, so this runs once, in the background at
+    startup; if it fails (e.g. no outbound access) token counts stay estimates for good.
+    """
+    global _token_encoding
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(DEPLOYMENT_ID)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        app.logger.warning(f"tiktoken encoding unavailable, estimating token counts instead: {e}")
+        return
+    _token_encoding = encoding
+
+
+def get_token_encoding():
+    """The tiktoken encoding, or None while it loads, after it failed to, or without tiktoken"""
+    return _token_encoding
+
+
+if TIKTOKEN_AVAILABLE:
+    threading.Thread(target=load_token_encoding, name="tiktoken-load", daemon=True).start()
+
+
+def count_tokens(text):
+    """Tokens in text; without tiktoken, ~1 per CJK character and ~4 characters per token otherwise"""
+    if not text:
+        return 0
+    encoding = get_token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(re.findall(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(msg):
+    # ~4 tokens of per-message overhead (role and separators)
+    return count_tokens(msg["content"]) + 4
+
+
+def truncate_to_tokens(text, limit):
+    """Keep the start of text within `limit` tokens"""
+    if count_tokens(text) <= limit:
+        return text
+    marker = "…（內容過長，已截斷）"
+    limit = max(1, limit - count_tokens(marker))
+    encoding = get_token_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:limit]) + marker
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + marker
+
+
+# Summary of history[:k], keyed by the hash chain of those k messages
+history_summary_cache = TTLCache(CHAT_SUMMARY_TTL, max_entries=CHAT_SUMMARY_CACHE_SIZE)
+
+
+def history_prefix_hashes(history):
+    """hashes[k] identifies history[:k]; computed as a chain so every prefix costs one step"""
+    hashes = [hashlib.sha256(f"v{CHAT_SUMMARY_PROMPT_VERSION}".encode()).hexdigest()]
+    for msg in history:
+        hashes.append(hashlib.sha256((hashes[-1] + canonical_json(msg)).encode("utf-8")).hexdigest())
+    return hashes
+
+
+def summarize_history(previous_summary, messages):
+    """Fold `messages` into `previous_summary` (one LLM call)"""
+    transcript = "\n".join(
+        f"{'使用者' if m['role'] == 'user' else '助手'}：{m['content']}" for m in messages
+    )
+    prompt = (
+        (f"先前摘要：\n{previous_summary}\n\n" if previous_summary else "")
+        + f"新增對話：\n{transcript}\n\n"
+        "請更新摘要：保留使用者的教學情境（科目、年級、主題、學生）、已確認的決定與學習目標、"
+        "尚未解決的問題；略去寒暄與重複內容。只輸出摘要本文。"
+    )
+    with stage("history_summary"):
+        completion = create_chat_completion(
+            model=DEPLOYMENT_ID,
+            messages=[
+                {"role": "system", "content": "你負責為學習設計助手壓縮對話歷史，供後續回覆參考。"},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.2,
+            max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+        )
+    return (completion.choices[0].message.content or "").strip()
+
+
+def clean_history(conversation_history):
+    """user/assistant messages with text, each capped at CHAT_HISTORY_MESSAGE_TOKENS"""
+    history = []
+    for msg in conversation_history or []:
+        if not isinstance(msg, dict):
+            continue
+        role = msg.get("role")
+        content = msg.get("content", "")
+        if role in ["user", "assistant"] and isinstance(content, str) and content:
+            history.append({"role": role, "content": truncate_to_tokens(content, CHAT_HISTORY_MESSAGE_TOKENS)})
+    return history
+
+
+def suffix_token_counts(history):
+    """suffix_tokens[k] = tokens of history[k:]"""
+    suffix_tokens = [0] * (len(history) + 1)
+    for i in range(len(history) - 1, -1, -1):
+        suffix_tokens[i] = suffix_tokens[i + 1] + history[i].get("tokens", message_tokens(history[i]))
+    return suffix_tokens
+
+
+def summary_cut(suffix_tokens):
+    """Index to summarise up to: keeps at most half the budget verbatim (and at least the newest message)"""
+    cut = len(suffix_tokens) - 2
+    while cut > 1 and suffix_tokens[cut - 1] <= CHAT_HISTORY_TOKEN_BUDGET // 2:
+        cut -= 1
+    return cut
+
+
+def summary_message(summary):
+    return {"role": "system", "content": f"先前對話摘要：\n{summary}"}
+
+
+def summarize_sent_history(history):
+    """
+    Fit a client-sent (clean_history()) history into CHAT_HISTORY_TOKEN_BUDGET:
+    the newest messages are kept verbatim; older ones are replaced by a rolling
+    summary cached per history prefix, so a client resending its whole history
+    every turn does not have it summarised from scratch every turn.
+    When a new summary is needed, the verbatim window is cut back to half the budget,
+    so the summary is extended every few turns rather than on every turn.
+    Returns (summary, verbatim messages); summary is "" when everything fits.
+    """
+    suffix_tokens = suffix_token_counts(history)
+    if suffix_tokens[0] <= CHAT_HISTORY_TOKEN_BUDGET or len(history) < 2:
+        return "", history
+
+    hashes = history_prefix_hashes(history)
+
+    # Reuse the longest verbatim window a cached summary allows
+    for k in range(1, len(history)):
+        if suffix_tokens[k] > CHAT_HISTORY_TOKEN_BUDGET:
+            continue
+        cached, state = history_summary_cache.lookup(hashes[k])
+        if state == "hit" and suffix_tokens[k] + count_tokens(cached) <= CHAT_HISTORY_TOKEN_BUDGET:
+            return cached, history[k:]
+
+    # Otherwise extend the newest cached summary before the new cut point
+    cut = summary_cut(suffix_tokens)
+    base, previous_summary = 0, ""
+    for k in range(cut - 1, 0, -1):
+        cached, state = history_summary_cache.lookup(hashes[k])
+        if state == "hit":
+            base, previous_summary = k, cached
+            break
+    try:
+        summary = summarize_history(previous_summary, history[base:cut])
+    except Exception as e:
+        app.logger.warning(f"History summary failed, dropping {cut} older message(s): {e}")
+        return "", history[cut:]
+    if not summary:
+        return "", history[cut:]
+    history_summary_cache.put(hashes[cut], summary)
+    app.logger.info(f"History summary extended to {cut} message(s) ({count_tokens(summary)} tokens)")
+    return summary, history[cut:]
+
+
+def dialogue_state(history):
+    """(conversation_rounds, last_user_message) of a conversation history"""
+    user_messages = [msg for msg in history if msg.get("role") == "user"]
+    return len(user_messages), (user_messages[-1].get("content", "") if user_messages else "")
+
+
+# =========================
+# Conversation sessions
+# =========================
+# A session holds what /api/chat needs from earlier turns, updated once per turn:
+#   history            - verbatim window, each message with its token count
+#   summary            - rolling summary of the messages before the window
+#   rounds             - user turns so far
+#   last_user_message  - the previous user message (drives the scaffolding level)
+CONVERSATION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+class MemoryConversationStore:
+    """In-process sessions (single worker); idle sessions expire after `ttl` seconds"""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # conversation_id -> (session, updated_at)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "writes": 0}
+
+    def get(self, conversation_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None and now - entry[1] >= self.ttl:
+                del self._entries[conversation_id]
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            return json.loads(entry[0])
+
+    def put(self, conversation_id, session):
+        # Stored serialised, like the SQLite backend, so callers never share a mutable session
+        value = json.dumps(session, ensure_ascii=False)
+        with self._lock:
+            self._entries[conversation_id] = (value, time.time())
+            self._entries.move_to_end(conversation_id)
+            self._stats["writes"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, backend="memory", sessions=len(self._entries))
+
+
+class SQLiteConversationStore:
+    """
+    Sessions in a SQLite file, shared by all workers on the host (CHAT_SESSION_BACKEND=sqlite).
+    One connection per thread; expired rows are purged every `purge_every` writes.
+    """
+
+    def __init__(self, path, ttl, purge_every=200):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "writes": 0}
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations "
+                "(id TEXT PRIMARY KEY, session TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+            return self._stats[name]
+
+    def get(self, conversation_id):
+        row = self._connect().execute(
+            "SELECT session, updated_at FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row is not None and time.time() - row[1] >= self.ttl:
+            self._count("expired")
+            row = None
+        if row is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return json.loads(row[0])
+
+    def put(self, conversation_id, session):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (id, session, updated_at) VALUES (?, ?, ?)",
+                (conversation_id, json.dumps(session, ensure_ascii=False), now),
+            )
+            if self._count("writes") % self.purge_every == 0:
+                conn.execute("DELETE FROM conversations WHERE updated_at < ?", (now - self.ttl,))
+
+    def stats(self):
+        stats = {"backend": "sqlite", "path": self.path}
+        with self._lock:
+            stats.update(self._stats)
+        try:
+            stats["sessions"] = self._connect().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        except sqlite3.Error as e:
+            stats["error"] = str(e)
+        return stats
+
+
+if CHAT_SESSION_BACKEND == "sqlite":
+    conversation_store = SQLiteConversationStore(CHAT_SESSION_DB, CHAT_SESSION_TTL)
+else:
+    conversation_store = MemoryConversationStore(CHAT_SESSION_TTL, max_entries=CHAT_SESSION_MAX_ENTRIES)
+
+
+def new_session(conversation_history=None):
+    """
+    Session seeded from a client-sent conversation_history (if any); a history over
+    the budget starts with its older part summarised (see summarize_sent_history())
+    """
+    history = clean_history(conversation_history)
+    rounds, last_user_message = dialogue_state(history)
+    summary, history = summarize_sent_history(history)
+    for msg in history:
+        msg["tokens"] = message_tokens(msg)
+    return {"history": history, "summary": summary, "rounds": rounds, "last_user_message": last_user_message}
+
+
+def open_chat_session(data):
+    """
+    (conversation_id, session) for an /api/chat or /api/analyze-document request.
+    A sent conversation_history (older clients, or re-seeding an expired session)
+    replaces the stored session. session is None when conversation_id is unknown
+    and no history was sent; the client should then resend with its history.
+    """
+    conversation_id = data.get("conversation_id")
+    if not isinstance(conversation_id, str) or not CONVERSATION_ID_RE.match(conversation_id):
+        conversation_id = None
+    history = data.get("conversation_history")
+    if isinstance(history, list):
+        return conversation_id or uuid.uuid4().hex, new_session(history)
+    if conversation_id is None:
+        return uuid.uuid4().hex, new_session()
+    return conversation_id, conversation_store.get(conversation_id)
+
+
+def session_history_messages(session):
+    """
+    History messages for the prompt, from the session's summary and window.
+    Fitted into CHAT_HISTORY_TOKEN_BUDGET; the summary is extended in place
+    when the window outgrows it, so per-turn work doesn't grow with the conversation.
+    """
+    history = session["history"]
+    suffix_tokens = suffix_token_counts(history)
+    if suffix_tokens[0] + count_tokens(session["summary"]) > CHAT_HISTORY_TOKEN_BUDGET and len(history) > 1:
+        cut = summary_cut(suffix_tokens)
+        try:
+            summary = summarize_history(session["summary"], history[:cut])
+            if summary:
+                session["summary"] = summary
+        except Exception as e:
+            app.logger.warning(f"History summary failed, dropping {cut} older message(s): {e}")
+        session["history"] = history = history[cut:]
+
+    messages = [summary_message(session["summary"])] if session["summary"] else []
+    return messages + [{"role": msg["role"], "content": msg["content"]} for msg in history]
+
+
+def record_session_turn(conversation_id, session, user_message, reply_text):
+    """Append a finished turn to the session and store it"""
+    if session is None:
+        return
+    for role, content in (("user", user_message), ("assistant", reply_text)):
+        if content:
+            msg = {"role": role, "content": truncate_to_tokens(content, CHAT_HISTORY_MESSAGE_TOKENS)}
+            msg["tokens"] = message_tokens(msg)
+            session["history"].append(msg)
+    session["rounds"] += 1
+    session["last_user_message"] = user_message
+    try:
+        conversation_store.put(conversation_id, session)
+    except Exception as e:
+        app.logger.warning(f"Could not store conversation {conversation_id}: {e}")
 
+
+def record_document_turn(conversation_id, filename, user_message, analysis_text):
+    """Add a document analysis to an existing chat session, so later chat turns can refer to it"""
+    if not isinstance(conversation_id, str) or not CONVERSATION_ID_RE.match(conversation_id):
+        return
+    session = conversation_store.get(conversation_id)
+    if session is not None:
+        record_session_turn(conversation_id, session, f"（上傳文件：{filename}）{user_message}", analysis_text)
+
+
+def conversation_not_found(conversation_id):
+    return {"error": "conversation_not_found", "conversation_id": conversation_id}
+
+
+def build_chat_messages(data, user_msg, session):
+    """
+    Build the LLM message list for /api/chat (system prompt with Socratic
+    scaffolding, recent history, current message).
+    History and dialogue state come from `session` (see open_chat_session()).
+    Returns (messages, conversation_history).
+    """
     # Optional context
     topic = (data.get("topic") or "").strip()
     grade = (data.get("grade") or "").strip()
@@ -1033,19 +3603,16 @@ def chat_general():
     user_wants_direct_answer = any(keyword in user_msg for keyword in explicit_direct_answer_keywords)
     
     # Get conversation history (if any)
-    conversation_history = data.get("conversation_history", [])
+    conversation_history = session["history"]
+    conversation_rounds = session["rounds"]  # Number of conversation rounds
+    last_user_msg = session["last_user_message"]
     last_user_response_length = 0
-    conversation_rounds = 0  # Number of conversation rounds
     user_has_provided_details = False  # Whether user has provided detailed information
     
     if conversation_history:
         # Count conversation rounds and user response detail level
-        user_messages = [msg for msg in conversation_history if msg.get("role") == "user"]
-        conversation_rounds = len(user_messages)
-        
         # Get last user response length and content
-        if user_messages:
-            last_user_msg = user_messages[-1].get("content", "")
+        if last_user_msg:
             last_user_response_length = len(last_user_msg)
             
             # Detect if user has provided sufficient detailed information
@@ -1144,130 +3711,360 @@ def chat_general():
     # Build conversation history (if any)
     messages = [{"role": "system", "content": system_msg}]
     
-    # Add conversation history (most recent 5 rounds, avoid too long)
-    if conversation_history:
-        recent_history = conversation_history[-5:]  # Only take most recent 5 rounds
-        for msg in recent_history:
-            role = msg.get("role")
-            content = msg.get("content", "")
-            if role in ["user", "assistant"] and content:
-                messages.append({"role": role, "content": content})
+    # Add conversation history, fitted into CHAT_HISTORY_TOKEN_BUDGET (older turns summarised)
+    messages.extend(session_history_messages(session))
+    # Snapshot after the window is cut: record_session_turn() later appends this turn to the live list
+    conversation_history = list(session["history"])
     
     # Add current user message
     messages.append({"role": "user", "content": context_block + user_msg})
 
+    return messages, conversation_history
+
+
+def finalize_chat_reply(content, user_msg):
+    """
+    Parse the model's JSON answer and repair it into the /api/chat shape:
+    {"chat_message_reply": {"text": "..."}, "actions": [...]}
+    """
+    # Robust parse + repair
     try:
-        msg = run_chat_with_optional_tools(
-            messages,
-            temperature=0.3,
-            max_tokens=3000,  # Increase token limit to support more detailed and complete responses
-            response_format=CHATBOT_SCHEMA,
-            tools=TOOLS,
-        )
+        obj = json.loads(content) if content else {}
+    except Exception:
+        obj = {}
 
-        content = msg.get("content", "{}")
+    # Ensure chat_message_reply exists (optional per spec, but we provide default for compatibility)
+    if "chat_message_reply" not in obj or not isinstance(obj["chat_message_reply"], dict):
+        obj["chat_message_reply"] = {"text": ""}
+    if "text" not in obj["chat_message_reply"]:
+        obj["chat_message_reply"]["text"] = ""
 
-        # Robust parse + repair
-        try:
-            obj = json.loads(content) if content else {}
-        except Exception:
-            obj = {}
+    # If response is empty, provide default response
+    if not obj["chat_message_reply"]["text"] or obj["chat_message_reply"]["text"].strip() == "":
+        # Provide default response based on user message
+        user_msg_lower = user_msg.lower()
+        if any(g in user_msg_lower for g in ["你好", "hello", "hi", "您好"]):
+            obj["chat_message_reply"]["text"] = "你好！我是學習設計助手，可以協助您進行課程規劃、教學設計、學習目標制定等。請告訴我您需要什麼幫助？"
+        elif any(k in user_msg_lower for k in ["教學設計", "課程設計", "設計", "如何"]):
+            obj["chat_message_reply"]["text"] = "關於教學設計，我可以協助您：\n1. 制定學習目標（ILO）\n2. 設計教學活動\n3. 規劃評量方式\n4. 應用 Bloom's Taxonomy\n\n請告訴我您具體想了解哪個方面？"
+        else:
+            obj["chat_message_reply"]["text"] = "我理解您的問題。作為學習設計助手，我可以協助您進行課程規劃、教學設計、學習目標制定等。請提供更多細節，我會盡力幫助您。"
 
-        # Ensure chat_message_reply exists (optional per spec, but we provide default for compatibility)
-        if "chat_message_reply" not in obj or not isinstance(obj["chat_message_reply"], dict):
-            obj["chat_message_reply"] = {"text": ""}
-        if "text" not in obj["chat_message_reply"]:
-            obj["chat_message_reply"]["text"] = ""
-        
-        # If response is empty, provide default response
-        if not obj["chat_message_reply"]["text"] or obj["chat_message_reply"]["text"].strip() == "":
-            # Provide default response based on user message
-            user_msg_lower = user_msg.lower()
-            if any(g in user_msg_lower for g in ["你好", "hello", "hi", "您好"]):
-                obj["chat_message_reply"]["text"] = "你好！我是學習設計助手，可以協助您進行課程規劃、教學設計、學習目標制定等。請告訴我您需要什麼幫助？"
-            elif any(k in user_msg_lower for k in ["教學設計", "課程設計", "設計", "如何"]):
-                obj["chat_message_reply"]["text"] = "關於教學設計，我可以協助您：\n1. 制定學習目標（ILO）\n2. 設計教學活動\n3. 規劃評量方式\n4. 應用 Bloom's Taxonomy\n\n請告訴我您具體想了解哪個方面？"
-            else:
-                obj["chat_message_reply"]["text"] = "我理解您的問題。作為學習設計助手，我可以協助您進行課程規劃、教學設計、學習目標制定等。請提供更多細節，我會盡力幫助您。"
-        
-        # Ensure actions exists (optional per spec, but we provide default empty array)
-        if "actions" not in obj or not isinstance(obj["actions"], list):
-            obj["actions"] = []
-        
-        # Generate suggested follow-up questions (using AI generation, not restricted by system prompt)
-        suggested_questions = generate_suggested_questions(
-            user_msg, 
-            obj["chat_message_reply"]["text"],
-            conversation_history
-        )
-        if suggested_questions:
-            obj["suggested_questions"] = suggested_questions
+    # Ensure actions exists (optional per spec, but we provide default empty array)
+    if "actions" not in obj or not isinstance(obj["actions"], list):
+        obj["actions"] = []
 
-        return jsonify(obj)
+    return obj
 
-    except Exception as e:
-        # Write detailed error to log, and return simplified error message in response for frontend debugging
-        app.logger.exception(e)
-        return jsonify({
-            "chat_message_reply": {
-                "text": f"伺服器錯誤（暫供除錯）：{str(e)}"
-            },
-            "actions": []
-        }), 500
 
+class ChatStreamTurn:
+    """
+    Calls and events of one streamed /api/chat turn, shared by stream_chat_events() and
+    its async version in asgi.py (which only await the calls):
+      - first call: tools and CHATBOT_SCHEMA together, like run_chat_single_pass();
+        tools only once the deployment is known to reject single-pass
+      - final call after tool calls: the tool results, in the first call's response_format
+        (CHATBOT_SCHEMA after a tools-only first call)
+    A rejected response_format is retried once with json_object; other errors are raised.
+    """
 
-@app.route("/api/suggest_dp", methods=["POST"])
-def suggest_dp():
-    data = request.json or {}
+    TEMPERATURE = 0.3
+    MAX_TOKENS = 3000
 
-    topic = data.get("topic") or "General Topic"
-    description = data.get("description") or "No description provided."
-    subject = data.get("subject") or "General Studies"
+    def __init__(self, messages, user_msg):
+        self.messages = messages
+        self.user_msg = user_msg
+        self.single_pass = deployment_capabilities.supports("single_pass")
+        if self.single_pass:
+            self.payload = single_pass_payload(messages, self.TEMPERATURE, self.MAX_TOKENS, CHATBOT_SCHEMA, TOOLS)
+        else:
+            self.payload = self._tools_only_payload()
+        self.final = False
+        self.extractor = ReplyTextExtractor()
+        self.tool_calls = []
+        self.sent_text = False
 
-    system_prompt = (
-        "Pick the single best Disciplinary Practice and explain briefly. "
-        "Use the provided definitions. Output must match the JSON schema."
-    )
+    def _tools_only_payload(self):
+        return {
+            "messages": self.messages,
+            "temperature": self.TEMPERATURE,
+            "max_tokens": self.MAX_TOKENS,
+            "tools": TOOLS,
+            "tool_choice": "auto",
+        }
 
-    user_prompt = f"""Definitions:
-{DP_DEFINITIONS}
+    def retry(self, error):
+        """After call_openai_stream(self.payload) failed: True to send self.payload (now adjusted) again"""
+        if "response_format" in self.payload and json_object_fallback(self.payload, error):
+            return True
+        if not self.final and self.single_pass and single_pass_rejected(error, TOOLS):
+            self.single_pass = False
+            self.payload = self._tools_only_payload()
+            return True
+        return False
 
-Course:
-Subject: {subject}
-Topic: {topic}
-Description: {description}
-""".strip()
+    def feed(self, kind, value):
+        """An item of the call_openai_stream() iterator; returns the "delta" event to send, if any"""
+        if kind == "tool_calls":
+            self.tool_calls = value
+            return None
+        delta = self.extractor.feed(value)
+        if not delta:
+            return None
+        self.sent_text = True
+        return sse_event("delta", {"text": delta})
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-    ]
+    def reset_event(self):
+        """Before the final call: a "reset" event withdrawing the text streamed so far, if any"""
+        if not self.sent_text:
+            return None
+        self.sent_text = False
+        return sse_event("reset", {})
 
-    schema = {
-        "type": "json_schema",
-        "json_schema": {
-            "name": "dp_recommendation",
-            "schema": {
-                "type": "object",
-                "additionalProperties": False,
-                "properties": {
-                    "recommended_dp": {"type": "string"},
-                    "reason": {"type": "string"}
-                },
-                "required": ["recommended_dp", "reason"]
-            }
-        }
-    }
+    def final_call(self, tool_messages):
+        """Switch to the final call, answering with the tool results"""
+        assistant_msg = {"role": "assistant", "content": self.extractor.content or None, "tool_calls": self.tool_calls}
+        self.payload = final_answer_payload(
+            dict(self.payload, response_format=self.payload.get("response_format") or CHATBOT_SCHEMA),
+            self.messages + [assistant_msg] + tool_messages,
+        )
+        self.final = True
+        self.extractor = ReplyTextExtractor()
+        self.tool_calls = []
+
+    def reply(self, conversation_id=None):
+        """The final reply object (sent as the "actions" event)"""
+        obj = finalize_chat_reply(self.extractor.json_content(), self.user_msg)
+        if conversation_id:
+            obj["conversation_id"] = conversation_id
+        return obj
+
+
+def chat_stream_error_event(e):
+    """The "error" event for an exception ending a streamed chat turn (logged here)"""
+    if isinstance(e, LLMOverloaded):
+        # Headers are already sent, so the 429/503 is reported in-band
+        app.logger.warning(f"Streamed chat not admitted: {e.reason} (retry after {e.retry_after}s)")
+        return sse_event("error", {
+            "error": f"AI 服務繁忙，請 {e.retry_after} 秒後再試",
+            "status": e.status,
+            "retry_after": e.retry_after,
+        })
+    app.logger.exception(e)
+    return sse_event("error", {"error": f"伺服器錯誤（暫供除錯）：{str(e)}"})
+
+
+def chat_stream_done_event(llm_calls, timing):
+    # Stages after the headers were sent can't go in the Server-Timing header
+    return sse_event("done", {
+        "llm_calls": llm_calls,
+        "server_timing": server_timing_header(timing) if timing else "",
+    })
+
+
+def open_chat_stream(turn):
+    """call_openai_stream(turn.payload), retried as ChatStreamTurn.retry() decides"""
+    while True:
+        try:
+            return call_openai_stream(turn.payload)
+        except LLMOverloaded:
+            raise
+        except Exception as e:
+            if not turn.retry(e):
+                raise
+
+
+def stream_chat_events(messages, user_msg, conversation_history, conversation_id=None, session=None):
+    """
+    SSE variant of /api/chat (calls as in ChatStreamTurn):
+      event: delta                data: {"text": "..."}        (repeated, reply text as it is generated)
+      event: reset                data: {}                     (the model called a tool: discard the
+                                                                text received so far, the final answer follows)
+      event: actions              data: {"chat_message_reply": {...}, "actions": [...], "conversation_id": "..."}
+      event: suggested_questions  data: {"suggested_questions": [...]}
+      event: done                 data: {"llm_calls": n, "server_timing": "..."}
+    The deltas after the last reset add up to the text in "actions".
+    Errors are reported as an "error" event followed by "done".
+    """
+    try:
+        turn = ChatStreamTurn(messages, user_msg)
+        stream = open_chat_stream(turn)
+        with stage("llm_stream"):
+            for kind, value in stream:
+                event = turn.feed(kind, value)
+                if event:
+                    yield event
+
+        if turn.tool_calls:
+            reset = turn.reset_event()
+            if reset:
+                yield reset
+            turn.final_call(execute_tool_calls(turn.tool_calls))
+            stream = open_chat_stream(turn)
+            with stage("llm_stream_stage2"):
+                for kind, value in stream:
+                    event = turn.feed(kind, value)
+                    if event:
+                        yield event
+
+        obj = turn.reply(conversation_id)
+        record_session_turn(conversation_id, session, user_msg, obj["chat_message_reply"]["text"])
+        yield sse_event("actions", obj)
+
+        suggested_questions = generate_suggested_questions(
+            user_msg,
+            obj["chat_message_reply"]["text"],
+            conversation_history
+        )
+        if suggested_questions:
+            yield sse_event("suggested_questions", {"suggested_questions": suggested_questions})
+    except Exception as e:
+        yield chat_stream_error_event(e)
+    yield chat_stream_done_event(g.get("llm_calls", 0), current_request_timing())
+
+
+@app.route("/api/chat", methods=["POST", "OPTIONS"])
+def chat_general():
+    """
+    Returns:
+    {
+      "chat_message_reply": {"text": "..."},
+      "actions": [...],
+      "conversation_id": "..."
+    }
+    Send conversation_id back on later turns instead of conversation_history; the
+    server keeps the history (409 conversation_not_found: resend with the history).
+    With {"stream": true} (or Accept: text/event-stream) the reply is streamed
+    as Server-Sent Events instead, see stream_chat_events().
+    """
+    if request.method == "OPTIONS":
+        return ("", 204)
+
+    data = request.json or {}
+    user_msg = (data.get("message") or "").strip()
+    stream = wants_event_stream(data, request.headers.get("Accept", ""))
+    
+    # If it's a BOT-suggested question, skip scope check and accept directly
+    is_suggested_question = data.get("is_suggested_question", False)
+    
+    if not is_suggested_question and not is_in_scope(user_msg):
+        refusal = {"chat_message_reply": {"text": REFUSAL_TEXT}, "actions": []}
+        if stream:
+            return sse_response(iter([
+                sse_event("delta", {"text": REFUSAL_TEXT}),
+                sse_event("actions", refusal),
+                sse_event("done", {}),
+            ]))
+        return jsonify(refusal)
+
+    conversation_id, session = open_chat_session(data)
+    tag_conversation(conversation_id)
+    if session is None:
+        return jsonify(conversation_not_found(conversation_id)), 409
+
+    messages, conversation_history = build_chat_messages(data, user_msg, session)
+
+    if stream:
+        return sse_response(stream_chat_events(messages, user_msg, conversation_history, conversation_id, session))
+
+    try:
+        msg = run_chat_with_optional_tools(
+            messages,
+            temperature=0.3,
+            max_tokens=3000,  # Increase token limit to support more detailed and complete responses
+            response_format=CHATBOT_SCHEMA,
+            tools=TOOLS,
+        )
+
+        obj = finalize_chat_reply(msg.get("content", "{}"), user_msg)
+        record_session_turn(conversation_id, session, user_msg, obj["chat_message_reply"]["text"])
+        obj["conversation_id"] = conversation_id
+
+        # Generate suggested follow-up questions (using AI generation, not restricted by system prompt)
+        suggested_questions = generate_suggested_questions(
+            user_msg, 
+            obj["chat_message_reply"]["text"],
+            conversation_history
+        )
+        if suggested_questions:
+            obj["suggested_questions"] = suggested_questions
+
+        return jsonify(obj)
+
+    except LLMOverloaded:
+        raise
+    except Exception as e:
+        # Write detailed error to log, and return simplified error message in response for frontend debugging
+        app.logger.exception(e)
+        return jsonify({
+            "chat_message_reply": {
+                "text": f"伺服器錯誤（暫供除錯）：{str(e)}"
+            },
+            "actions": []
+        }), 500
+
+
+DP_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "dp_recommendation",
+        "schema": {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {
+                "recommended_dp": {"type": "string"},
+                "reason": {"type": "string"}
+            },
+            "required": ["recommended_dp", "reason"]
+        }
+    }
+}
+
+
+def build_dp_messages(data):
+    """Prompt messages for recommend_dp()"""
+    topic = data.get("topic") or "General Topic"
+    description = data.get("description") or "No description provided."
+    subject = data.get("subject") or "General Studies"
+
+    system_prompt = (
+        "Pick the single best Disciplinary Practice and explain briefly. "
+        "Use the provided definitions. Output must match the JSON schema."
+    )
+
+    user_prompt = f"""Definitions:
+{DP_DEFINITIONS}
+
+Course:
+Subject: {subject}
+Topic: {topic}
+Description: {description}
+""".strip()
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+def recommend_dp(data):
+    """
+    Recommend a Disciplinary Practice for one course (the /api/suggest_dp body).
+    Returns (payload, status): {"recommended_dp", "reason"} with 200, or an error object with 500.
+    """
+    messages = build_dp_messages(data)
 
     try:
         msg = run_chat_with_optional_tools(
             messages,
             temperature=0.1,
             max_tokens=180,
-            response_format=schema,
+            response_format=DP_SCHEMA,
             tools=None
         )
-        return jsonify(json.loads(msg.get("content", "{}")))
+        return json.loads(msg.get("content", "{}")), 200
+    except LLMOverloaded:
+        raise
     except Exception:
         try:
             msg = run_chat_with_optional_tools(
@@ -1277,23 +4074,92 @@ Description: {description}
                 response_format={"type": "json_object"},
                 tools=None
             )
-            return jsonify(json.loads(msg.get("content", "{}")))
+            return json.loads(msg.get("content", "{}")), 200
+        except LLMOverloaded:
+            raise
         except Exception as e2:
             app.logger.exception(e2)
-            return jsonify({"error": str(e2)}), 500
+            return {"error": str(e2)}, 500
 
 
-@app.route("/api/generate_ilos", methods=["POST"])
-def generate_ilos():
+@app.route("/api/suggest_dp", methods=["POST"])
+def suggest_dp():
     data = request.json or {}
 
-    topic = data.get("topic", "N/A")
-    description = data.get("description", "")
-    subject = data.get("subject", "")
-    grade = data.get("grade", "Secondary School")
-    bloom_level = data.get("bloom_level", "Understand")
-    action_verb = (data.get("action_verb") or "").strip()
-    disciplinary_practice = data.get("disciplinary_practice", "General Inquiry")
+    payload, status = recommend_dp(data)
+    return jsonify(payload), status
+
+
+ilo_result_cache = TTLCache(ILO_CACHE_TTL, max_entries=ILO_CACHE_SIZE)
+
+# Inputs generate_ilo_statements() depends on, with their defaults (see normalise_ilo_inputs())
+ILO_CACHE_FIELDS = {
+    "topic": "N/A",
+    "description": "",
+    "subject": "",
+    "grade": "Secondary School",
+    "bloom_level": "Understand",
+    "action_verb": "",
+    "disciplinary_practice": "General Inquiry",
+}
+
+
+def normalise_ilo_inputs(data):
+    """
+    ILO inputs with defaults for missing or empty fields, stripped, and runs of
+    spaces within a line collapsed (line breaks are kept for the prompt).
+    The prompts are built from this, so equal cache keys always mean equal prompts.
+    """
+    return {
+        field: "\n".join(" ".join(line.split()) for line in str(data.get(field) or default).strip().splitlines())
+        for field, default in ILO_CACHE_FIELDS.items()
+    }
+
+
+def ilo_cache_key(data):
+    """Hash of the normalised ILO inputs plus deployment and prompt version"""
+    normalised = normalise_ilo_inputs(data)
+    normalised["_deployment"] = DEPLOYMENT_ID
+    normalised["_prompt_version"] = ILO_PROMPT_VERSION
+    return hashlib.sha256(canonical_json(normalised).encode("utf-8")).hexdigest()
+
+
+ILO_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "ilos",
+        "schema": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "statement": {"type": "string"}
+                },
+                "required": ["statement"]
+            },
+            "minItems": 3,
+            "maxItems": 3
+        }
+    }
+}
+
+ILO_CONTENT_FILTER_ERROR = {
+    "error": "內容過濾錯誤：請嘗試修改輸入內容或稍後再試",
+    "details": "Azure OpenAI 的內容過濾系統阻止了此請求。請確保輸入內容符合教育用途規範。"
+}
+
+
+def build_ilo_messages(data):
+    """Prompt messages for generate_ilo_statements()"""
+    data = normalise_ilo_inputs(data)
+    topic = data["topic"]
+    description = data["description"]
+    subject = data["subject"]
+    grade = data["grade"]
+    bloom_level = data["bloom_level"]
+    action_verb = data["action_verb"]
+    disciplinary_practice = data["disciplinary_practice"]
 
     system_prompt = (
         "You are an educational consultant helping teachers create Intended Learning Outcomes (ILOs). "
@@ -1328,118 +4194,124 @@ Please ensure each ILO:
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
     ]
+    return messages
 
-    schema = {
-        "type": "json_schema",
-        "json_schema": {
-            "name": "ilos",
-            "schema": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "additionalProperties": False,
-                    "properties": {
-                        "statement": {"type": "string"}
-                    },
-                    "required": ["statement"]
-                },
-                "minItems": 3,
-                "maxItems": 3
-            }
-        }
-    }
+
+def build_safe_ilo_messages(data):
+    """Simpler, safer prompt used when the main ILO prompt trips the content filter"""
+    data = normalise_ilo_inputs(data)
+    topic = data["topic"]
+    subject = data["subject"]
+    grade = data["grade"]
+    bloom_level = data["bloom_level"]
+    action_verb = data["action_verb"]
+
+    safe_system_prompt = (
+        "You are an educational consultant helping teachers create learning outcomes. "
+        "Please create 3 clear and measurable learning outcomes based on the provided educational context."
+    )
+    safe_user_prompt = f"""Create 3 learning outcomes for:
+Topic: {topic}
+Subject: {subject}
+Grade: {grade}
+Bloom's Taxonomy Level: {bloom_level}
+{f'Action Verb: {action_verb}' if action_verb else ''}
+
+Please format as JSON array with 3 objects, each with a 'statement' field."""
+
+    return [
+        {"role": "system", "content": safe_system_prompt},
+        {"role": "user", "content": safe_user_prompt}
+    ]
+
+
+def validate_ilo_items(items):
+    """Keep the items that carry a statement, normalised to {"statement": ...}"""
+    validated_ilos = []
+    for ilo in items:
+        if isinstance(ilo, dict):
+            statement = ilo.get("statement") or ilo.get("text") or ilo.get("content") or ""
+            if statement:
+                validated_ilos.append({"statement": statement})
+        elif isinstance(ilo, str):
+            validated_ilos.append({"statement": ilo})
+    return validated_ilos
+
+
+def parse_ilo_content(content):
+    """
+    Parse the model's answer into validated ILOs. Accepts a JSON array, or an object
+    wrapping one under "ilos", "ILOs", "data", "results" or "statements".
+    Returns (validated_ilos, ilos_data); validated_ilos is empty when nothing usable was found.
+    """
+    try:
+        ilos_data = json.loads(content) if content else []
+    except json.JSONDecodeError as e:
+        app.logger.error(f"Failed to parse ILO JSON: {e}, content: {content[:500]}")
+        ilos_data = []
+
+    if isinstance(ilos_data, dict):
+        # Try to extract array from object (support multiple key names, including case variants)
+        for key in ["ilos", "ILOs", "data", "results", "statements"]:
+            if isinstance(ilos_data.get(key), list):
+                return validate_ilo_items(ilos_data[key]), ilos_data
+        return [], ilos_data
+    if isinstance(ilos_data, list):
+        return validate_ilo_items(ilos_data), ilos_data
+    return [], ilos_data
+
+
+def ilo_parse_error(ilos_data):
+    """Error payload when parse_ilo_content() found no usable ILOs"""
+    if isinstance(ilos_data, list):
+        app.logger.warning("No valid ILOs found in list")
+        return {"error": "No valid ILOs generated", "raw": ilos_data}
+    app.logger.warning(f"ILO data is not a list: {type(ilos_data)}, data: {ilos_data}")
+    return {"error": "Invalid response format", "data": ilos_data}
+
+
+def is_content_filter_error(error_str):
+    return "content_filter" in error_str or "content management policy" in error_str or "ResponsibleAIPolicyViolation" in error_str
+
+
+def generate_ilo_statements(data):
+    """
+    Generate 3 ILOs for one educational context (the /api/generate_ilos body).
+    Returns (payload, status): the validated [{"statement": ...}] list with 200,
+    or an error object with an HTTP error status.
+    """
+    messages = build_ilo_messages(data)
 
     try:
         msg = run_chat_with_optional_tools(
             messages,
             temperature=0.2,
             max_tokens=320,
-            response_format=schema,
+            response_format=ILO_SCHEMA,
             tools=None
         )
         content = msg.get("content", "[]")
         app.logger.info(f"ILO generation response content: {content[:200]}")
         
-        try:
-            ilos_data = json.loads(content) if content else []
-        except json.JSONDecodeError as e:
-            app.logger.error(f"Failed to parse ILO JSON: {e}, content: {content[:500]}")
-            ilos_data = []
-        
-        # Ensure returned data is an array
-        if isinstance(ilos_data, list):
-            # Validate that each element in array has statement field
-            validated_ilos = []
-            for ilo in ilos_data:
-                if isinstance(ilo, dict):
-                    statement = ilo.get("statement") or ilo.get("text") or ilo.get("content") or ""
-                    if statement:
-                        validated_ilos.append({"statement": statement})
-                elif isinstance(ilo, str):
-                    validated_ilos.append({"statement": ilo})
-            
-            if validated_ilos:
-                app.logger.info(f"Successfully generated {len(validated_ilos)} ILOs")
-                return jsonify(validated_ilos)
-            else:
-                app.logger.warning("No valid ILOs found in list")
-                return jsonify({"error": "No valid ILOs generated", "raw": ilos_data}), 500
-        elif isinstance(ilos_data, dict):
-            # Try to extract array from object (support multiple key names, including case variants)
-            ilos_list = None
-            for key in ["ilos", "ILOs", "data", "results", "statements"]:
-                if key in ilos_data:
-                    ilos_list = ilos_data[key]
-                    break
-            
-            if isinstance(ilos_list, list) and ilos_list:
-                validated_ilos = []
-                for ilo in ilos_list:
-                    if isinstance(ilo, dict):
-                        statement = ilo.get("statement") or ilo.get("text") or ilo.get("content") or ""
-                        if statement:
-                            validated_ilos.append({"statement": statement})
-                    elif isinstance(ilo, str):
-                        validated_ilos.append({"statement": ilo})
-                
-                if validated_ilos:
-                    app.logger.info(f"Successfully extracted {len(validated_ilos)} ILOs from object")
-                    return jsonify(validated_ilos)
-            
-            app.logger.warning(f"ILO data is not a list: {type(ilos_data)}, data: {ilos_data}")
-            return jsonify({"error": "Invalid response format", "data": ilos_data}), 500
-        else:
-            app.logger.warning(f"ILO data is not a list or dict: {type(ilos_data)}, data: {ilos_data}")
-            return jsonify({"error": "Invalid response format", "data": ilos_data}), 500
-            
+        validated_ilos, ilos_data = parse_ilo_content(content)
+        if validated_ilos:
+            app.logger.info(f"Successfully generated {len(validated_ilos)} ILOs")
+            return validated_ilos, 200
+        return ilo_parse_error(ilos_data), 500
+
+    except LLMOverloaded:
+        raise
     except Exception as e1:
         error_str = str(e1)
         app.logger.exception(e1)
         
         # Check if it's a content filter error
-        if "content_filter" in error_str or "content management policy" in error_str or "ResponsibleAIPolicyViolation" in error_str:
+        if is_content_filter_error(error_str):
             app.logger.error("Content filter triggered. Attempting with modified prompt...")
             # Retry with simpler and safer prompt
-            safe_system_prompt = (
-                "You are an educational consultant helping teachers create learning outcomes. "
-                "Please create 3 clear and measurable learning outcomes based on the provided educational context."
-            )
-            safe_user_prompt = f"""Create 3 learning outcomes for:
-Topic: {topic}
-Subject: {subject}
-Grade: {grade}
-Bloom's Taxonomy Level: {bloom_level}
-{f'Action Verb: {action_verb}' if action_verb else ''}
-
-Please format as JSON array with 3 objects, each with a 'statement' field."""
-            
             try:
-                safe_messages = [
-                    {"role": "system", "content": safe_system_prompt},
-                    {"role": "user", "content": safe_user_prompt}
-                ]
                 msg = run_chat_with_optional_tools(
-                    safe_messages,
+                    build_safe_ilo_messages(data),
                     temperature=0.2,
                     max_tokens=320,
                     response_format={"type": "json_object"},
@@ -1448,43 +4320,19 @@ Please format as JSON array with 3 objects, each with a 'statement' field."""
                 content = msg.get("content", "{}")
                 app.logger.info(f"Safe prompt ILO generation response content: {content[:200]}")
                 
-                # Process retry result
-                try:
-                    ilos_data = json.loads(content) if content else []
-                    # If returned is an object, try to extract array
-                    if isinstance(ilos_data, dict):
-                        # Try to extract array from common keys
-                        ilos_data = ilos_data.get("ilos", ilos_data.get("data", ilos_data.get("statements", [])))
-                    
-                    if isinstance(ilos_data, list):
-                        validated_ilos = []
-                        for ilo in ilos_data:
-                            if isinstance(ilo, dict):
-                                statement = ilo.get("statement") or ilo.get("text") or ilo.get("content") or ""
-                                if statement:
-                                    validated_ilos.append({"statement": statement})
-                            elif isinstance(ilo, str):
-                                validated_ilos.append({"statement": ilo})
-                        
-                        if validated_ilos:
-                            app.logger.info(f"Successfully generated {len(validated_ilos)} ILOs (safe prompt)")
-                            return jsonify(validated_ilos)
-                
-                except json.JSONDecodeError as e3:
-                    app.logger.error(f"Failed to parse safe prompt ILO JSON: {e3}, content: {content[:500]}")
+                validated_ilos, _ = parse_ilo_content(content)
+                if validated_ilos:
+                    app.logger.info(f"Successfully generated {len(validated_ilos)} ILOs (safe prompt)")
+                    return validated_ilos, 200
                 
                 # If retry still fails, return error
-                return jsonify({
-                    "error": "內容過濾錯誤：請嘗試修改輸入內容或稍後再試",
-                    "details": "Azure OpenAI 的內容過濾系統阻止了此請求。請確保輸入內容符合教育用途規範。"
-                }), 400
-                
+                return dict(ILO_CONTENT_FILTER_ERROR), 400
+
+            except LLMOverloaded:
+                raise
             except Exception as e2:
                 app.logger.exception(e2)
-                return jsonify({
-                    "error": "內容過濾錯誤：請嘗試修改輸入內容或稍後再試",
-                    "details": "Azure OpenAI 的內容過濾系統阻止了此請求。請確保輸入內容符合教育用途規範。"
-                }), 400
+                return dict(ILO_CONTENT_FILTER_ERROR), 400
         
         try:
             msg = run_chat_with_optional_tools(
@@ -1497,101 +4345,442 @@ Please format as JSON array with 3 objects, each with a 'statement' field."""
             content = msg.get("content", "{}")
             app.logger.info(f"Fallback ILO generation response content: {content[:200]}")
             
-            try:
-                ilos_data = json.loads(content) if content else []
-                # 如果返回的是對象，嘗試提取數組
-                if isinstance(ilos_data, dict):
-                    # 嘗試從常見的鍵中提取數組
-                    ilos_data = ilos_data.get("ilos", ilos_data.get("data", []))
-                
-                if isinstance(ilos_data, list):
-                    validated_ilos = []
-                    for ilo in ilos_data:
-                        if isinstance(ilo, dict):
-                            statement = ilo.get("statement") or ilo.get("text") or ilo.get("content") or ""
-                            if statement:
-                                validated_ilos.append({"statement": statement})
-                        elif isinstance(ilo, str):
-                            validated_ilos.append({"statement": ilo})
-                    
-                    if validated_ilos:
-                        app.logger.info(f"Successfully generated {len(validated_ilos)} ILOs (fallback)")
-                        return jsonify(validated_ilos)
-                    else:
-                        app.logger.warning("No valid ILOs found in fallback list")
-                        return jsonify({"error": "No valid ILOs generated", "raw": ilos_data}), 500
-                elif isinstance(ilos_data, dict):
-                    # Try to extract array from object (support multiple key names, including case variants)
-                    ilos_list = None
-                    for key in ["ilos", "ILOs", "data", "results", "statements"]:
-                        if key in ilos_data:
-                            ilos_list = ilos_data[key]
-                            break
-                    
-                    if isinstance(ilos_list, list) and ilos_list:
-                        validated_ilos = []
-                        for ilo in ilos_list:
-                            if isinstance(ilo, dict):
-                                statement = ilo.get("statement") or ilo.get("text") or ilo.get("content") or ""
-                                if statement:
-                                    validated_ilos.append({"statement": statement})
-                            elif isinstance(ilo, str):
-                                validated_ilos.append({"statement": ilo})
-                        
-                        if validated_ilos:
-                            app.logger.info(f"Successfully extracted {len(validated_ilos)} ILOs from fallback object")
-                            return jsonify(validated_ilos)
-                
-                app.logger.warning(f"Fallback ILO data is not a list: {type(ilos_data)}")
-                return jsonify({"error": "Invalid response format", "data": ilos_data}), 500
-            except json.JSONDecodeError as e:
-                app.logger.error(f"Failed to parse fallback ILO JSON: {e}")
-                return jsonify({"error": f"Failed to parse response: {str(e)}"}), 500
-                
+            validated_ilos, ilos_data = parse_ilo_content(content)
+            if validated_ilos:
+                app.logger.info(f"Successfully generated {len(validated_ilos)} ILOs (fallback)")
+                return validated_ilos, 200
+            return ilo_parse_error(ilos_data), 500
+
+        except LLMOverloaded:
+            raise
         except Exception as e2:
             app.logger.exception(e2)
-            return jsonify({"error": str(e2)}), 500
+            return {"error": str(e2)}, 500
 
 
-def extract_text_from_file(file, filename):
+def generate_ilos_cached(data):
     """
-    Extract text content from uploaded file
-    Supports PDF, DOCX, TXT formats
+    generate_ilo_statements() behind ilo_result_cache.
+    Pass {"fresh": true} to bypass the cache (the new result still replaces the cached one).
+    Returns (payload, status, cache_hit).
     """
-    file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-    
-    if file_ext == 'pdf':
-        if not PDF_AVAILABLE:
-            return None, "PDF 解析庫未安裝。請運行以下命令安裝：pip install PyPDF2"
-        try:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            return text, None
-        except Exception as e:
-            return None, f"PDF 解析錯誤: {str(e)}"
-    
-    elif file_ext in ['doc', 'docx']:
-        if not DOCX_AVAILABLE:
-            return None, "DOCX 解析庫未安裝。請運行以下命令安裝：pip install python-docx"
-        try:
-            doc = Document(file)
-            text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-            return text, None
-        except Exception as e:
-            return None, f"DOCX 解析錯誤: {str(e)}"
-    
-    elif file_ext == 'txt':
+    key = ilo_cache_key(data)
+    if not data.get("fresh"):
+        cached, state = ilo_result_cache.lookup(key)
+        if state == "hit":
+            return cached, 200, True
+
+    payload, status = generate_ilo_statements(data)
+    if status == 200:
+        ilo_result_cache.put(key, payload)
+    return payload, status, False
+
+
+@app.route("/api/generate_ilos", methods=["POST"])
+def generate_ilos():
+    data = request.json or {}
+
+    payload, status, cache_hit = generate_ilos_cached(data)
+    resp = jsonify(payload)
+    resp.status_code = status
+    resp.headers["X-Cache"] = "HIT" if cache_hit else "MISS"
+    return resp
+
+
+def parse_ilo_batch(data):
+    """Returns (items, error) for a /api/generate_ilos/batch body {"items": [context, ...]}"""
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return None, "items must be a non-empty list of ILO contexts"
+    if len(items) > ILO_BATCH_MAX_ITEMS:
+        return None, f"At most {ILO_BATCH_MAX_ITEMS} items per batch"
+    return items, None
+
+
+def ilo_batch_line(index, item, payload, status, cache_hit):
+    """
+    One NDJSON result: what /api/generate_ilos would return for the item, tagged with
+    its index (and "id" if the item had one), status and cache flag.
+    Success carries "ilos"; failure carries the error payload's fields.
+    """
+    line = {"index": index, "status": status, "cache_hit": cache_hit}
+    if isinstance(item, dict) and "id" in item:
+        line["id"] = item["id"]
+    if status == 200:
+        line["ilos"] = payload
+    else:
+        line.update(payload)
+    return line
+
+
+def generate_ilo_batch_item(index, item):
+    if not isinstance(item, dict):
+        return ilo_batch_line(index, item, {"error": "Each item must be an object"}, 400, False)
+    try:
+        payload, status, cache_hit = generate_ilos_cached(item)
+    except LLMOverloaded as e:
+        payload, status, cache_hit = {
+            "error": f"AI 服務繁忙，請 {e.retry_after} 秒後再試",
+            "retry_after": e.retry_after,
+        }, e.status, False
+    except Exception as e:
+        app.logger.exception(e)
+        payload, status, cache_hit = {"error": str(e)}, 500, False
+    return ilo_batch_line(index, item, payload, status, cache_hit)
+
+
+def ilo_batch_summary(lines):
+    return {
+        "done": True,
+        "count": len(lines),
+        "errors": sum(1 for line in lines if line["status"] != 200),
+        "cache_hits": sum(1 for line in lines if line["cache_hit"]),
+    }
+
+
+def ndjson_line(obj):
+    return json.dumps(obj, ensure_ascii=False) + "\n"
+
+
+def ndjson_response(lines):
+    return Response(
+        stream_with_context(lines),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def generate_ilo_batch_lines(items):
+    """Results in completion order, at most ILO_BATCH_CONCURRENCY generating at once, then a summary line"""
+    executor = ThreadPoolExecutor(max_workers=max(1, min(ILO_BATCH_CONCURRENCY, len(items))))
+    try:
+        futures = [executor.submit(bind_request_timing(generate_ilo_batch_item), index, item) for index, item in enumerate(items)]
+        lines = []
+        for future in as_completed(futures):
+            lines.append(future.result())
+            yield ndjson_line(lines[-1])
+        yield ndjson_line(ilo_batch_summary(lines))
+    finally:
+        # Client gone: drop the items that have not started
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.route("/api/generate_ilos/batch", methods=["POST"])
+def generate_ilos_batch():
+    """
+    ILOs for several contexts (e.g. every lesson of a unit) in one request.
+    Body: {"items": [<generate_ilos body>, ...]}; streams one JSON line per item as it
+    finishes (see ilo_batch_line), then {"done": true, ...}.
+    """
+    data = request.json or {}
+    items, error = parse_ilo_batch(data)
+    if error:
+        return jsonify({"error": error}), 400
+    return ndjson_response(generate_ilo_batch_lines(items))
+
+
+# =========================
+# Document uploads
+# =========================
+class SpooledUploadRequest(Flask.request_class):
+    """
+    Request whose file uploads are written to named temp files as they arrive, so
+    parser processes can map them by path; the files are removed when the request ends.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_MEMORY_KB * 1024:
+            return io.BytesIO()
+        stream = tempfile.NamedTemporaryFile("w+b", prefix="lds-upload-", dir=UPLOAD_SPOOL_DIR, delete=False)
+        self.__dict__.setdefault("spooled_paths", []).append(stream.name)
+        return stream
+
+    def close(self):
+        super().close()
+        for path in self.__dict__.pop("spooled_paths", ()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+app.request_class = SpooledUploadRequest
+# Room for the form fields sent alongside the file
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES + 64 * 1024
+UPLOAD_TOO_LARGE_ERROR = f"文件過大，上限為 {UPLOAD_MAX_MB:g} MB"
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({"error": UPLOAD_TOO_LARGE_ERROR}), 413
+
+
+document_parser_pool = document_parser.DocumentParserPool(
+    workers=DOCUMENT_PARSE_WORKERS,
+    timeout=DOCUMENT_PARSE_TIMEOUT,
+    memory_mb=DOCUMENT_PARSE_MEMORY_MB,
+    spool_dir=UPLOAD_SPOOL_DIR,
+)
+atexit.register(document_parser_pool.shutdown)
+
+extracted_text_cache = None
+if DOCUMENT_CACHE_MAX_MB > 0:
+    try:
+        extracted_text_cache = document_parser.ExtractedTextCache(DOCUMENT_CACHE_DB, DOCUMENT_CACHE_MAX_MB * 1024 * 1024)
+    except Exception as e:
+        print(f"Warning: Extracted text cache disabled: {e}")
+
+
+def extract_text_from_file(file, filename, max_chars=None):
+    """
+    Extract text content from uploaded file (PDF, DOCX, TXT) in a parser process,
+    reading at most about `max_chars` characters (default DOCUMENT_TEXT_BUDGET).
+    The same bytes uploaded again are served from extracted_text_cache without parsing.
+    Returns (text, error); see document_parser.extract_text().
+    """
+    max_chars = DOCUMENT_TEXT_BUDGET if max_chars is None else max_chars
+    if extracted_text_cache is None:
+        with stage("document_extract"):
+            return document_parser_pool.extract(file, filename, max_chars)
+
+    key = extracted_text_cache.key(file, filename, max_chars)
+    try:
+        text = extracted_text_cache.get(key)
+    except Exception as e:
+        app.logger.warning(f"Extracted text cache read failed: {e}")
+        text = None
+    if text is not None:
+        app.logger.info(f"Extracted text cache hit: {filename}")
+        return text, None
+
+    with stage("document_extract"):
+        text, error = document_parser_pool.extract(file, filename, max_chars)
+    if error is None:
         try:
-            file.seek(0)
-            text = file.read().decode('utf-8', errors='ignore')
-            return text, None
+            extracted_text_cache.put(key, text)
         except Exception as e:
-            return None, f"TXT 讀取錯誤: {str(e)}"
+            app.logger.warning(f"Extracted text cache write failed: {e}")
+    return text, error
+
+
+DOCUMENT_ANALYSIS_SYSTEM_PROMPT = (
+    "你是一位教育設計專家。請仔細分析用戶提供的教學文件，"
+    "並提供專業的改進建議。重點關注：\n"
+    "1. 學習目標（ILO）的清晰度和可測量性\n"
+    "2. 教學活動的設計是否有效\n"
+    "3. 評量方式是否與學習目標對齊\n"
+    "4. 是否符合 Bloom's Taxonomy\n"
+    "5. 整體教學設計的優缺點\n\n"
+    "請用中文回答，提供具體、可操作的建議。"
+)
+
+
+def document_context_block(subject="", grade="", topic=""):
+    context_parts = []
+    if subject:
+        context_parts.append(f"科目：{subject}")
+    if grade:
+        context_parts.append(f"年級：{grade}")
+    if topic:
+        context_parts.append(f"課題：{topic}")
+    return "\n".join(context_parts) + "\n\n" if context_parts else ""
+
+
+def build_document_analysis_messages(text_content, filename, user_message="", subject="", grade="", topic=""):
+    """Prompt messages for /api/analyze-document from the extracted document text"""
+    # Limit file content length (avoid exceeding token limit)
+    max_length = DOCUMENT_TEXT_BUDGET
+    if len(text_content) > max_length:
+        text_content = text_content[:max_length] + "\n\n...（內容已截斷）"
+
+    # Build analysis prompt
+    context_block = document_context_block(subject, grade, topic)
+
+    user_prompt = user_message if user_message else "請分析這個教學文件並提供改進建議"
     
-    else:
-        return None, f"不支援的文件格式: {file_ext}"
+    system_prompt = DOCUMENT_ANALYSIS_SYSTEM_PROMPT
+
+    full_user_content = f"""{context_block}文件名稱：{filename}
+
+文件內容：
+{text_content}
+
+用戶問題：{user_prompt}
+""".strip()
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": full_user_content}
+    ]
+    return messages
+
+
+# =========================
+# Long documents (map-reduce analysis)
+# =========================
+# Partial findings per chunk, keyed by chunk content (the map prompt doesn't depend on the request)
+document_chunk_cache = TTLCache(DOCUMENT_CHUNK_CACHE_TTL, max_entries=DOCUMENT_CHUNK_CACHE_SIZE)
+
+
+def document_extract_limit():
+    """How much text to extract from an upload: enough for map-reduce when it is enabled"""
+    return max(DOCUMENT_MAX_CHARS, DOCUMENT_TEXT_BUDGET)
+
+
+def is_long_document(text_content):
+    return DOCUMENT_MAX_CHARS > DOCUMENT_TEXT_BUDGET and len(text_content) > DOCUMENT_TEXT_BUDGET
+
+
+def split_document_chunks(text, chunk_tokens):
+    """Split text into chunks of about `chunk_tokens` tokens, on line boundaries where possible"""
+    chunks = []
+    current, current_tokens = [], 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+        if line_tokens > chunk_tokens:
+            # A single oversized paragraph is split by characters
+            step = max(1, len(line) * chunk_tokens // line_tokens)
+            pieces = [line[i:i + step] for i in range(0, len(line), step)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_tokens = line_tokens if len(pieces) == 1 else count_tokens(piece)
+            if current and current_tokens + piece_tokens > chunk_tokens:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def document_chunks(text):
+    """
+    Chunks of a long document: DOCUMENT_CHUNK_TOKENS each, grown as needed so there are
+    at most DOCUMENT_MAX_CHUNKS (the number of map calls stays bounded however long it is)
+    """
+    max_chunks = max(1, DOCUMENT_MAX_CHUNKS)
+    chunk_tokens = max(DOCUMENT_CHUNK_TOKENS, -(-count_tokens(text) // max_chunks))
+    chunks = split_document_chunks(text, chunk_tokens)
+    # Line boundaries can leave a chunk short of the target; grow until the count fits
+    while len(chunks) > max_chunks:
+        chunk_tokens = int(chunk_tokens * 1.1) + 1
+        chunks = split_document_chunks(text, chunk_tokens)
+    return chunks
+
+
+def document_chunk_key(chunk):
+    return hashlib.sha256(f"v{DOCUMENT_MAP_PROMPT_VERSION}\n{chunk}".encode("utf-8")).hexdigest()
+
+
+def document_chunk_messages(chunk):
+    """Map prompt for one chunk; request-independent so summaries can be cached by content"""
+    return [
+        {"role": "system", "content": "你是一位教育設計專家，正在分段閱讀一份較長的教學文件。"},
+        {"role": "user", "content": (
+            f"文件片段：\n{chunk}\n\n"
+            "請只根據這個片段，用條列方式摘錄與以下方面相關的內容及問題："
+            "學習目標（ILO）、教學活動、評量方式、Bloom's Taxonomy 層次、其他值得注意的優缺點。"
+            "沒有相關內容的方面請略過，不要推測片段以外的內容。"
+        )},
+    ]
+
+
+def analyze_document_chunk(chunk):
+    """Map step: findings for one chunk. Returns (notes, made_llm_call)"""
+    key = document_chunk_key(chunk)
+    cached, state = document_chunk_cache.lookup(key)
+    if state == "hit":
+        return cached, False
+
+    completion = create_chat_completion(
+        priority="document",
+        model=DEPLOYMENT_ID,
+        messages=document_chunk_messages(chunk),
+        temperature=0.2,
+        max_tokens=DOCUMENT_MAP_MAX_TOKENS,
+    )
+    notes = (completion.choices[0].message.content or "").strip()
+    if notes:
+        document_chunk_cache.put(key, notes)
+    return notes, True
+
+
+def build_document_reduce_messages(notes, truncated, filename, user_message="", subject="", grade="", topic=""):
+    """
+    Reduce prompt: the per-chunk notes (None for a chunk that failed) in document order.
+    Raises RuntimeError if every chunk failed.
+    """
+    if all(n is None for n in notes):
+        raise RuntimeError("All document chunks failed to analyse")
+    findings = []
+    for index, n in enumerate(notes, start=1):
+        if n is None:
+            n = "（此部分分析失敗）"
+        findings.append(f"【第 {index}/{len(notes)} 部分】\n{n or '（沒有相關內容）'}")
+
+    user_prompt = user_message if user_message else "請分析這個教學文件並提供改進建議"
+    coverage = f"（文件過長，只分析了前 {DOCUMENT_MAX_CHARS} 字）\n" if truncated else ""
+    full_user_content = f"""{document_context_block(subject, grade, topic)}文件名稱：{filename}
+
+文件較長，已分為 {len(notes)} 部分分析。{coverage}各部分的分析摘要：
+{chr(10).join(findings)}
+
+請綜合以上各部分（包括文件後段的評量等內容）回答。
+用戶問題：{user_prompt}
+""".strip()
+
+    return [
+        {"role": "system", "content": DOCUMENT_ANALYSIS_SYSTEM_PROMPT},
+        {"role": "user", "content": full_user_content},
+    ]
+
+
+def analyze_long_document(text_content, filename, user_message="", subject="", grade="", topic=""):
+    """
+    Analyse a document longer than DOCUMENT_TEXT_BUDGET instead of truncating it:
+      - map: split into at most DOCUMENT_MAX_CHUNKS chunks (see document_chunks()),
+        analysed concurrently (at most DOCUMENT_MAP_CONCURRENCY at once, cached per chunk)
+      - reduce: one call merges the partial findings and answers the user's question
+    Returns (analysis_text, chunk_count).
+    """
+    truncated = len(text_content) > DOCUMENT_MAX_CHARS
+    chunks = document_chunks(text_content[:DOCUMENT_MAX_CHARS])
+
+    notes = [None] * len(chunks)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(DOCUMENT_MAP_CONCURRENCY, len(chunks))))
+    try:
+        with stage("document_map"):
+            futures = {executor.submit(bind_request_timing(analyze_document_chunk), chunk): index
+                       for index, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    chunk_notes, made_call = future.result()
+                except LLMOverloaded:
+                    # No point queueing the remaining chunks: fail the request now
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                except Exception as e:
+                    app.logger.warning(f"Chunk {index + 1}/{len(chunks)} of {filename} failed: {e}")
+                    chunk_notes, made_call = None, True
+                # Worker threads have no request context, so count their calls here
+                if made_call:
+                    record_llm_call()
+                notes[index] = chunk_notes
+    finally:
+        executor.shutdown(wait=False)
+
+    with stage("document_reduce"):
+        completion = create_chat_completion(
+            priority="document",
+            model=DEPLOYMENT_ID,
+            messages=build_document_reduce_messages(notes, truncated, filename, user_message, subject, grade, topic),
+            temperature=0.5,
+            max_tokens=1500,
+        )
+    return completion.choices[0].message.content, len(chunks)
 
 
 @app.route("/api/analyze-document", methods=["POST", "OPTIONS"])
@@ -1616,93 +4805,69 @@ def analyze_document():
         subject = request.form.get("subject", "").strip()
         grade = request.form.get("grade", "").strip()
         topic = request.form.get("topic", "").strip()
+        tag_conversation(request.form.get("conversation_id"))
 
         # Extract file content
         filename = secure_filename(file.filename)
         file.seek(0)  # Ensure file pointer is at the beginning
+
+        # Reject oversized or mislabelled files before any parsing
+        if document_parser.upload_size(file) > UPLOAD_MAX_BYTES:
+            return jsonify({"error": UPLOAD_TOO_LARGE_ERROR}), 413
+        error = document_parser.sniff_file_type(file, filename)
+        if error:
+            return jsonify({"error": error}), 400
         
-        text_content, error = extract_text_from_file(file, filename)
+        text_content, error = extract_text_from_file(file, filename, document_extract_limit())
         
         if error:
             # Provide more detailed error message
             error_msg = error
             if "未安裝" in error:
-                error_msg += "\n\n請在終端運行以下命令安裝所需庫：\npip install -r requirements.txt\n\n或者單獨安裝：\npip install PyPDF2 python-docx"
+                error_msg += "\n\n請在終端運行以下命令安裝所需庫：\npip install -r requirements.txt\n\n或者單獨安裝：\npip install PyPDF2"
             return jsonify({"error": error_msg}), 400
         
         if not text_content or len(text_content.strip()) < 10:
             return jsonify({"error": "文件內容過少或無法提取文字"}), 400
 
-        # Limit file content length (avoid exceeding token limit)
-        max_length = 10000  # Approximately 2500-3000 tokens
-        if len(text_content) > max_length:
-            text_content = text_content[:max_length] + "\n\n...（內容已截斷）"
-
-        # Build analysis prompt
-        context_parts = []
-        if subject:
-            context_parts.append(f"科目：{subject}")
-        if grade:
-            context_parts.append(f"年級：{grade}")
-        if topic:
-            context_parts.append(f"課題：{topic}")
-        context_block = "\n".join(context_parts) + "\n\n" if context_parts else ""
-
-        user_prompt = user_message if user_message else "請分析這個教學文件並提供改進建議"
-        
-        system_prompt = (
-            "你是一位教育設計專家。請仔細分析用戶提供的教學文件，"
-            "並提供專業的改進建議。重點關注：\n"
-            "1. 學習目標（ILO）的清晰度和可測量性\n"
-            "2. 教學活動的設計是否有效\n"
-            "3. 評量方式是否與學習目標對齊\n"
-            "4. 是否符合 Bloom's Taxonomy\n"
-            "5. 整體教學設計的優缺點\n\n"
-            "請用中文回答，提供具體、可操作的建議。"
-        )
-
-        full_user_content = f"""{context_block}文件名稱：{filename}
-
-文件內容：
-{text_content}
-
-用戶問題：{user_prompt}
-""".strip()
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": full_user_content}
-        ]
-
-        # Call OpenAI API
-        payload = {
-            "messages": messages,
-            "temperature": 0.3,
-            "max_tokens": 1000
-        }
-
         # Use Azure OpenAI client
         if not azure_openai_client:
             return jsonify({"error": "Azure OpenAI client not initialized"}), 500
         
+        chunks = None
         try:
-            completion = azure_openai_client.chat.completions.create(
-                model=DEPLOYMENT_ID,
-                messages=messages,
-                temperature=0.5,
-                max_tokens=1500
-            )
-            analysis_text = completion.choices[0].message.content
+            if is_long_document(text_content):
+                analysis_text, chunks = analyze_long_document(text_content, filename, user_message, subject, grade, topic)
+            else:
+                messages = build_document_analysis_messages(text_content, filename, user_message, subject, grade, topic)
+                with stage("llm_document"):
+                    completion = create_chat_completion(
+                        priority="document",
+                        model=DEPLOYMENT_ID,
+                        messages=messages,
+                        temperature=0.5,
+                        max_tokens=1500
+                    )
+                analysis_text = completion.choices[0].message.content
+        except LLMOverloaded:
+            raise
         except Exception as e:
             app.logger.error(f"Azure OpenAI API error: {e}")
             return jsonify({"error": f"AI 分析失敗：{str(e)}"}), 500
 
-        return jsonify({
+        record_document_turn(request.form.get("conversation_id"), filename, user_message, analysis_text)
+
+        result = {
             "analysis": analysis_text,
             "filename": filename,
             "actions": []  # Can add actions based on analysis results
-        })
+        }
+        if chunks:
+            result["chunks"] = chunks
+        return jsonify(result)
 
+    except (LLMOverloaded, RequestEntityTooLarge):
+        raise
     except Exception as e:
         app.logger.exception(e)
         return jsonify({"error": str(e), "type": type(e).__name__}), 500
@@ -0,0 +1,837 @@
+"""
+ASGI entry point (async serving mode).
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+The LLM-bound routes (/api/chat, /api/generate_ilos[/batch], /api/analyze-document) are
+served here with AsyncAzureOpenAI and async LDS calls, so a request waiting on the
+model does not hold a worker. Every other route is the Flask app from app.py,
+mounted unchanged. Request/response shapes match the Flask routes; prompts,
+parsing, caches and deployment capabilities are shared with app.py.
+"""
+import asyncio
+import contextlib
+import time
+
+import httpx
+from openai import AsyncAzureOpenAI
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.utils import secure_filename
+
+import app as backend
+
+logger = backend.app.logger
+
+async_azure_openai_client = AsyncAzureOpenAI(
+    azure_endpoint=backend.OPENAI_ENDPOINT,
+    api_key=backend.AZURE_OPENAI_API_KEY,
+    api_version=backend.API_VERSION,
+)
+
+# Azure OpenAI calls made by the current request (reported as X-LLM-Calls)
+llm_call_count = backend.llm_call_count
+
+
+# =========================
+# Async upstream clients
+# =========================
+class AsyncLDSClient:
+    """
+    httpx counterpart of app.LDSClient: same headers, pool size and per-route timeouts.
+    Concurrent identical requests share one upstream call; calls are counted in
+    app.lds_client.stats().
+    """
+
+    def __init__(self, headers, pool_size=10, timeouts=None):
+        self.headers = dict(headers)
+        self.headers.setdefault("Accept-Encoding", "gzip, deflate")
+        self.pool_size = pool_size
+        self.timeouts = dict(timeouts or {})
+        self._client = None
+        self._single_flight = backend.lds_client.async_single_flight()
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers=self.headers,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+        return self._client
+
+    def timeout_for(self, route):
+        timeout = self.timeouts.get(route, self.timeouts.get("default", (5, 30)))
+        if isinstance(timeout, tuple):
+            return httpx.Timeout(timeout[1], connect=timeout[0])
+        return httpx.Timeout(timeout)
+
+    async def request(self, method, url, route="default", json=None):
+        body = json if json is not None else {}
+        key = (method.upper(), url, backend.canonical_json(body))
+        with backend.stage("lds"):
+            return await self._single_flight.do(key, lambda: self._send_guarded(method, url, route, body))
+
+    async def _send_guarded(self, method, url, route, body):
+        # Inside the single flight: a call refused by the breaker is refused for all its waiters
+        with backend.lds_breaker.guard() as outcome:
+            with backend.lds_client.counted(route) as counted:
+                resp = await self._send(method, url, body, self.timeout_for(route))
+                counted["status"] = resp.status_code
+            outcome["failure"] = backend.upstream_failure(status=resp.status_code)
+            return resp
+
+    async def _send(self, method, url, body, timeout):
+        """Async app.send_lds_request(): recorded or replayed per CASSETTE_MODE"""
+        cassettes = backend.upstream_cassettes
+        if not cassettes.mode:
+            return await self._get_client().request(method, url, json=body, timeout=timeout)
+        key, shape = backend.lds_cassette_key(method, url, body)
+        if cassettes.replaying:
+            entry = cassettes.lookup("lds", key, shape)
+            await asyncio.sleep(cassettes.delay(entry["duration"]))
+            return httpx.Response(
+                entry["status"],
+                content=entry["body"].encode("utf-8"),
+                headers={"Content-Type": entry.get("content_type") or "application/json"},
+                request=httpx.Request(method, url),
+            )
+        started = time.perf_counter()
+        resp = await self._get_client().request(method, url, json=body, timeout=timeout)
+        cassettes.record_lds(
+            key, shape, resp.status_code, resp.text, resp.headers.get("Content-Type"), time.perf_counter() - started
+        )
+        return resp
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+async_lds_client = AsyncLDSClient(backend.lds_headers, pool_size=backend.LDS_POOL_SIZE, timeouts=backend.LDS_TIMEOUTS)
+
+
+async def release_after(stream, started):
+    """Hold the admission slot while a streamed completion is consumed"""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        backend.llm_admission.release(started)
+
+
+async def send_chat_completion(params, adapted):
+    """Async app.send_chat_completion(): recorded or replayed per CASSETTE_MODE"""
+    cassettes = backend.upstream_cassettes
+    if not cassettes.mode:
+        return await async_azure_openai_client.chat.completions.create(**adapted)
+    key, shape = backend.azure_cassette_key(params)
+    if cassettes.replaying:
+        delay, answer = cassettes.replay_azure(key, shape)
+        if isinstance(answer, list):
+            return replay_stream(answer)
+        await asyncio.sleep(delay)
+        return answer
+    started = time.perf_counter()
+    completion = await async_azure_openai_client.chat.completions.create(**adapted)
+    if params.get("stream"):
+        return cassettes.recording_stream_async(key, shape, completion, started)
+    cassettes.record_completion(key, shape, completion, time.perf_counter() - started)
+    return completion
+
+
+async def replay_stream(chunks):
+    for delay, chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        yield chunk
+
+
+async def create_chat_completion(priority="chat", **params):
+    """Async app.create_chat_completion(): same app.ChatCompletionCall bookkeeping"""
+    call = backend.ChatCompletionCall(params)
+    try:
+        call.admitted(await backend.llm_admission.acquire_async(priority))
+        while True:
+            adapted = call.attempt()
+            try:
+                completion = await send_chat_completion(params, adapted)
+            except Exception as e:
+                if call.failed(adapted, e):
+                    continue
+                raise
+            call.succeeded()
+            break
+    except BaseException as e:
+        call.abort(e)  # cancelled mid-call included
+        raise
+    if params.get("stream"):
+        return release_after(completion, call.started)
+    return call.finish(completion)
+
+
+async def call_openai(payload: dict):
+    """Async app.call_openai(): returns the same {"choices": [{"message": ...}]} shape"""
+    try:
+        completion = await create_chat_completion(**backend.build_completion_params(payload))
+        return {"choices": [{"message": backend.completion_message(completion)}]}
+    except backend.LLMOverloaded:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Azure OpenAI error: {str(e)}") from e
+
+
+async def call_openai_stream(payload: dict):
+    """Async app.call_openai_stream(): yields ("content", delta) then ("tool_calls", [...])"""
+    try:
+        stream = await create_chat_completion(stream=True, **backend.build_completion_params(payload))
+    except backend.LLMOverloaded:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Azure OpenAI error: {str(e)}") from e
+
+    async def _events():
+        reply = backend.StreamedReply()
+        try:
+            async for chunk in stream:
+                content = reply.feed(chunk)
+                if content:
+                    yield "content", content
+        except Exception as e:
+            raise RuntimeError(f"Azure OpenAI error: {str(e)}") from e
+        if reply.tool_calls:
+            yield "tool_calls", reply.tool_calls
+
+    return _events()
+
+
+async def get_lds_option_list(route, locale):
+    """Async app.get_lds_option_list(): lds_option_cache, async HTTP on a miss"""
+    key, value = backend.lds_option_lookup(route, locale)
+    if value is not None:
+        return value
+    try:
+        resp = await async_lds_client.request(
+            "POST", backend.LDS_ENDPOINTS[route], route=route, json={"locale": locale} if locale else {}
+        )
+        value = backend.lds_option_list(resp)
+    except Exception:
+        fallback = backend.lds_option_cache.last_good(key)
+        if fallback is None:
+            raise
+        return fallback
+    backend.lds_option_cache.put(key, value)
+    return value
+
+
+async def call_lds_api(name: str, args: dict):
+    """Async app.call_lds_api(): same app.LDSToolCall cache policy, async HTTP on a miss"""
+    call = backend.LDSToolCall(name, args)
+    if call.result is not None:
+        return call.result
+
+    if call.option_route:
+        try:
+            return call.option_list_answered(await get_lds_option_list(call.option_route, call.args.get("locale")))
+        except Exception as e:
+            result = call.option_list_failed(e)
+            if result is not None:
+                return result
+
+    try:
+        resp = await async_lds_client.request(call.api["method"], call.api["url"], route=name, json=call.args)
+        return call.answered(resp)
+    except Exception as e:
+        return call.failed(e)
+
+
+async def execute_tool_calls(tool_calls):
+    """Async app.execute_tool_calls(): the tool calls run concurrently"""
+    async def _run(tc):
+        return backend.tool_message(tc, await call_lds_api(tc["function"]["name"], backend.tool_call_args(tc)))
+
+    with backend.stage("tools"):
+        return list(await asyncio.gather(*(_run(tc) for tc in tool_calls)))
+
+
+async def call_openai_with_format_fallback(payload, stage_name):
+    """Async app.call_openai_with_format_fallback(): json_object retry on a rejection only"""
+    try:
+        with backend.stage(stage_name):
+            return await call_openai(payload)
+    except backend.LLMOverloaded:
+        raise
+    except Exception as e:
+        if not backend.json_object_fallback(payload, e):
+            raise
+        with backend.stage(f"{stage_name}_fallback"):
+            return await call_openai(payload)
+
+
+async def run_chat_single_pass(messages, temperature=0.3, max_tokens=600, response_format=None, tools=None):
+    """Async app.run_chat_single_pass(): None when the deployment rejects the first call"""
+    payload = backend.single_pass_payload(messages, temperature, max_tokens, response_format, tools)
+    try:
+        data1 = await call_openai_with_format_fallback(payload, "llm_single_pass")
+    except backend.LLMOverloaded:
+        raise
+    except Exception as e:
+        if not backend.single_pass_rejected(e, tools):
+            raise
+        return None
+
+    msg1, tool_calls = backend.reply_tool_calls(data1, tools)
+    if not tool_calls:
+        return msg1
+
+    # A failed final call is raised: stage 1 and the tools are not run again
+    payload2 = backend.final_answer_payload(payload, messages + [msg1] + await execute_tool_calls(tool_calls))
+    data2 = await call_openai_with_format_fallback(payload2, "llm_final")
+    return data2["choices"][0]["message"]
+
+
+async def run_chat_with_optional_tools(messages, temperature=0.3, max_tokens=600, response_format=None, tools=None):
+    """
+    Async app.run_chat_with_optional_tools(): run_chat_single_pass() first (single_pass
+    mode); the legacy 2-stage strategy (two_stage mode, or deployments that reject
+    single-pass) runs the sync version in a thread.
+    """
+    if (
+        backend.CHAT_EXECUTION_MODE == "single_pass"
+        and response_format
+        and backend.deployment_capabilities.supports("single_pass")
+    ):
+        msg = await run_chat_single_pass(
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format=response_format,
+            tools=tools,
+        )
+        if msg is not None:
+            return msg
+
+    return await asyncio.to_thread(
+        backend.run_chat_with_optional_tools,
+        messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=response_format,
+        tools=tools,
+        allow_single_pass=False,
+    )
+
+
+async def generate_suggested_questions(user_message, bot_reply, conversation_history):
+    """Async app.generate_suggested_questions()"""
+    try:
+        messages = backend.build_suggestion_messages(user_message, bot_reply, conversation_history)
+        with backend.stage("suggestions"):
+            completion = await create_chat_completion(
+                priority="suggestions",
+                model=backend.DEPLOYMENT_ID,
+                messages=messages,
+                temperature=0.8,
+                max_tokens=200,
+                response_format={"type": "json_object"}
+            )
+        questions = backend.parse_suggested_questions(completion.choices[0].message.content)
+        if questions:
+            return questions
+    except Exception as e:
+        logger.error(f"Error calling Azure OpenAI for suggested questions: {e}")
+    return list(backend.DEFAULT_SUGGESTED_QUESTIONS)
+
+
+# =========================
+# Routes
+# =========================
+def json_response(payload, status_code=200, headers=None):
+    headers = dict(headers or {})
+    counter = llm_call_count.get()
+    if counter and counter[0]:
+        headers["X-LLM-Calls"] = str(counter[0])
+    return JSONResponse(payload, status_code=status_code, headers=headers)
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def open_chat_stream(turn):
+    """Async app.open_chat_stream()"""
+    while True:
+        try:
+            return await call_openai_stream(turn.payload)
+        except backend.LLMOverloaded:
+            raise
+        except Exception as e:
+            if not turn.retry(e):
+                raise
+
+
+async def stream_chat_events(messages, user_msg, conversation_history, conversation_id=None, session=None):
+    """Async app.stream_chat_events(): same app.ChatStreamTurn calls and SSE events"""
+    try:
+        turn = backend.ChatStreamTurn(messages, user_msg)
+        stream = await open_chat_stream(turn)
+        with backend.stage("llm_stream"):
+            async for kind, value in stream:
+                event = turn.feed(kind, value)
+                if event:
+                    yield event
+
+        if turn.tool_calls:
+            reset = turn.reset_event()
+            if reset:
+                yield reset
+            turn.final_call(await execute_tool_calls(turn.tool_calls))
+            stream = await open_chat_stream(turn)
+            with backend.stage("llm_stream_stage2"):
+                async for kind, value in stream:
+                    event = turn.feed(kind, value)
+                    if event:
+                        yield event
+
+        obj = turn.reply(conversation_id)
+        await asyncio.to_thread(
+            backend.record_session_turn, conversation_id, session, user_msg, obj["chat_message_reply"]["text"]
+        )
+        yield backend.sse_event("actions", obj)
+
+        suggested_questions = await generate_suggested_questions(
+            user_msg,
+            obj["chat_message_reply"]["text"],
+            conversation_history
+        )
+        if suggested_questions:
+            yield backend.sse_event("suggested_questions", {"suggested_questions": suggested_questions})
+    except Exception as e:
+        yield backend.chat_stream_error_event(e)
+    yield backend.chat_stream_done_event((llm_call_count.get() or [0])[0], backend.request_timing.get())
+
+
+def sse_response(events):
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def chat_general(request):
+    """Async /api/chat (see app.chat_general)"""
+    if request.method == "OPTIONS":
+        return Response(status_code=204)
+    llm_call_count.set([0])
+
+    data = await read_json(request)
+    user_msg = (data.get("message") or "").strip()
+    stream = backend.wants_event_stream(data, request.headers.get("accept", ""))
+
+    is_suggested_question = data.get("is_suggested_question", False)
+    if not is_suggested_question and not backend.is_in_scope(user_msg):
+        refusal = {"chat_message_reply": {"text": backend.REFUSAL_TEXT}, "actions": []}
+        if stream:
+            async def _refusal_events():
+                yield backend.sse_event("delta", {"text": backend.REFUSAL_TEXT})
+                yield backend.sse_event("actions", refusal)
+                yield backend.sse_event("done", {})
+            return sse_response(_refusal_events())
+        return json_response(refusal)
+
+    conversation_id, session = await asyncio.to_thread(backend.open_chat_session, data)
+    backend.tag_conversation(conversation_id)
+    if session is None:
+        return json_response(backend.conversation_not_found(conversation_id), 409)
+
+    # May call the model to extend the history summary
+    messages, conversation_history = await asyncio.to_thread(backend.build_chat_messages, data, user_msg, session)
+
+    if stream:
+        return sse_response(stream_chat_events(messages, user_msg, conversation_history, conversation_id, session))
+
+    try:
+        msg = await run_chat_with_optional_tools(
+            messages,
+            temperature=0.3,
+            max_tokens=3000,
+            response_format=backend.CHATBOT_SCHEMA,
+            tools=backend.TOOLS,
+        )
+        obj = backend.finalize_chat_reply(msg.get("content", "{}"), user_msg)
+        await asyncio.to_thread(
+            backend.record_session_turn, conversation_id, session, user_msg, obj["chat_message_reply"]["text"]
+        )
+        obj["conversation_id"] = conversation_id
+
+        suggested_questions = await generate_suggested_questions(
+            user_msg,
+            obj["chat_message_reply"]["text"],
+            conversation_history
+        )
+        if suggested_questions:
+            obj["suggested_questions"] = suggested_questions
+
+        return json_response(obj)
+
+    except backend.LLMOverloaded:
+        raise
+    except Exception as e:
+        logger.exception(e)
+        return json_response({
+            "chat_message_reply": {
+                "text": f"伺服器錯誤（暫供除錯）：{str(e)}"
+            },
+            "actions": []
+        }, 500)
+
+
+async def generate_ilo_statements(data):
+    """Async app.generate_ilo_statements(): same prompts, fallbacks and validation"""
+    messages = backend.build_ilo_messages(data)
+    try:
+        msg = await run_chat_with_optional_tools(messages, temperature=0.2, max_tokens=320, response_format=backend.ILO_SCHEMA)
+        validated_ilos, ilos_data = backend.parse_ilo_content(msg.get("content", "[]"))
+        if validated_ilos:
+            return validated_ilos, 200
+        return backend.ilo_parse_error(ilos_data), 500
+    except backend.LLMOverloaded:
+        raise
+    except Exception as e1:
+        logger.exception(e1)
+        if backend.is_content_filter_error(str(e1)):
+            logger.error("Content filter triggered. Attempting with modified prompt...")
+            try:
+                msg = await run_chat_with_optional_tools(
+                    backend.build_safe_ilo_messages(data),
+                    temperature=0.2,
+                    max_tokens=320,
+                    response_format={"type": "json_object"}
+                )
+                validated_ilos, _ = backend.parse_ilo_content(msg.get("content", "{}"))
+                if validated_ilos:
+                    return validated_ilos, 200
+            except backend.LLMOverloaded:
+                raise
+            except Exception as e2:
+                logger.exception(e2)
+            return dict(backend.ILO_CONTENT_FILTER_ERROR), 400
+
+        try:
+            msg = await run_chat_with_optional_tools(
+                messages,
+                temperature=0.2,
+                max_tokens=320,
+                response_format={"type": "json_object"}
+            )
+            validated_ilos, ilos_data = backend.parse_ilo_content(msg.get("content", "{}"))
+            if validated_ilos:
+                return validated_ilos, 200
+            return backend.ilo_parse_error(ilos_data), 500
+        except backend.LLMOverloaded:
+            raise
+        except Exception as e2:
+            logger.exception(e2)
+            return {"error": str(e2)}, 500
+
+
+async def generate_ilos_cached(data):
+    """Async app.generate_ilos_cached(): shares ilo_result_cache with the Flask route"""
+    key = backend.ilo_cache_key(data)
+    if not data.get("fresh"):
+        cached, state = backend.ilo_result_cache.lookup(key)
+        if state == "hit":
+            return cached, 200, True
+
+    payload, status = await generate_ilo_statements(data)
+    if status == 200:
+        backend.ilo_result_cache.put(key, payload)
+    return payload, status, False
+
+
+async def generate_ilos(request):
+    """Async /api/generate_ilos (see app.generate_ilos)"""
+    llm_call_count.set([0])
+    data = await read_json(request)
+    payload, status, cache_hit = await generate_ilos_cached(data)
+    return json_response(payload, status, {"X-Cache": "HIT" if cache_hit else "MISS"})
+
+
+async def generate_ilo_batch_item(index, item, semaphore):
+    """Async app.generate_ilo_batch_item()"""
+    if not isinstance(item, dict):
+        return backend.ilo_batch_line(index, item, {"error": "Each item must be an object"}, 400, False)
+    async with semaphore:
+        try:
+            payload, status, cache_hit = await generate_ilos_cached(item)
+        except backend.LLMOverloaded as e:
+            payload, status, cache_hit = {
+                "error": f"AI 服務繁忙，請 {e.retry_after} 秒後再試",
+                "retry_after": e.retry_after,
+            }, e.status, False
+        except Exception as e:
+            logger.exception(e)
+            payload, status, cache_hit = {"error": str(e)}, 500, False
+    return backend.ilo_batch_line(index, item, payload, status, cache_hit)
+
+
+async def generate_ilo_batch_lines(items):
+    semaphore = asyncio.Semaphore(max(1, backend.ILO_BATCH_CONCURRENCY))
+    tasks = [asyncio.ensure_future(generate_ilo_batch_item(index, item, semaphore)) for index, item in enumerate(items)]
+    try:
+        lines = []
+        for next_done in asyncio.as_completed(tasks):
+            lines.append(await next_done)
+            yield backend.ndjson_line(lines[-1])
+        yield backend.ndjson_line(backend.ilo_batch_summary(lines))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def generate_ilos_batch(request):
+    """Async /api/generate_ilos/batch (see app.generate_ilos_batch)"""
+    data = await read_json(request)
+    items, error = backend.parse_ilo_batch(data)
+    if error:
+        return json_response({"error": error}, 400)
+    return StreamingResponse(
+        generate_ilo_batch_lines(items),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def analyze_document_chunk(chunk, semaphore):
+    """Async app.analyze_document_chunk(); returns the notes, or None if the call failed"""
+    key = backend.document_chunk_key(chunk)
+    cached, state = backend.document_chunk_cache.lookup(key)
+    if state == "hit":
+        return cached
+    async with semaphore:
+        try:
+            completion = await create_chat_completion(
+                priority="document",
+                model=backend.DEPLOYMENT_ID,
+                messages=backend.document_chunk_messages(chunk),
+                temperature=0.2,
+                max_tokens=backend.DOCUMENT_MAP_MAX_TOKENS,
+            )
+        except backend.LLMOverloaded:
+            raise
+        except Exception as e:
+            logger.warning(f"Document chunk failed: {e}")
+            return None
+    notes = (completion.choices[0].message.content or "").strip()
+    if notes:
+        backend.document_chunk_cache.put(key, notes)
+    return notes
+
+
+async def analyze_long_document(text_content, filename, user_message="", subject="", grade="", topic=""):
+    """Async app.analyze_long_document(): chunk summaries gathered concurrently, then one reduce call"""
+    truncated = len(text_content) > backend.DOCUMENT_MAX_CHARS
+    chunks = backend.document_chunks(text_content[:backend.DOCUMENT_MAX_CHARS])
+    semaphore = asyncio.Semaphore(max(1, backend.DOCUMENT_MAP_CONCURRENCY))
+    with backend.stage("document_map"):
+        tasks = [asyncio.ensure_future(analyze_document_chunk(chunk, semaphore)) for chunk in chunks]
+        try:
+            notes = await asyncio.gather(*tasks)
+        except backend.LLMOverloaded:
+            # gather() leaves the other chunks running: cancel them and fail the request now
+            for task in tasks:
+                task.cancel()
+            raise
+
+    with backend.stage("document_reduce"):
+        completion = await create_chat_completion(
+            priority="document",
+            model=backend.DEPLOYMENT_ID,
+            messages=backend.build_document_reduce_messages(
+                list(notes), truncated, filename, user_message, subject, grade, topic
+            ),
+            temperature=0.5,
+            max_tokens=1500,
+        )
+    return completion.choices[0].message.content, len(chunks)
+
+
+async def analyze_document(request):
+    """Async /api/analyze-document (see app.analyze_document); parsing runs in a thread"""
+    if request.method == "OPTIONS":
+        return Response(status_code=204)
+    llm_call_count.set([0])
+
+    try:
+        # Refuse oversized uploads before reading the body (see app.UPLOAD_MAX_MB)
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > backend.app.config["MAX_CONTENT_LENGTH"]:
+            return json_response({"error": backend.UPLOAD_TOO_LARGE_ERROR}, 413)
+
+        form = await request.form()
+        file = form.get("file")
+        if file is None or not hasattr(file, "filename"):
+            return json_response({"error": "沒有上傳文件"}, 400)
+        if file.filename == '':
+            return json_response({"error": "文件為空"}, 400)
+
+        user_message = (form.get("message") or "").strip()
+        subject = (form.get("subject") or "").strip()
+        grade = (form.get("grade") or "").strip()
+        topic = (form.get("topic") or "").strip()
+        backend.tag_conversation(form.get("conversation_id"))
+
+        filename = secure_filename(file.filename)
+        file.file.seek(0)
+
+        if await asyncio.to_thread(backend.document_parser.upload_size, file.file) > backend.UPLOAD_MAX_BYTES:
+            return json_response({"error": backend.UPLOAD_TOO_LARGE_ERROR}, 413)
+        error = await asyncio.to_thread(backend.document_parser.sniff_file_type, file.file, filename)
+        if error:
+            return json_response({"error": error}, 400)
+        text_content, error = await asyncio.to_thread(
+            backend.extract_text_from_file, file.file, filename, backend.document_extract_limit()
+        )
+
+        if error:
+            error_msg = error
+            if "未安裝" in error:
+                error_msg += "\n\n請在終端運行以下命令安裝所需庫：\npip install -r requirements.txt\n\n或者單獨安裝：\npip install PyPDF2"
+            return json_response({"error": error_msg}, 400)
+
+        if not text_content or len(text_content.strip()) < 10:
+            return json_response({"error": "文件內容過少或無法提取文字"}, 400)
+
+        chunks = None
+        try:
+            if backend.is_long_document(text_content):
+                analysis_text, chunks = await analyze_long_document(
+                    text_content, filename, user_message, subject, grade, topic
+                )
+            else:
+                messages = backend.build_document_analysis_messages(
+                    text_content, filename, user_message, subject, grade, topic
+                )
+                with backend.stage("llm_document"):
+                    completion = await create_chat_completion(
+                        priority="document",
+                        model=backend.DEPLOYMENT_ID,
+                        messages=messages,
+                        temperature=0.5,
+                        max_tokens=1500
+                    )
+                analysis_text = completion.choices[0].message.content
+        except backend.LLMOverloaded:
+            raise
+        except Exception as e:
+            logger.error(f"Azure OpenAI API error: {e}")
+            return json_response({"error": f"AI 分析失敗：{str(e)}"}, 500)
+
+        await asyncio.to_thread(
+            backend.record_document_turn, form.get("conversation_id"), filename, user_message, analysis_text
+        )
+
+        result = {
+            "analysis": analysis_text,
+            "filename": filename,
+            "actions": []
+        }
+        if chunks:
+            result["chunks"] = chunks
+        return json_response(result)
+
+    except backend.LLMOverloaded:
+        raise
+    except Exception as e:
+        logger.exception(e)
+        return json_response({"error": str(e), "type": type(e).__name__}, 500)
+
+
+async def llm_overloaded(request, e):
+    """Same 429/503 + Retry-After as app.llm_overloaded()"""
+    logger.warning(f"{request.method} {request.url.path} not admitted: {e.reason} (retry after {e.retry_after}s)")
+    return JSONResponse(
+        {"error": f"AI 服務繁忙，請 {e.retry_after} 秒後再試", "retry_after": e.retry_after},
+        status_code=e.status,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    yield
+    await async_lds_client.aclose()
+    await async_azure_openai_client.close()
+
+
+class ServerTimingMiddleware:
+    """
+    Stage timing for the async routes (the Flask routes time themselves): starts
+    app.request_timing, adds the Server-Timing header and records the request duration.
+    """
+
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        timing = backend.start_request_timing(scope["path"])
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", backend.server_timing_header(timing).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            backend.metrics.observe_since(
+                "lds_chatbot_request_duration_seconds", timing["started"],
+                route=scope["path"], method=scope["method"], status=status,
+            )
+
+
+routes = [
+    Route("/api/chat", chat_general, methods=["POST", "OPTIONS"]),
+    Route("/api/generate_ilos", generate_ilos, methods=["POST"]),
+    Route("/api/generate_ilos/batch", generate_ilos_batch, methods=["POST"]),
+    Route("/api/analyze-document", analyze_document, methods=["POST", "OPTIONS"]),
+]
+
+middleware = [Middleware(ServerTimingMiddleware, paths=[route.path for route in routes])]
+if backend.ENABLE_CORS:
+    middleware.append(Middleware(
+        CORSMiddleware,
+        allow_origins=["*"] if "*" in backend.ALLOWED_ORIGINS else backend.ALLOWED_ORIGINS,
+        allow_methods=["GET", "POST", "OPTIONS"],
+        allow_headers=["Content-Type", "Authorization"],
+    ))
+
+app = Starlette(
+    routes=[
+        *routes,
+        # Everything else is served by the Flask app
+        Mount("/", app=WsgiToAsgi(backend.app)),
+    ],
+    middleware=middleware,
+    exception_handlers={backend.LLMOverloaded: llm_overloaded},
+    lifespan=lifespan,
+)
@@ -0,0 +1,251 @@
+"""
+Offline batch runner: generate ILOs / Disciplinary Practice recommendations for a
+JSONL file of inputs, in-process (no HTTP, so the Flask app is not involved).
+
+    python batch_runner.py curriculum.jsonl -o ilo_bank.jsonl --workers 4 --rate 120
+
+Each input line is one request body, optionally wrapped:
+    {"id": "math-u1-l1", "kind": "generate_ilos", "input": {"topic": "...", "bloom_level": "Apply"}}
+    {"id": "math-u1", "kind": "suggest_dp", "input": {"topic": "...", "subject": "Mathematics"}}
+    {"topic": "...", "bloom_level": "Apply"}            (kind defaults to generate_ilos, id to line-N)
+
+Each output line is {"id", "kind", "status", "result" | "error", "latency_ms", "usage"}.
+The output file is the checkpoint: rerunning with the same -o skips ids that already
+succeeded and retries the rest. Prompts, fallbacks and validation are the ones the
+/api/generate_ilos and /api/suggest_dp routes use (app.generate_ilos_cached / app.recommend_dp),
+and calls go through the same admission control; an item that is not admitted waits
+Retry-After and is retried.
+Ctrl-C stops starting new items and saves the running ones once they finish; a second
+Ctrl-C drops those and exits at once.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app as backend
+
+
+RUNNERS = {
+    "generate_ilos": lambda data: backend.generate_ilos_cached(data)[:2],
+    "suggest_dp": backend.recommend_dp,
+}
+
+
+class RateLimiter:
+    """Starts at most `per_minute` items a minute across all workers (0 = unlimited)"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until this worker may start an item; returns the seconds waited"""
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return start - now
+
+
+def read_items(path):
+    """(id, kind, input) per non-empty line; raises ValueError on a malformed line"""
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_no}: invalid JSON ({e})") from e
+            if not isinstance(record, dict):
+                raise ValueError(f"{path}:{line_no}: expected a JSON object")
+            kind = record.get("kind", "generate_ilos")
+            if kind not in RUNNERS:
+                raise ValueError(f"{path}:{line_no}: unknown kind {kind!r} (expected one of {', '.join(RUNNERS)})")
+            data = record.get("input", record)
+            if not isinstance(data, dict):
+                raise ValueError(f"{path}:{line_no}: input must be a JSON object")
+            items.append((str(record.get("id", f"line-{line_no}")), kind, data))
+    return items
+
+
+def load_checkpoint(output_path):
+    """
+    Keep only the successful lines of an earlier run's output (rewritten in place) and
+    return their ids; failed items are run again.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    kept = {}
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short when the last run was killed
+            if isinstance(record, dict) and record.get("status") == 200:
+                kept[record["id"]] = line if line.endswith("\n") else line + "\n"
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(kept.values())
+    os.replace(tmp_path, output_path)
+    return set(kept)
+
+
+def run_item(item_id, kind, data, limiter, max_retries):
+    """One item through the route's generation code; returns its output record"""
+    started = time.perf_counter()
+    attempts = 0
+    throttled = 0.0  # rate limiter waits, not counted in the item's latency
+    # Token usage of the item goes to the usage ledger under this route, one request per item
+    backend.start_request_timing(f"batch_runner/{kind}")
+    with backend.llm_usage_scope() as usage:
+        while True:
+            throttled += limiter.wait()
+            attempts += 1
+            try:
+                payload, status = RUNNERS[kind](data)
+                break
+            except backend.LLMOverloaded as e:
+                if attempts > max_retries:
+                    payload, status = {"error": f"not admitted: {e.reason}"}, e.status
+                    break
+                time.sleep(e.retry_after)
+            except Exception as e:
+                backend.app.logger.exception(e)
+                payload, status = {"error": str(e)}, 500
+                break
+
+    record = {"id": item_id, "kind": kind, "status": status}
+    if status == 200:
+        record["result"] = payload
+    else:
+        record["error"] = payload.get("error") if isinstance(payload, dict) else payload
+    record["latency_ms"] = round((time.perf_counter() - started - throttled) * 1000, 1)
+    record["attempts"] = attempts
+    record["usage"] = usage
+    return record
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(records, skipped, elapsed):
+    latencies = sorted(r["latency_ms"] for r in records)
+    usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    for r in records:
+        for field in usage:
+            usage[field] += r["usage"][field]
+    return {
+        "items": len(records),
+        "succeeded": sum(1 for r in records if r["status"] == 200),
+        "failed": sum(1 for r in records if r["status"] != 200),
+        "skipped_from_checkpoint": skipped,
+        "elapsed_s": round(elapsed, 2),
+        "items_per_minute": round(len(records) / elapsed * 60, 1) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+        "usage": usage,
+    }
+
+
+def run(input_path, output_path, workers=4, rate=0.0, max_retries=5, fresh=False):
+    """Run every pending item of `input_path`, appending results to `output_path`; returns the summary"""
+    items = read_items(input_path)
+    done = load_checkpoint(output_path)
+    pending = [item for item in items if item[0] not in done]
+    skipped = len(items) - len(pending)
+    print(f"{len(items)} items, {skipped} already done, {len(pending)} to run", file=sys.stderr)
+
+    limiter = RateLimiter(rate)
+    records = []
+    saved = set()
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        with open(output_path, "a", encoding="utf-8") as out:
+            def save(future):
+                record = future.result()
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                saved.add(future)
+                records.append(record)
+                if len(records) % 50 == 0:
+                    print(f"{len(records)}/{len(pending)} done", file=sys.stderr)
+
+            futures = [
+                executor.submit(run_item, item_id, kind, dict(data, fresh=True) if fresh else data, limiter, max_retries)
+                for item_id, kind, data in pending
+            ]
+            try:
+                for future in as_completed(futures):
+                    save(future)
+            except KeyboardInterrupt:
+                # Items not started yet are cancelled; running ones have already spent
+                # tokens, so they are waited for and saved
+                running = [f for f in futures if f not in saved and not f.cancel()]
+                print(
+                    f"Interrupted; saving {len(running)} running item(s) before stopping "
+                    "(Ctrl-C again to drop them), rerun to resume",
+                    file=sys.stderr,
+                )
+                try:
+                    for future in as_completed(running):
+                        save(future)
+                except KeyboardInterrupt:
+                    dropped = sum(1 for f in running if f not in saved)
+                    print(f"Dropped {dropped} running item(s); rerun to resume", file=sys.stderr)
+                    out.flush()
+                    # os._exit skips atexit, so write the token usage of the saved items here
+                    backend.usage_ledger.flush()
+                    # Exit without joining the worker threads still waiting on Azure OpenAI
+                    os._exit(130)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return summarize(records, skipped, time.perf_counter() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate ILOs / DP recommendations for a JSONL file of inputs")
+    parser.add_argument("input", help="JSONL file of generate_ilos / suggest_dp inputs")
+    parser.add_argument("-o", "--output", required=True, help="JSONL results file; also the resume checkpoint")
+    parser.add_argument("--workers", type=int, default=4, help="items generated at once (default: 4)")
+    parser.add_argument("--rate", type=float, default=0, help="max items started per minute (default: unlimited)")
+    parser.add_argument("--max-retries", type=int, default=5, help="retries for an item the admission queue rejects")
+    parser.add_argument("--fresh", action="store_true", help="bypass the ILO result cache")
+    parser.add_argument("--summary", help="also write the run summary to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        summary = run(args.input, args.output, args.workers, args.rate, args.max_retries, args.fresh)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
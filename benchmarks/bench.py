@@ -0,0 +1,454 @@
+"""
+Endpoint benchmark: starts the fake Azure OpenAI and LDS servers (fake_servers.py), starts
+the backend pointed at them (ENDPOINT_URL / LDS_BASE), drives each route at each concurrency
+level and writes throughput and latency percentiles as JSON, to compare between commits.
+
+    python benchmarks/bench.py run -o bench-main.json
+    python benchmarks/bench.py run --server asgi --routes chat,chat_stream,generate_ilos \\
+        --concurrency 1,8,32 --duration 20 --azure-ttft-ms 800 --azure-rate-429 0.05 -o bench-pr.json
+    python benchmarks/bench.py compare bench-main.json bench-pr.json --threshold 10
+
+Each (route, concurrency) cell runs `concurrency` closed-loop clients for --duration seconds
+after --warmup requests. Payloads are unique per request (cache misses) unless --warm-cache.
+The backend gets fresh SQLite files (sessions, document text, usage ledger) in a temp
+directory, so runs start from the same state; --target benchmarks a server already running
+(it must already use the fakes, e.g. started with fake_servers.py).
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+import fake_servers
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "flask": [sys.executable, "app.py"],
+    "asgi": [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", "{port}", "--log-level", "warning"],
+    "gunicorn": [sys.executable, "-m", "gunicorn", "-w", "4", "-k", "gthread", "--threads", "8",
+                 "-b", "127.0.0.1:{port}", "app:app"],
+}
+
+# Backend environment for every run (--server-env overrides it): long-document
+# map-reduce is opt-in, and analyze_document_long is there to measure it
+BENCH_SERVER_ENV = {"DOCUMENT_MAX_CHARS": "60000"}
+
+DOCUMENT_LINE = "Students investigate how the rate of photosynthesis depends on light intensity, recording evidence. "
+
+
+def ilo_context(n):
+    return {
+        "topic": f"Photosynthesis and light intensity, lesson {n}",
+        "subject": "Biology",
+        "grade": "Secondary 2",
+        "bloom_level": "Apply",
+        "description": "Students design a fair test and explain the results.",
+    }
+
+
+def document_upload(n, size_kb, message):
+    text = f"Unit plan {n}\n" + DOCUMENT_LINE * (size_kb * 1024 // len(DOCUMENT_LINE) + 1)
+    return {
+        "files": {"file": (f"unit-{n}.txt", text.encode("utf-8"), "text/plain")},
+        "data": {"message": message, "subject": "Biology", "grade": "Secondary 2"},
+    }
+
+
+# name -> (method, path, response kind, function of a request number -> requests kwargs)
+ROUTES = {
+    "health": ("GET", "/api/health", "json", lambda n: {}),
+    "subjects": ("GET", "/api/subjects", "json", lambda n: {}),
+    "grade_levels": ("GET", "/api/grade-levels", "json", lambda n: {}),
+    "ilo_categories": ("GET", "/api/ilo-categories", "json", lambda n: {}),
+    "bloom_levels": ("GET", "/api/bloom-taxonomy-levels", "json", lambda n: {}),
+    "ilo_patterns": ("POST", "/api/chatbot/patterns/intended-learning-outcomes", "json", lambda n: {"json": {}}),
+    "bootstrap": ("GET", "/api/bootstrap", "json", lambda n: {}),
+    "chat": ("POST", "/api/chat", "json", lambda n: {
+        "json": {"message": f"How should I write intended learning outcomes for lesson {n}?"},
+    }),
+    "chat_stream": ("POST", "/api/chat", "sse", lambda n: {
+        "json": {"message": f"How should I write intended learning outcomes for lesson {n}?", "stream": True},
+        "stream": True,
+    }),
+    "suggest_dp": ("POST", "/api/suggest_dp", "json", lambda n: {
+        "json": {"topic": f"Fractions, lesson {n}", "subject": "Mathematics", "description": "Equivalent fractions"},
+    }),
+    "generate_ilos": ("POST", "/api/generate_ilos", "json", lambda n: {"json": ilo_context(n)}),
+    "generate_ilos_batch": ("POST", "/api/generate_ilos/batch", "ndjson", lambda n: {
+        "json": {"items": [ilo_context(f"{n}.{i}") for i in range(5)]},
+        "stream": True,
+    }),
+    "analyze_document": ("POST", "/api/analyze-document", "json", lambda n: document_upload(n, 8, "Suggest ILOs")),
+    # Past DOCUMENT_TEXT_BUDGET: analysed in chunks (map-reduce), with DOCUMENT_MAX_CHARS
+    # from BENCH_SERVER_ENV; a --target backend needs DOCUMENT_MAX_CHARS set itself
+    "analyze_document_long": ("POST", "/api/analyze-document", "json", lambda n: document_upload(n, 60, "Suggest ILOs")),
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def distribution(values_ms):
+    values = sorted(values_ms)
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50), 1),
+        "p95": round(percentile(values, 95), 1),
+        "p99": round(percentile(values, 99), 1),
+        "mean": round(sum(values) / len(values), 1),
+        "max": round(values[-1], 1),
+    }
+
+
+def send(session, base_url, route, n, timeout):
+    """One request; returns (status, ok, latency_ms, ttfb_ms or None, error type or None)"""
+    method, path, kind, build = ROUTES[route]
+    kwargs = build(n)
+    stream = kwargs.pop("stream", False)
+    started = time.perf_counter()
+    ttfb = None
+    try:
+        resp = session.request(method, base_url + path, timeout=timeout, stream=stream, **kwargs)
+        ok = 200 <= resp.status_code < 300
+        if kind == "sse":
+            # ttfb: first reply text, as the user sees it
+            event = None
+            for line in resp.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[7:]
+                    if event == "delta" and ttfb is None:
+                        ttfb = (time.perf_counter() - started) * 1000
+                    elif event == "error":
+                        ok = False
+        elif kind == "ndjson":
+            summary = {}
+            for line in resp.iter_lines(decode_unicode=True):
+                if line:
+                    if ttfb is None:
+                        ttfb = (time.perf_counter() - started) * 1000
+                    summary = json.loads(line)
+            ok = ok and summary.get("done") and not summary.get("errors")
+        else:
+            resp.content
+        resp.close()
+        return resp.status_code, bool(ok), (time.perf_counter() - started) * 1000, ttfb, None
+    except requests.RequestException as e:
+        return None, False, (time.perf_counter() - started) * 1000, None, type(e).__name__
+
+
+def run_cell(base_url, route, concurrency, duration, timeout, numbers):
+    """`concurrency` clients sending back to back for `duration` seconds"""
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            result = send(session, base_url, route, next(numbers), timeout)
+            with lock:
+                results.append(result)
+        session.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def summarize_cell(route, concurrency, results, elapsed, fake_delta):
+    method, path, kind, _ = ROUTES[route]
+    ok = [r for r in results if r[1]]
+    status_counts, error_types = {}, {}
+    for status, _, _, _, error in results:
+        key = str(status) if status is not None else "exception"
+        status_counts[key] = status_counts.get(key, 0) + 1
+        if error:
+            error_types[error] = error_types.get(error, 0) + 1
+    count = len(results) or 1
+    return {
+        "route": route,
+        "method": method,
+        "path": path,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "status_counts": status_counts,
+        "error_types": error_types,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": distribution([r[2] for r in ok]),
+        "ttfb_ms": distribution([r[3] for r in ok if r[3] is not None]) if kind != "json" else None,
+        "azure_calls_per_request": round(fake_delta["azure"].get("calls", 0) / count, 2),
+        "azure_tokens_per_request": {
+            "prompt": round(fake_delta["azure"].get("prompt_tokens", 0) / count, 1),
+            "completion": round(fake_delta["azure"].get("completion_tokens", 0) / count, 1),
+        },
+        "lds_calls_per_request": round(fake_delta["lds"].get("calls", 0) / count, 2),
+    }
+
+
+def stats_delta(before, after):
+    return {name: {k: v - before[name].get(k, 0) for k, v in after[name].items()} for name in after}
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit or None, dirty
+    except OSError:
+        return None, None
+
+
+def start_backend(command, env, log_path, startup_timeout=60):
+    """Start the backend and wait until it answers; returns (process, base_url)"""
+    port = free_port()
+    args = [part.format(port=port) for part in command]
+    env = dict(env, PORT=str(port), HOST="127.0.0.1")
+    log = open(log_path, "w")
+    process = subprocess.Popen(args, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"backend exited with {process.returncode}; see {log_path}")
+        try:
+            requests.get(base_url + "/api/health", timeout=5)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.3)
+    process.terminate()
+    raise RuntimeError(f"backend did not start within {startup_timeout}s; see {log_path}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_env(pairs):
+    env = {}
+    for pair in pairs or []:
+        name, sep, value = pair.partition("=")
+        if not sep:
+            raise ValueError(f"--server-env expects NAME=VALUE, got {pair!r}")
+        env[name] = value
+    return env
+
+
+def run(args):
+    routes = args.routes.split(",") if args.routes else list(ROUTES)
+    unknown = [r for r in routes if r not in ROUTES]
+    if unknown:
+        raise ValueError(f"unknown routes {', '.join(unknown)} (expected: {', '.join(ROUTES)})")
+    levels = [int(c) for c in args.concurrency.split(",")]
+    azure_config, lds_config = fake_servers.configs_from_args(args)
+    azure = fake_servers.start("azure", azure_config, seed=args.seed)
+    lds = fake_servers.start("lds", lds_config, seed=args.seed)
+    server_env = parse_env(args.server_env)
+    if not args.target:
+        server_env = dict(BENCH_SERVER_ENV, **server_env)
+
+    workdir = tempfile.mkdtemp(prefix="lds-bench-")
+    process = None
+    if args.target:
+        base_url = args.target.rstrip("/")
+    else:
+        env = dict(
+            os.environ,
+            ENDPOINT_URL=azure.url + "/",
+            AZURE_OPENAI_API_KEY="bench",
+            LDS_BASE=lds.url + "/api",
+            CHAT_SESSION_DB=os.path.join(workdir, "sessions.sqlite3"),
+            DOCUMENT_CACHE_DB=os.path.join(workdir, "document_text.sqlite3"),
+            USAGE_LEDGER_DB=os.path.join(workdir, "token_usage.sqlite3"),
+            **server_env,
+        )
+        env.pop("LDS_TOKEN", None)
+        command = args.server_cmd.split() if args.server_cmd else SERVERS[args.server]
+        process, base_url = start_backend(command, env, os.path.join(workdir, "server.log"))
+
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "server": args.target or args.server_cmd or args.server,
+            "server_env": server_env,
+            "seed": args.seed,
+            "duration_s": args.duration,
+            "warmup_requests": args.warmup,
+            "warm_cache": args.warm_cache,
+            "azure": azure_config,
+            "lds": lds_config,
+        },
+        "results": [],
+    }
+    # Unique request numbers (cache misses), or the same one every time (--warm-cache)
+    numbers = itertools.repeat(0) if args.warm_cache else itertools.count(1)
+    try:
+        for route in routes:
+            with requests.Session() as session:
+                for _ in range(args.warmup):
+                    send(session, base_url, route, next(numbers), args.timeout)
+            for concurrency in levels:
+                before = {"azure": azure.snapshot(), "lds": lds.snapshot()}
+                results, elapsed = run_cell(base_url, route, concurrency, args.duration, args.timeout, numbers)
+                delta = stats_delta(before, {"azure": azure.snapshot(), "lds": lds.snapshot()})
+                cell = summarize_cell(route, concurrency, results, elapsed, delta)
+                report["results"].append(cell)
+                latency = cell["latency_ms"] or {}
+                print(
+                    f"{route:24} c={concurrency:<3} {cell['throughput_rps'] or 0:8.2f} rps  "
+                    f"p50 {latency.get('p50')}  p95 {latency.get('p95')}  p99 {latency.get('p99')} ms  "
+                    f"errors {cell['errors']}/{cell['requests']}",
+                    file=sys.stderr,
+                )
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        azure.shutdown()
+        lds.shutdown()
+    return report
+
+
+def pct_change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return round((new - old) / old * 100, 1)
+
+
+def compare(base, head, threshold):
+    """
+    Per (route, concurrency) cell in both reports: throughput and latency changes in %.
+    A cell regresses when throughput drops, or p95 latency rises, by more than `threshold` %.
+    """
+    base_cells = {(c["route"], c["concurrency"]): c for c in base["results"]}
+    rows = []
+    for cell in head["results"]:
+        old = base_cells.get((cell["route"], cell["concurrency"]))
+        if old is None:
+            continue
+        row = {
+            "route": cell["route"],
+            "concurrency": cell["concurrency"],
+            "throughput_rps": [old["throughput_rps"], cell["throughput_rps"], pct_change(old["throughput_rps"], cell["throughput_rps"])],
+        }
+        for field in ("p50", "p95", "p99"):
+            before = (old["latency_ms"] or {}).get(field)
+            after = (cell["latency_ms"] or {}).get(field)
+            row[field] = [before, after, pct_change(before, after)]
+        row["errors"] = [old["errors"], cell["errors"]]
+        row["regressed"] = (
+            (row["throughput_rps"][2] is not None and row["throughput_rps"][2] < -threshold)
+            or (row["p95"][2] is not None and row["p95"][2] > threshold)
+        )
+        rows.append(row)
+    return rows
+
+
+def format_comparison(rows):
+    def change(values):
+        before, after, pct = values
+        return f"{before} -> {after} ({'n/a' if pct is None else f'{pct:+.1f}%'})"
+
+    lines = []
+    for row in rows:
+        lines.append(
+            f"{'REGRESSED ' if row['regressed'] else '          '}{row['route']:24} c={row['concurrency']:<3} "
+            f"rps {change(row['throughput_rps'])}  p50 {change(row['p50'])}  p95 {change(row['p95'])}  "
+            f"p99 {change(row['p99'])}  errors {row['errors'][0]} -> {row['errors'][1]}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the backend's routes against fake Azure OpenAI / LDS servers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark and write JSON results")
+    run_parser.add_argument("-o", "--output", help="write the JSON results here (default: stdout)")
+    run_parser.add_argument("--server", choices=sorted(SERVERS), default="flask", help="how to start the backend (default: flask)")
+    run_parser.add_argument("--server-cmd", help="custom backend command; {port} is replaced by the port to listen on")
+    run_parser.add_argument("--server-env", action="append", metavar="NAME=VALUE",
+                            help="extra environment for the backend, e.g. LDS_CACHE_TTL=0 (repeatable)")
+    run_parser.add_argument("--target", help="benchmark a running backend at this URL instead of starting one")
+    run_parser.add_argument("--routes", help=f"comma-separated routes (default: all of {', '.join(ROUTES)})")
+    run_parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels (default: 1,4,16)")
+    run_parser.add_argument("--duration", type=float, default=10.0, help="seconds per route and concurrency level (default: 10)")
+    run_parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests per route first (default: 2)")
+    run_parser.add_argument("--timeout", type=float, default=120.0, help="client timeout per request in seconds (default: 120)")
+    run_parser.add_argument("--warm-cache", action="store_true", help="send the same payload every time (measures cache hits)")
+    run_parser.add_argument("--seed", type=int, default=1, help="seed of the fake servers' random draws (default: 1)")
+    fake_servers.add_arguments(run_parser)
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON results (base, then new)")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.add_argument("--threshold", type=float, default=10.0,
+                                help="%% throughput drop or p95 rise counted as a regression (default: 10)")
+    compare_parser.add_argument("--json", action="store_true", help="print the comparison as JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        try:
+            with open(args.base, encoding="utf-8") as f:
+                base = json.load(f)
+            with open(args.head, encoding="utf-8") as f:
+                head = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+        rows = compare(base, head, args.threshold)
+        print(json.dumps(rows, indent=2) if args.json else format_comparison(rows))
+        return 1 if any(row["regressed"] for row in rows) else 0
+
+    try:
+        report = run(args)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
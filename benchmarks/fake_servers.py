@@ -0,0 +1,425 @@
+"""
+Local stand-ins for Azure OpenAI and the LDS (Laravel) API, for benchmarks (bench.py)
+and for running the backend without either.
+
+    python benchmarks/fake_servers.py --azure-port 8001 --lds-port 8002 --azure-ttft-ms 400
+    ENDPOINT_URL=http://127.0.0.1:8001/ LDS_BASE=http://127.0.0.1:8002/api AZURE_OPENAI_API_KEY=fake python app.py
+
+Fake Azure OpenAI answers POST /openai/deployments/<name>/chat/completions:
+  - latency: time to first token drawn from a log-normal distribution (median, sigma),
+    then completion tokens at a fixed rate (streamed ones token by token, as SSE)
+  - content: an instance of the request's json_schema; for json_object one object with
+    the keys every route looks for; plain text otherwise. Tool calls at a set rate.
+  - usage, and a final usage chunk on streams that ask for it (stream_options)
+  - injected 429s (with Retry-After), hangs that end in a dropped connection, and 400s
+    rejecting json_schema / stream_options like a deployment that lacks them
+Fake LDS answers every POST/GET with a list of options, with its own latency, 500s and hangs.
+Both keep counters, served at GET /stats.
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+AZURE_DEFAULTS = {
+    "ttft_ms": 300.0,          # median time to first token
+    "jitter": 0.35,            # sigma of the log-normal latency distribution (0 = fixed)
+    "tokens_per_s": 80.0,      # completion token rate
+    "completion_tokens": 120,  # tokens per answer (capped by the request's max_tokens)
+    "tool_call_rate": 0.3,     # share of tool-enabled calls answered with a tool call
+    "rate_429": 0.0,           # share of calls refused with 429
+    "retry_after": 1,          # Retry-After of those 429s (seconds)
+    "timeout_rate": 0.0,       # share of calls that hang, then drop the connection
+    "hang_s": 30.0,            # how long those hang
+    "reject_json_schema": False,
+    "reject_stream_usage": False,
+}
+
+LDS_DEFAULTS = {
+    "latency_ms": 60.0,
+    "jitter": 0.3,
+    "error_rate": 0.0,  # share of calls answered with 500
+    "timeout_rate": 0.0,
+    "hang_s": 35.0,     # longer than the backend's default LDS read timeout
+    "items": 12,        # options per list
+}
+
+WORDS = (
+    "students", "analyse", "evidence", "explain", "model", "design", "inquiry", "data",
+    "compare", "concept", "apply", "lesson", "outcome", "reason", "practice", "evaluate",
+    "context", "learning", "task", "criteria",
+)
+
+
+class FakeServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer with a config dict, a seeded RNG and counters"""
+
+    daemon_threads = True
+
+    def __init__(self, address, handler, config, seed=None):
+        super().__init__(address, handler)
+        self.config = config
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def random(self):
+        with self._lock:
+            return self.rng.random()
+
+    def latency(self, median_ms, sigma):
+        """Seconds, log-normal around median_ms"""
+        with self._lock:
+            z = self.rng.gauss(0.0, 1.0)
+        return median_ms / 1000.0 * math.exp(sigma * z)
+
+    def words(self, n):
+        with self._lock:
+            return " ".join(self.rng.choice(WORDS) for _ in range(max(1, n)))
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is routine under load
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle on, each answer waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            return {}
+
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def hang(self):
+        """Injected timeout: wait, then drop the connection without an answer"""
+        self.server.count("injected_timeouts")
+        time.sleep(self.server.config["hang_s"])
+        self.close_connection = True
+
+    def serve_stats(self):
+        if self.path.rstrip("/") == "/stats":
+            self.send_json(200, self.server.snapshot())
+            return True
+        return False
+
+
+# =========================
+# Fake Azure OpenAI
+# =========================
+def schema_example(schema, text):
+    """An instance of a JSON schema with every string set to text() and arrays at minItems"""
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: schema_example(prop, text) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [schema_example(schema.get("items", {}), text) for _ in range(schema.get("minItems", 0))]
+    if kind == "string":
+        return text()
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return True
+    return None
+
+
+def count_strings(schema):
+    counter = [0]
+
+    def text():
+        counter[0] += 1
+        return ""
+    schema_example(schema, text)
+    return counter[0]
+
+
+def estimate_tokens(messages):
+    chars = 0
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            chars += sum(len(part.get("text", "")) for part in content if isinstance(part, dict))
+        chars += len(json.dumps(message.get("tool_calls") or ""))
+    return max(1, chars // 4) + 4 * len(messages or [])
+
+
+class FakeAzureHandler(FakeHandler):
+
+    def do_GET(self):
+        if not self.serve_stats():
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        server, config = self.server, self.server.config
+        body = self.read_json()
+        if "/chat/completions" not in self.path:
+            self.send_json(404, {"error": {"code": "404", "message": "Resource not found"}})
+            return
+        server.count("calls")
+
+        draw = server.random()
+        if draw < config["rate_429"]:
+            server.count("injected_429")
+            self.send_json(429, {"error": {
+                "code": "429",
+                "message": "Requests to the ChatCompletions_Create Operation have exceeded the rate limit.",
+            }}, headers={"Retry-After": config["retry_after"]})
+            return
+        if draw < config["rate_429"] + config["timeout_rate"]:
+            self.hang()
+            return
+
+        response_format = body.get("response_format") or {}
+        if config["reject_json_schema"] and response_format.get("type") == "json_schema":
+            server.count("rejected")
+            self.send_json(400, {"error": {
+                "code": "BadRequest", "param": "response_format", "type": "invalid_request_error",
+                "message": "Invalid parameter: 'response_format' of type 'json_schema' is not supported with this model.",
+            }})
+            return
+        if config["reject_stream_usage"] and "stream_options" in body:
+            server.count("rejected")
+            self.send_json(400, {"error": {
+                "code": "BadRequest", "param": "stream_options", "type": "invalid_request_error",
+                "message": "Unrecognized request argument supplied: stream_options",
+            }})
+            return
+
+        messages = body.get("messages") or []
+        prompt_tokens = estimate_tokens(messages)
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or config["completion_tokens"]
+        target = max(1, min(int(config["completion_tokens"]), int(max_tokens)))
+        tool_call = None
+        if body.get("tools") and body.get("tool_choice") != "none" \
+                and not any(m.get("role") == "tool" for m in messages) \
+                and server.random() < config["tool_call_rate"]:
+            tool_call = {
+                "id": f"call_{int(server.random() * 1e9)}",
+                "type": "function",
+                "function": {"name": body["tools"][0]["function"]["name"], "arguments": "{}"},
+            }
+            server.count("tool_calls")
+            content, completion_tokens = None, 12
+        else:
+            content, completion_tokens = self.content(response_format, target), target
+        server.count("prompt_tokens", prompt_tokens)
+        server.count("completion_tokens", completion_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+        time.sleep(server.latency(config["ttft_ms"], config["jitter"]))
+        if body.get("stream"):
+            server.count("streamed")
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self.stream(body, content, tool_call, usage if include_usage else None)
+            return
+        time.sleep(completion_tokens / config["tokens_per_s"])
+        message = {"role": "assistant", "content": content}
+        if tool_call:
+            message["tool_calls"] = [tool_call]
+        self.send_json(200, {
+            "id": f"chatcmpl-fake-{int(server.random() * 1e12)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model") or "fake",
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_call else "stop"}],
+            "usage": usage,
+        })
+
+    def content(self, response_format, target):
+        """Answer text of about `target` tokens (one word each) in the requested format"""
+        server = self.server
+        kind = response_format.get("type")
+        if kind == "json_schema":
+            schema = (response_format.get("json_schema") or {}).get("schema") or {}
+            per_string = max(3, target // max(1, count_strings(schema)))
+            return json.dumps(schema_example(schema, lambda: server.words(per_string)), ensure_ascii=False)
+        if kind == "json_object":
+            # No schema to follow: one object with what each route's parser looks for
+            per_string = max(3, target // 12)
+            return json.dumps({
+                "chat_message_reply": {"text": server.words(per_string * 4)},
+                "actions": [],
+                "questions": [server.words(per_string) for _ in range(3)],
+                "ilos": [{"statement": server.words(per_string)} for _ in range(3)],
+                "recommended_dp": server.words(3),
+                "reason": server.words(per_string),
+            }, ensure_ascii=False)
+        return server.words(target)
+
+    def write_chunk(self, data):
+        payload = f"data: {data}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+        self.wfile.flush()
+
+    def stream(self, body, content, tool_call, usage):
+        """SSE chat.completion.chunk events, chunked transfer encoding"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        base = {
+            "id": f"chatcmpl-fake-{int(self.server.random() * 1e12)}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model") or "fake",
+        }
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps(dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}]))
+
+        try:
+            # Azure's first chunk: prompt filter results, no choices
+            self.write_chunk(json.dumps(dict(base, choices=[], prompt_filter_results=[])))
+            self.write_chunk(chunk({"role": "assistant", "content": ""}))
+            if tool_call:
+                self.write_chunk(chunk({"tool_calls": [dict(tool_call, index=0)]}))
+                self.write_chunk(chunk({}, "tool_calls"))
+            else:
+                interval = 1.0 / self.server.config["tokens_per_s"]
+                pieces = content.split(" ")
+                for i, piece in enumerate(pieces):
+                    time.sleep(interval)
+                    self.write_chunk(chunk({"content": piece if i == 0 else " " + piece}))
+                self.write_chunk(chunk({}, "stop"))
+            if usage:
+                self.write_chunk(json.dumps(dict(base, choices=[], usage=usage)))
+            self.write_chunk("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+# =========================
+# Fake LDS API
+# =========================
+class FakeLDSHandler(FakeHandler):
+
+    def do_GET(self):
+        if not self.serve_stats():
+            self.answer({})
+
+    def do_POST(self):
+        self.answer(self.read_json())
+
+    def answer(self, body):
+        server, config = self.server, self.server.config
+        server.count("calls")
+        draw = server.random()
+        if draw < config["error_rate"]:
+            server.count("injected_errors")
+            self.send_json(500, {"message": "Server Error"})
+            return
+        if draw < config["error_rate"] + config["timeout_rate"]:
+            self.hang()
+            return
+        time.sleep(server.latency(config["latency_ms"], config["jitter"]))
+        name = self.path.rstrip("/").rsplit("/", 1)[-1]
+        locale = body.get("locale") if isinstance(body, dict) else None
+        self.send_json(200, [
+            {"id": i, "name": f"{name} {i}", "value": f"{name}-{i}", "locale": locale or "zh_HK"}
+            for i in range(1, int(config["items"]) + 1)
+        ])
+
+
+# =========================
+# Starting and configuring
+# =========================
+def start(kind, config=None, host="127.0.0.1", port=0, seed=None):
+    """Start a fake ("azure" or "lds") in a daemon thread; returns the server (see .url, .snapshot())"""
+    handler, defaults = {"azure": (FakeAzureHandler, AZURE_DEFAULTS), "lds": (FakeLDSHandler, LDS_DEFAULTS)}[kind]
+    server = FakeServer((host, port), handler, dict(defaults, **(config or {})), seed=seed)
+    threading.Thread(target=server.serve_forever, name=f"fake-{kind}", daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    """--azure-* and --lds-* options for each AZURE_DEFAULTS / LDS_DEFAULTS entry"""
+    for prefix, defaults in (("azure", AZURE_DEFAULTS), ("lds", LDS_DEFAULTS)):
+        group = parser.add_argument_group(f"fake {prefix.upper()}")
+        for name, default in defaults.items():
+            flag = f"--{prefix}-{name.replace('_', '-')}"
+            if isinstance(default, bool):
+                group.add_argument(flag, dest=f"{prefix}_{name}", action="store_true")
+            else:
+                group.add_argument(flag, dest=f"{prefix}_{name}", type=type(default), default=default,
+                                   help=f"(default: {default})")
+
+
+def configs_from_args(args):
+    """(azure_config, lds_config) from add_arguments() options"""
+    return tuple(
+        {name: getattr(args, f"{prefix}_{name}") for name in defaults}
+        for prefix, defaults in (("azure", AZURE_DEFAULTS), ("lds", LDS_DEFAULTS))
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run fake Azure OpenAI and LDS servers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--azure-port", type=int, default=8001)
+    parser.add_argument("--lds-port", type=int, default=8002)
+    parser.add_argument("--seed", type=int, default=None)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    azure_config, lds_config = configs_from_args(args)
+    azure = start("azure", azure_config, args.host, args.azure_port, args.seed)
+    lds = start("lds", lds_config, args.host, args.lds_port, args.seed)
+    print(f"ENDPOINT_URL={azure.url}/")
+    print(f"LDS_BASE={lds.url}/api")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,212 @@
+"""
+Record/replay cassettes for upstream traffic: Azure OpenAI chat completions and LDS API calls.
+
+Recording (CASSETTE_MODE=record) appends every call to JSONL files in CASSETTE_DIR, one file
+per kind and process (azure-<pid>.jsonl, lds-<pid>.jsonl):
+    {"kind": "azure", "key": "<sha256>", "shape": "/api/chat suggestions json_object",
+     "duration": 0.81, "response": {...chat.completion...}}          (streamed: "chunks": [[offset_s, chunk], ...])
+    {"kind": "lds", "key": "<sha256>", "shape": "POST /api/chatbot/options/courses/subjects",
+     "duration": 0.12, "status": 200, "content_type": "application/json", "body": "..."}
+Requests are only stored as the hash of their content, so prompts and LDS request bodies never
+reach the files; values under secret-looking keys (token, password, api_key, ...) in the
+recorded responses are redacted. Failed calls (exceptions) are not recorded.
+
+Replaying (CASSETTE_MODE=replay) answers from the files without touching the network. A call
+is matched by its hash, several recordings of the same request being played in turn. With
+match="shape" a call with no exact recording gets one of the same shape instead (route, stage
+and response format for Azure; endpoint for LDS), for replaying traffic whose prompts differ.
+replay_timing=True sleeps for the recorded latencies (chunk by chunk for streams).
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+try:
+    from openai.types.chat import ChatCompletion, ChatCompletionChunk
+except ImportError:
+    ChatCompletion = ChatCompletionChunk = None
+
+
+SECRET_KEY_RE = re.compile(r"token|secret|passw|api[-_]?key|authorization|cookie|credential", re.IGNORECASE)
+REDACTED = "[REDACTED]"
+
+
+class CassetteMiss(LookupError):
+    """Replay has no recording for a request"""
+
+
+def redact(value):
+    """value with everything under secret-looking keys replaced by REDACTED"""
+    if isinstance(value, dict):
+        return {
+            k: REDACTED if SECRET_KEY_RE.search(str(k)) and v not in (None, "") else redact(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+
+def redact_text(text):
+    """A JSON body redacted key by key; other text unchanged"""
+    try:
+        return json.dumps(redact(json.loads(text)), ensure_ascii=False)
+    except ValueError:
+        return text
+
+
+def request_key(*parts):
+    """sha256 of the parts as canonical JSON"""
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def url_path(url):
+    """The path of an LDS URL, so recordings replay whatever LDS_BASE points at"""
+    return urlsplit(url).path
+
+
+class Cassettes:
+    """Recorder / player for one process; mode is "" (off), "record" or "replay"."""
+
+    def __init__(self, directory, mode="", replay_timing=False, match="exact"):
+        if mode not in ("", "record", "replay"):
+            raise ValueError(f"cassette mode must be record or replay, not {mode!r}")
+        if match not in ("exact", "shape"):
+            raise ValueError(f"cassette match must be exact or shape, not {match!r}")
+        self.directory = directory
+        self.mode = mode
+        self.replay_timing = replay_timing
+        self.match = match
+        self._lock = threading.Lock()
+        self._files = {}  # kind -> (pid, file)
+        self._recordings = None  # kind -> {"key": {key: [entry]}, "shape": {shape: [entry]}}
+        self._turns = {}  # id(entry list) -> recordings of it played so far
+        self._stats = {"recorded": 0, "replayed": 0, "shape_matches": 0, "misses": 0}
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    # ---- recording ----
+    def _file(self, kind):
+        # One file per process: forked workers never interleave their lines
+        pid = os.getpid()
+        current = self._files.get(kind)
+        if current is None or current[0] != pid:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{kind}-{pid}.jsonl")
+            current = self._files[kind] = (pid, open(path, "a", encoding="utf-8"))
+        return current[1]
+
+    def record(self, kind, key, shape, duration, **fields):
+        entry = {"kind": kind, "key": key, "shape": shape, "duration": round(duration, 4),
+                 "recorded_at": time.time(), **fields}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            f = self._file(kind)
+            f.write(line)
+            f.flush()
+            self._stats["recorded"] += 1
+
+    def record_completion(self, key, shape, completion, duration):
+        self.record("azure", key, shape, duration, response=completion.model_dump(mode="json"))
+
+    def recording_stream(self, key, shape, stream, started):
+        """Pass a streamed completion through, recording its chunks once it has been read to the end"""
+        chunks = []
+        for chunk in stream:
+            chunks.append([round(time.perf_counter() - started, 4), chunk.model_dump(mode="json")])
+            yield chunk
+        self.record("azure", key, shape, time.perf_counter() - started, chunks=chunks)
+
+    async def recording_stream_async(self, key, shape, stream, started):
+        chunks = []
+        async for chunk in stream:
+            chunks.append([round(time.perf_counter() - started, 4), chunk.model_dump(mode="json")])
+            yield chunk
+        self.record("azure", key, shape, time.perf_counter() - started, chunks=chunks)
+
+    def record_lds(self, key, shape, status, text, content_type, duration):
+        self.record("lds", key, shape, duration, status=status, content_type=content_type, body=redact_text(text))
+
+    # ---- replaying ----
+    def _load(self):
+        with self._lock:
+            if self._recordings is not None:
+                return self._recordings
+            recordings = {}
+            for path in sorted(glob.glob(os.path.join(self.directory, "*.jsonl"))):
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue  # a line cut short when the recording process died
+                        index = recordings.setdefault(entry.get("kind"), {"key": {}, "shape": {}})
+                        index["key"].setdefault(entry.get("key"), []).append(entry)
+                        index["shape"].setdefault(entry.get("shape"), []).append(entry)
+            self._recordings = recordings
+            return recordings
+
+    def lookup(self, kind, key, shape):
+        """The recording to answer a call with; raises CassetteMiss"""
+        index = self._load().get(kind, {"key": {}, "shape": {}})
+        with self._lock:
+            entries = index["key"].get(key)
+            if not entries and self.match == "shape":
+                entries = index["shape"].get(shape)
+                if entries:
+                    self._stats["shape_matches"] += 1
+            if not entries:
+                self._stats["misses"] += 1
+                raise CassetteMiss(f"No {kind} recording in {self.directory} for {shape} ({key[:12]})")
+            turn = self._turns.get(id(entries), 0)
+            self._turns[id(entries)] = turn + 1
+            self._stats["replayed"] += 1
+            return entries[turn % len(entries)]
+
+    def delay(self, seconds):
+        """Seconds to wait to reproduce a recorded latency (0 unless replay_timing)"""
+        return max(0.0, seconds) if self.replay_timing else 0.0
+
+    @staticmethod
+    def completion_from(entry):
+        return ChatCompletion.model_validate(entry["response"])
+
+    def chunks_from(self, entry):
+        """[(seconds to wait, ChatCompletionChunk)] of a recorded stream"""
+        chunks, previous = [], 0.0
+        for offset, chunk in entry["chunks"]:
+            chunks.append((self.delay(offset - previous), ChatCompletionChunk.model_validate(chunk)))
+            previous = offset
+        return chunks
+
+    def replay_azure(self, key, shape):
+        """
+        The recorded answer to an Azure OpenAI call, as (seconds to wait, answer): a
+        ChatCompletion, or for a streamed call the chunks_from() list (which carries its own delays)
+        """
+        entry = self.lookup("azure", key, shape)
+        if "chunks" in entry:
+            return 0.0, self.chunks_from(entry)
+        return self.delay(entry["duration"]), self.completion_from(entry)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, mode=self.mode, directory=self.directory, match=self.match)
+            if self._recordings is not None:
+                stats["loaded"] = {
+                    kind: sum(len(entries) for entries in index["key"].values())
+                    for kind, index in self._recordings.items()
+                }
+            return stats
@@ -0,0 +1,559 @@
+"""
+Text extraction for uploaded documents (PDF, DOCX, TXT), and a process pool that
+runs it outside the web worker.
+
+Parsing is pure Python and CPU-bound; in the request thread it holds the GIL and
+stalls every other request on the worker. DocumentParserPool runs each job in a
+separate parser process with a timeout (a stuck process is killed and replaced)
+and an optional memory cap. A parser process runs this file as a script
+(`document_parser.py --serve FD MEMORY_MB`), so it loads this module and its
+parsers only: not app.py, which multiprocessing's spawn and forkserver start
+methods would re-import (module-level side effects included) when the app runs
+as `python app.py`. This module must therefore not import app.py either.
+
+Uploads are handed over as files, never read into memory whole: a parser process
+gets the path of the spooled upload and memory-maps it.
+"""
+import codecs
+import contextlib
+import hashlib
+import io
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from xml.etree import ElementTree
+
+try:
+    import PyPDF2
+    PDF_AVAILABLE = True
+except ImportError:
+    PDF_AVAILABLE = False
+    print("Warning: PyPDF2 not available. PDF parsing will be disabled.")
+
+try:
+    import resource  # POSIX only; no memory cap elsewhere
+except ImportError:
+    resource = None
+
+
+WORDML_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MARKUP_COMPATIBILITY_NS = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+
+MEMORY_ERROR = "文件過大：解析時超出記憶體上限"
+
+# Bump whenever extract_text() output changes, to invalidate ExtractedTextCache entries
+EXTRACTOR_VERSION = "1"
+
+# Uploads up to this size are sent to a parser process as bytes; larger ones by path
+INLINE_UPLOAD_BYTES = 256 * 1024
+SNIFF_BYTES = 8 * 1024
+COPY_BLOCK_BYTES = 1024 * 1024
+
+
+def iter_pdf_text(file):
+    """Text of each PDF page; pages are only parsed when reached"""
+    for page in PyPDF2.PdfReader(file).pages:
+        yield (page.extract_text() or "") + "\n"
+
+
+def iter_docx_text(file):
+    """
+    Text of each DOCX paragraph (tables and text boxes included), streamed from
+    word/document.xml so the rest of the document is never parsed.
+    """
+    with zipfile.ZipFile(file) as package:
+        with package.open("word/document.xml") as xml:
+            fallback_depth = 0  # text boxes are stored twice; skip the mc:Fallback copy
+            for event, elem in ElementTree.iterparse(xml, events=("start", "end")):
+                if elem.tag == MARKUP_COMPATIBILITY_NS + "Fallback":
+                    fallback_depth += 1 if event == "start" else -1
+                elif event == "end" and elem.tag == WORDML_NS + "p":
+                    if not fallback_depth:
+                        parts = []
+                        for node in elem.iter():
+                            if node.tag == WORDML_NS + "t":
+                                parts.append(node.text or "")
+                            elif node.tag == WORDML_NS + "tab":
+                                parts.append("\t")
+                            elif node.tag in (WORDML_NS + "br", WORDML_NS + "cr"):
+                                parts.append("\n")
+                        yield "".join(parts) + "\n"
+                    elem.clear()
+
+
+def iter_txt_text(file, chunk_size=64 * 1024):
+    """UTF-8 text in chunks (invalid bytes dropped)"""
+    file.seek(0)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            break
+        yield decoder.decode(data)
+    yield decoder.decode(b"", final=True)
+
+
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+# =========================
+# Upload files
+# =========================
+def upload_stream(file):
+    """The underlying file object (werkzeug's FileStorage wraps the spooled file)"""
+    return getattr(file, "stream", file)
+
+
+def upload_size(file):
+    stream = upload_stream(file)
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def upload_path(file):
+    """Path of an upload spooled to a named file on disk, or None"""
+    stream = upload_stream(file)
+    name = getattr(stream, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        stream.flush()
+        return name
+    return None
+
+
+def sniff_file_type(file, filename):
+    """
+    Check the first bytes of an upload against its extension before any parsing.
+    Returns an error message, or None if the file looks like what it claims to be.
+    """
+    file_ext = file_extension(filename)
+    stream = upload_stream(file)
+    stream.seek(0)
+    head = stream.read(SNIFF_BYTES)
+    stream.seek(0)
+
+    if not head:
+        return "文件為空"
+    if file_ext == 'pdf':
+        # The PDF header must start within the first 1024 bytes
+        if b"%PDF-" not in head[:1024]:
+            return "文件內容不是有效的 PDF"
+    elif file_ext in ['doc', 'docx']:
+        if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+            return "不支援舊版 Word (.doc) 格式，請另存為 .docx 後再上傳"
+        if not head.startswith(b"PK\x03\x04"):
+            return "文件內容不是有效的 DOCX"
+    elif file_ext == 'txt':
+        if b"\x00" in head:
+            return "文字文件需為 UTF-8 編碼"
+    else:
+        return f"不支援的文件格式: {file_ext}"
+    return None
+
+
+@contextlib.contextmanager
+def mapped_file(path):
+    """Read-only file object for `path`, memory-mapped so pages load only when read"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield io.BytesIO()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+@contextlib.contextmanager
+def spooled_path(file, directory=None):
+    """
+    Path of the upload on disk: its own path if it was spooled to a named file,
+    else a temporary copy (removed on exit), copied in blocks.
+    """
+    path = upload_path(file)
+    if path is not None:
+        yield path
+        return
+    stream = upload_stream(file)
+    stream.seek(0)
+    with tempfile.NamedTemporaryFile("wb", prefix="lds-upload-", dir=directory, delete=False) as copy:
+        shutil.copyfileobj(stream, copy, COPY_BLOCK_BYTES)
+    try:
+        yield copy.name
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(copy.name)
+
+
+def extract_text(file, filename, max_chars=None):
+    """
+    Extract text content from uploaded file
+    Supports PDF, DOCX, TXT formats
+    Pages/paragraphs are read in order and reading stops once more than `max_chars`
+    characters are collected, so a large file is only parsed as far as it is used.
+    Returns (text, error).
+    """
+    file_ext = file_extension(filename)
+
+    if file_ext == 'pdf':
+        if not PDF_AVAILABLE:
+            return None, "PDF 解析庫未安裝。請運行以下命令安裝：pip install PyPDF2"
+        chunks, error_label = iter_pdf_text(file), "PDF 解析錯誤"
+    elif file_ext in ['doc', 'docx']:
+        chunks, error_label = iter_docx_text(file), "DOCX 解析錯誤"
+    elif file_ext == 'txt':
+        chunks, error_label = iter_txt_text(file), "TXT 讀取錯誤"
+    else:
+        return None, f"不支援的文件格式: {file_ext}"
+
+    parts = []
+    collected = 0
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            collected += len(chunk)
+            if max_chars is not None and collected > max_chars:
+                break
+    except MemoryError:
+        return None, MEMORY_ERROR
+    except Exception as e:
+        return None, f"{error_label}: {str(e)}"
+    finally:
+        chunks.close()
+    return "".join(parts), None
+
+
+# =========================
+# Parser processes
+# =========================
+def parser_process_main(conn, memory_mb):
+    """
+    Parser process loop: receive (source, filename, max_chars), send back (text, error).
+    `source` is ("bytes", data) for small uploads or ("path", path) for spooled ones.
+    """
+    if memory_mb and resource is not None:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        (kind, source), filename, max_chars = job
+        try:
+            if kind == "path":
+                with mapped_file(source) as file:
+                    result = extract_text(file, filename, max_chars)
+            else:
+                result = extract_text(io.BytesIO(source), filename, max_chars)
+        except MemoryError:
+            result = (None, MEMORY_ERROR)
+        except OSError as e:
+            result = (None, f"文件讀取錯誤: {e}")
+        conn.send(result)
+
+
+class _ParserProcess:
+    """
+    One parser process: on POSIX, this file run as a script on one end of a socketpair;
+    elsewhere (no descriptor passing) a multiprocessing spawn child.
+    """
+
+    def __init__(self, memory_mb):
+        if os.name == "posix":
+            parent_sock, child_sock = socket.socketpair()
+            with child_sock:
+                self.process = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), "--serve", str(child_sock.fileno()), str(memory_mb or 0)],
+                    pass_fds=(child_sock.fileno(),),
+                    stdin=subprocess.DEVNULL,
+                )
+            self.conn = multiprocessing.connection.Connection(parent_sock.detach())
+        else:
+            context = multiprocessing.get_context("spawn")
+            self.conn, child_conn = context.Pipe()
+            self.process = context.Process(
+                target=parser_process_main,
+                args=(child_conn, memory_mb),
+                name="document-parser",
+                daemon=True,
+            )
+            self.process.start()
+            child_conn.close()
+        self.jobs = 0
+
+    def _wait(self, timeout):
+        """True once the process has exited"""
+        if isinstance(self.process, subprocess.Popen):
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                return False
+            return True
+        self.process.join(timeout)
+        return not self.process.is_alive()
+
+    def stop(self, kill=False):
+        try:
+            if not kill:
+                self.conn.send(None)
+                if self._wait(1):
+                    return
+            self.process.kill()
+            self._wait(1)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.conn.close()
+
+
+class DocumentParserPool:
+    """
+    Bounded pool of parser processes (spawned on first use, then reused).
+      - at most `workers` jobs run at once; a job waits up to `timeout` for a free process
+      - a job that takes longer than `timeout` seconds has its process killed
+      - each process is capped at `memory_mb` of address space (POSIX) and replaced
+        after `max_jobs` jobs
+    workers=0 parses in the calling thread (no isolation).
+    Uploads larger than INLINE_UPLOAD_BYTES are passed by path (copied to `spool_dir`
+    first if the upload is not already a named file), so they are never held in memory.
+    """
+
+    def __init__(self, workers=2, timeout=20.0, memory_mb=512, max_jobs=100, spool_dir=None):
+        self.workers = max(0, workers)
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.max_jobs = max_jobs
+        self.spool_dir = spool_dir
+        self._slots = threading.BoundedSemaphore(max(1, self.workers))
+        self._idle = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._stats = {"jobs": 0, "timeouts": 0, "crashes": 0, "rejected": 0, "processes_started": 0}
+        self._formats = {}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _record(self, file_ext, seconds, error):
+        with self._lock:
+            stats = self._formats.setdefault(
+                file_ext or "unknown",
+                {"jobs": 0, "errors": 0, "seconds_total": 0.0, "seconds_max": 0.0},
+            )
+            stats["jobs"] += 1
+            stats["errors"] += 1 if error else 0
+            stats["seconds_total"] += seconds
+            stats["seconds_max"] = max(stats["seconds_max"], seconds)
+            self._stats["jobs"] += 1
+
+    def _checkout(self):
+        with self._lock:
+            self._busy += 1
+            if self._idle:
+                return self._idle.pop()
+        try:
+            worker = _ParserProcess(self.memory_mb)
+        except Exception:
+            with self._lock:
+                self._busy -= 1
+            raise
+        self._count("processes_started")
+        return worker
+
+    def _checkin(self, worker, healthy=True):
+        worker.jobs += 1
+        retire = not healthy or worker.jobs >= self.max_jobs
+        with self._lock:
+            self._busy -= 1
+            if not retire:
+                self._idle.append(worker)
+        if retire:
+            worker.stop(kill=not healthy)
+
+    def extract(self, file, filename, max_chars=None):
+        """extract_text() in a parser process; returns (text, error)"""
+        file_ext = file_extension(filename)
+        started = time.perf_counter()
+        if self.workers == 0:
+            result = extract_text(file, filename, max_chars)
+            self._record(file_ext, time.perf_counter() - started, result[1])
+            return result
+
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count("rejected")
+            return None, "文件解析服務繁忙，請稍後再試"
+        try:
+            with contextlib.ExitStack() as stack:
+                if upload_size(file) <= INLINE_UPLOAD_BYTES:
+                    source = ("bytes", upload_stream(file).read())
+                else:
+                    source = ("path", stack.enter_context(spooled_path(file, self.spool_dir)))
+                result = self._run(source, filename, max_chars)
+        finally:
+            self._slots.release()
+
+        self._record(file_ext, time.perf_counter() - started, result[1])
+        return result
+
+    def _run(self, source, filename, max_chars):
+        worker = self._checkout()
+        healthy = False
+        try:
+            worker.conn.send((source, filename, max_chars))
+            if worker.conn.poll(self.timeout):
+                result = worker.conn.recv()
+                healthy = True
+            else:
+                self._count("timeouts")
+                result = (None, f"文件解析逾時（超過 {self.timeout:g} 秒），文件可能已損壞或過於複雜")
+        except (EOFError, OSError):
+            # The parser process died, e.g. it hit the memory cap
+            self._count("crashes")
+            result = (None, "文件解析失敗：解析程序異常終止（文件可能過大或已損壞）")
+        finally:
+            self._checkin(worker, healthy)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "workers": self.workers,
+                "busy": self._busy,
+                "idle": len(self._idle),
+                "utilisation": round(self._busy / self.workers, 2) if self.workers else None,
+                "timeout": self.timeout,
+                "memory_mb": self.memory_mb,
+                "formats": {
+                    ext: dict(s, seconds_total=round(s["seconds_total"], 3),
+                              seconds_max=round(s["seconds_max"], 3),
+                              seconds_avg=round(s["seconds_total"] / s["jobs"], 3) if s["jobs"] else 0.0)
+                    for ext, s in self._formats.items()
+                },
+            })
+        return stats
+
+
+# =========================
+# Extracted text cache
+# =========================
+class ExtractedTextCache:
+    """
+    Extracted text keyed by SHA-256 of the uploaded bytes (plus file type, text budget
+    and EXTRACTOR_VERSION), in a SQLite file shared by all workers on the host.
+    Least recently used entries are evicted once the stored text exceeds `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS extracted_texts "
+                "(key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS extracted_texts_last_used ON extracted_texts (last_used)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    @staticmethod
+    def key(file, filename, max_chars):
+        """Cache key for an upload; the file is hashed in blocks, not read whole"""
+        stream = upload_stream(file)
+        stream.seek(0)
+        sha = hashlib.sha256()
+        for block in iter(lambda: stream.read(COPY_BLOCK_BYTES), b""):
+            sha.update(block)
+        stream.seek(0)
+        digest = sha.hexdigest()
+        return f"{digest}:{file_extension(filename)}:{max_chars}:v{EXTRACTOR_VERSION}"
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT text FROM extracted_texts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._count("misses")
+                return None
+            conn.execute("UPDATE extracted_texts SET last_used = ? WHERE key = ?", (time.time(), key))
+        self._count("hits")
+        return row[0]
+
+    def put(self, key, text):
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO extracted_texts (key, text, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, text, size, time.time()),
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM extracted_texts").fetchone()[0]
+            if total > self.max_bytes:
+                evict = []
+                for old_key, old_size in conn.execute(
+                    "SELECT key, size FROM extracted_texts ORDER BY last_used"
+                ):
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((old_key,))
+                    total -= old_size
+                conn.executemany("DELETE FROM extracted_texts WHERE key = ?", evict)
+                self._count("evictions", len(evict))
+        self._count("writes")
+
+    def stats(self):
+        stats = {"path": self.path, "max_bytes": self.max_bytes}
+        with self._lock:
+            stats.update(self._stats)
+        try:
+            entries, size = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extracted_texts"
+            ).fetchone()
+            stats.update(entries=entries, bytes=size)
+        except sqlite3.Error as e:
+            stats["error"] = str(e)
+        return stats
+
+
+if __name__ == "__main__":
+    # A parser process started by _ParserProcess: document_parser.py --serve FD MEMORY_MB
+    if len(sys.argv) != 4 or sys.argv[1] != "--serve":
+        sys.exit("usage: document_parser.py --serve FD MEMORY_MB (started by DocumentParserPool)")
+    # Ctrl-C reaches the whole process group; the pool stops its parser processes itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parser_process_main(multiprocessing.connection.Connection(int(sys.argv[2])), int(sys.argv[3]))
@@ -167,6 +167,8 @@ export default function App() {
   const [inputValue, setInputValue] = useState("");
   const [messages, setMessages] = useState([]);
   const greetedRef = useRef(false);
+  // Server-side conversation session (history is only sent until the server assigns one)
+  const conversationIdRef = useRef(null);
   
   // Subject-related state
   const [subjects, setSubjects] = useState([]);
@@ -259,107 +261,33 @@ export default function App() {
     el.style.height = Math.min(el.scrollHeight, 120) + "px";
   }, [inputValue]);
 
-  // Load subjects list
+  // Load all option lists (subjects, grade levels, ILO categories, ILO patterns, Bloom levels)
+  // with a single /api/bootstrap call; the backend fetches them from LDS in parallel
   useEffect(() => {
     let cancelled = false;
 
-    async function loadSubjects() {
-      setIsLoadingSubjects(true);
+    const setters = {
+      subjects: setSubjects,
+      grade_levels: setGradeLevels,
+      ilo_categories: setIloCategories,
+      ilo_patterns: setIloPatterns,
+      bloom_taxonomy_levels: setBloomLevels
+    };
+    const loadingSetters = [
+      setIsLoadingSubjects,
+      setIsLoadingGradeLevels,
+      setIsLoadingCategories,
+      setIsLoadingPatterns,
+      setIsLoadingBloomLevels
+    ];
+
+    async function loadBootstrap() {
+      loadingSetters.forEach(setLoading => setLoading(true));
       try {
-        const url = `${API_BASE_URL}/api/subjects?locale=zh_HK`;
-        console.log("Loading subjects from:", url);
+        const url = `${API_BASE_URL}/api/bootstrap?locale=zh_HK`;
+        console.log("Loading option lists from:", url);
         console.log("API_BASE_URL value:", API_BASE_URL);
-        
-        // Try using POST (because LDS API chatbot/options endpoints usually use POST)
-        const resp = await fetch(url, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ locale: "zh_HK" })
-        });
-
-        if (cancelled) return;
-
-        console.log("Subjects API response status:", resp.status, resp.statusText);
-
-        let data;
-        try {
-          const text = await resp.text();
-          console.log("Raw response text (first 200 chars):", text.substring(0, 200));
-          data = JSON.parse(text);
-        } catch (err) {
-          console.error("Failed to parse JSON:", err);
-          console.error("Response status:", resp.status);
-          console.error("Response headers:", Object.fromEntries(resp.headers.entries()));
-          data = { error: "無法解析 JSON 回應", details: err.message };
-        }
-
-        console.log("Subjects API response data:", data);
-
-        if (resp.ok) {
-          if (Array.isArray(data)) {
-            console.log(`Successfully loaded ${data.length} subjects`);
-            setSubjects(data);
-            // Default to select first subject (if none currently selected)
-            setSelectedSubjectId(prev => {
-              if (prev === null && data.length > 0) {
-                return data[0].id;
-              }
-              return prev;
-            });
-          } else {
-            console.error("Subjects API returned non-array:", data);
-            // If returned is not an array, might be error message
-            if (data.error) {
-              console.error("LDS API error:", data.error, data.details);
-              setSubjects([]); // Ensure set to empty array
-            } else {
-              console.error("Unknown data format:", typeof data, data);
-              setSubjects([]); // Unknown format, set to empty array
-            }
-          }
-        } else {
-          // Backend returned error
-          const errorMsg = data.error || `HTTP ${resp.status}`;
-          const errorDetails = data.details || "";
-          console.error("Failed to load subjects:", errorMsg, errorDetails);
-          console.error("Full error response:", data);
-          setSubjects([]); // Set to empty array on error
-          
-          // If 503 or connection error, might be LDS API issue
-          if (resp.status === 503 || resp.status === 504 || errorMsg.includes("connect") || errorMsg.includes("timeout")) {
-            console.error("⚠️ LDS API 連接問題，請檢查：");
-            console.error("  1. LDS_BASE 環境變數是否正確設置");
-            console.error("  2. LDS_TOKEN 環境變數是否正確設置（如果需要）");
-            console.error("  3. LDS API 服務器是否可訪問");
-          }
-        }
-      } catch (err) {
-        if (cancelled) return;
-        console.error("Error loading subjects:", err);
-        console.error("Error details:", err.message, err.stack);
-        setSubjects([]); // Set to empty array on network error
-      } finally {
-        if (!cancelled) {
-          setIsLoadingSubjects(false);
-        }
-      }
-    }
-
-    loadSubjects();
-    return () => { cancelled = true; };
-  }, [API_BASE_URL]);
 
-  // Load grade levels list
-  useEffect(() => {
-    let cancelled = false;
-
-    async function loadGradeLevels() {
-      setIsLoadingGradeLevels(true);
-      try {
-        const url = `${API_BASE_URL}/api/grade-levels?locale=zh_HK`;
-        console.log("Loading grade levels from:", url);
-        console.log("API_BASE_URL value:", API_BASE_URL);
-        
         const resp = await fetch(url, {
           method: "POST",
           headers: { "Content-Type": "application/json" },
@@ -368,289 +296,64 @@ export default function App() {
 
         if (cancelled) return;
 
-        console.log("Grade levels API response status:", resp.status, resp.statusText);
+        console.log("Bootstrap API response status:", resp.status, resp.statusText);
 
         let data;
         try {
           const text = await resp.text();
-          console.log("Raw response text (first 200 chars):", text.substring(0, 200));
           data = JSON.parse(text);
         } catch (err) {
           console.error("Failed to parse JSON:", err);
           console.error("Response status:", resp.status);
-          console.error("Response headers:", Object.fromEntries(resp.headers.entries()));
           data = { error: "無法解析 JSON 回應", details: err.message };
         }
 
-        console.log("Grade levels API response data:", data);
-
-        if (resp.ok) {
-          if (Array.isArray(data)) {
-            console.log(`Successfully loaded ${data.length} grade levels`);
-            setGradeLevels(data);
-            // Default to select first grade level (if none currently selected)
-            setSelectedGradeLevelId(prev => {
-              if (prev === null && data.length > 0) {
-                return data[0].id;
-              }
-              return prev;
-            });
-          } else {
-            console.error("Grade levels API returned non-array:", data);
-            if (data.error) {
-              console.error("LDS API error:", data.error, data.details);
-            }
-            setGradeLevels([]); // Ensure set to empty array
-          }
-        } else {
-          const errorMsg = data.error || `HTTP ${resp.status}`;
-          const errorDetails = data.details || "";
-          console.error("Failed to load grade levels:", errorMsg, errorDetails);
-          console.error("Full error response:", data);
-          setGradeLevels([]); // 錯誤時設置為空數組
-          
-          // 如果是 503 或連接錯誤，可能是 LDS API 問題
-          if (resp.status === 503 || resp.status === 504 || errorMsg.includes("connect") || errorMsg.includes("timeout")) {
-            console.error("⚠️ LDS API 連接問題，請檢查：");
-            console.error("  1. LDS_BASE 環境變數是否正確設置");
-            console.error("  2. LDS_TOKEN 環境變數是否正確設置（如果需要）");
-            console.error("  3. LDS API 服務器是否可訪問");
-          }
-        }
-      } catch (err) {
-        if (cancelled) return;
-        console.error("Error loading grade levels:", err);
-        console.error("Error details:", err.message, err.stack);
-        setGradeLevels([]); // Set to empty array on network error
-      } finally {
-        if (!cancelled) {
-          setIsLoadingGradeLevels(false);
-        }
-      }
-    }
-
-    loadGradeLevels();
-    return () => { cancelled = true; };
-  }, [API_BASE_URL]);
-
-  // Load ILO Categories
-  useEffect(() => {
-    let cancelled = false;
-
-    async function loadIloCategories() {
-      setIsLoadingCategories(true);
-      try {
-        const url = `${API_BASE_URL}/api/ilo-categories?locale=zh_HK`;
-        console.log("Loading ILO categories from:", url);
-        console.log("API_BASE_URL value:", API_BASE_URL);
-        
-        const resp = await fetch(url, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ locale: "zh_HK" })
-        });
-
-        if (cancelled) return;
-
-        console.log("ILO categories API response status:", resp.status, resp.statusText);
-
-        let data;
-        try {
-          const text = await resp.text();
-          console.log("Raw response text (first 200 chars):", text.substring(0, 200));
-          data = JSON.parse(text);
-        } catch (err) {
-          console.error("Failed to parse JSON:", err);
-          console.error("Response status:", resp.status);
-          console.error("Response headers:", Object.fromEntries(resp.headers.entries()));
-          data = { error: "無法解析 JSON 回應", details: err.message };
+        if (!resp.ok || data.error) {
+          console.error("Failed to load option lists:", data.error || `HTTP ${resp.status}`, data.details || "");
+          Object.values(setters).forEach(setList => setList([]));
+          return;
         }
 
-        console.log("ILO categories API response data:", data);
-
-        if (resp.ok) {
-          if (Array.isArray(data)) {
-            console.log(`Successfully loaded ${data.length} ILO categories`);
-            setIloCategories(data);
-          } else {
-            console.error("ILO categories API returned non-array:", data);
-            if (data.error) {
-              console.error("LDS API error:", data.error, data.details);
+        let hasConnectionIssue = false;
+        for (const [section, setList] of Object.entries(setters)) {
+          const entry = data[section] || {};
+          if (entry.error) {
+            console.error(`Failed to load ${section}:`, entry.error);
+            const errorText = String(entry.error);
+            if (errorText.includes("connect") || errorText.toLowerCase().includes("timeout")) {
+              hasConnectionIssue = true;
             }
-            setIloCategories([]); // 確保設置為空數組
-          }
-        } else {
-          const errorMsg = data.error || `HTTP ${resp.status}`;
-          const errorDetails = data.details || "";
-          console.error("Failed to load ILO categories:", errorMsg, errorDetails);
-          console.error("Full error response:", data);
-          setIloCategories([]); // 錯誤時設置為空數組
-          
-          // 如果是 503 或連接錯誤，可能是 LDS API 問題
-          if (resp.status === 503 || resp.status === 504 || errorMsg.includes("connect") || errorMsg.includes("timeout")) {
-            console.error("⚠️ LDS API 連接問題，請檢查：");
-            console.error("  1. LDS_BASE 環境變數是否正確設置");
-            console.error("  2. LDS_TOKEN 環境變數是否正確設置（如果需要）");
-            console.error("  3. LDS API 服務器是否可訪問");
           }
+          const list = Array.isArray(entry.data) ? entry.data : [];
+          console.log(`Loaded ${list.length} ${section}`);
+          setList(list);
         }
-      } catch (err) {
-        if (cancelled) return;
-        console.error("Error loading ILO categories:", err);
-        console.error("Error details:", err.message, err.stack);
-        setIloCategories([]); // Set to empty array on network error
-      } finally {
-        if (!cancelled) {
-          setIsLoadingCategories(false);
-        }
-      }
-    }
-
-    loadIloCategories();
-    return () => { cancelled = true; };
-  }, [API_BASE_URL]);
-
-  // Load ILO Patterns
-  useEffect(() => {
-    let cancelled = false;
-
-    async function loadIloPatterns() {
-      setIsLoadingPatterns(true);
-      try {
-        const url = `${API_BASE_URL}/api/chatbot/patterns/intended-learning-outcomes`;
-        console.log("Loading ILO patterns from:", url);
-        
-        const resp = await fetch(url, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({}) // POST request needs body
-        });
-
-        if (cancelled) return;
-
-        console.log("ILO patterns API response status:", resp.status, resp.statusText);
-
-        let data;
-        try {
-          const text = await resp.text();
-          console.log("Raw response text (first 500 chars):", text.substring(0, 500));
-          data = JSON.parse(text);
-        } catch (err) {
-          console.error("Failed to parse JSON:", err);
-          console.error("Response status:", resp.status);
-          data = { error: "無法解析 JSON 回應", details: err.message };
-        }
-
-        console.log("ILO patterns API response data:", data);
 
-        if (resp.ok) {
-          if (Array.isArray(data)) {
-            console.log(`Successfully loaded ${data.length} ILO patterns`);
-            setIloPatterns(data);
-          } else {
-            console.error("ILO patterns API returned non-array:", data);
-            if (data.error) {
-              console.error("LDS API error:", data.error, data.details);
-            }
-            setIloPatterns([]);
-          }
-        } else {
-          const errorMsg = data.error || `HTTP ${resp.status}`;
-          const errorDetails = data.details || "";
-          console.error("Failed to load ILO patterns:", errorMsg, errorDetails);
-          console.error("Full error response:", data);
-          setIloPatterns([]);
+        // Default to select first subject / grade level (if none currently selected)
+        const subjectList = data.subjects?.data || [];
+        const gradeLevelList = data.grade_levels?.data || [];
+        setSelectedSubjectId(prev => (prev === null && subjectList.length > 0) ? subjectList[0].id : prev);
+        setSelectedGradeLevelId(prev => (prev === null && gradeLevelList.length > 0) ? gradeLevelList[0].id : prev);
+
+        if (hasConnectionIssue) {
+          console.error("⚠️ LDS API 連接問題，請檢查：");
+          console.error("  1. LDS_BASE 環境變數是否正確設置");
+          console.error("  2. LDS_TOKEN 環境變數是否正確設置（如果需要）");
+          console.error("  3. LDS API 服務器是否可訪問");
         }
       } catch (err) {
         if (cancelled) return;
-        console.error("Error loading ILO patterns:", err);
+        console.error("Error loading option lists:", err);
         console.error("Error details:", err.message, err.stack);
-        setIloPatterns([]);
+        Object.values(setters).forEach(setList => setList([])); // Set to empty arrays on network error
       } finally {
         if (!cancelled) {
-          setIsLoadingPatterns(false);
+          loadingSetters.forEach(setLoading => setLoading(false));
         }
       }
     }
 
-    loadIloPatterns();
-    return () => { cancelled = true; };
-  }, [API_BASE_URL]);
-
-  // Load Bloom Taxonomy Levels
-  useEffect(() => {
-    let cancelled = false;
-
-    async function loadBloomLevels() {
-      setIsLoadingBloomLevels(true);
-      try {
-        const url = `${API_BASE_URL}/api/bloom-taxonomy-levels?locale=zh_HK`;
-        console.log("Loading bloom taxonomy levels from:", url);
-        console.log("API_BASE_URL value:", API_BASE_URL);
-        
-        const resp = await fetch(url, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ locale: "zh_HK" })
-        });
-
-        if (cancelled) return;
-
-        console.log("Bloom taxonomy levels API response status:", resp.status, resp.statusText);
-
-        let data;
-        try {
-          const text = await resp.text();
-          console.log("Raw response text (first 200 chars):", text.substring(0, 200));
-          data = JSON.parse(text);
-        } catch (err) {
-          console.error("Failed to parse JSON:", err);
-          console.error("Response status:", resp.status);
-          console.error("Response headers:", Object.fromEntries(resp.headers.entries()));
-          data = { error: "無法解析 JSON 回應", details: err.message };
-        }
-
-        console.log("Bloom taxonomy levels API response data:", data);
-
-        if (resp.ok) {
-          if (Array.isArray(data)) {
-            console.log(`Successfully loaded ${data.length} bloom taxonomy levels`);
-            setBloomLevels(data);
-          } else {
-            console.error("Bloom taxonomy levels API returned non-array:", data);
-            if (data.error) {
-              console.error("LDS API error:", data.error, data.details);
-            }
-            setBloomLevels([]); // 確保設置為空數組
-          }
-        } else {
-          const errorMsg = data.error || `HTTP ${resp.status}`;
-          const errorDetails = data.details || "";
-          console.error("Failed to load bloom taxonomy levels:", errorMsg, errorDetails);
-          console.error("Full error response:", data);
-          setBloomLevels([]); // 錯誤時設置為空數組
-          
-          // 如果是 503 或連接錯誤，可能是 LDS API 問題
-          if (resp.status === 503 || resp.status === 504 || errorMsg.includes("connect") || errorMsg.includes("timeout")) {
-            console.error("⚠️ LDS API 連接問題，請檢查：");
-            console.error("  1. LDS_BASE 環境變數是否正確設置");
-            console.error("  2. LDS_TOKEN 環境變數是否正確設置（如果需要）");
-            console.error("  3. LDS API 服務器是否可訪問");
-          }
-        }
-      } catch (err) {
-        if (cancelled) return;
-        console.error("Error loading bloom taxonomy levels:", err);
-        console.error("Error details:", err.message, err.stack);
-        setBloomLevels([]); // Set to empty array on network error
-      } finally {
-        if (!cancelled) {
-          setIsLoadingBloomLevels(false);
-        }
-      }
-    }
-
-    loadBloomLevels();
+    loadBootstrap();
     return () => { cancelled = true; };
   }, [API_BASE_URL]);
 
@@ -900,15 +603,29 @@ export default function App() {
         }))
         .filter(m => m.content.trim().length > 0);
       
-      requestBody.conversation_history = conversationHistory;
-
-      const resp = await fetch(`${API_BASE_URL}/api/chat`, {
+      const postChat = (body) => fetch(`${API_BASE_URL}/api/chat`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify(requestBody)
+        body: JSON.stringify(body)
       });
 
+      let resp;
+      if (conversationIdRef.current) {
+        resp = await postChat({ ...requestBody, conversation_id: conversationIdRef.current });
+        if (resp.status === 409) {
+          // Session expired on the server: start a new one from the local history
+          conversationIdRef.current = null;
+          resp = null;
+        }
+      }
+      if (!resp) {
+        resp = await postChat({ ...requestBody, conversation_history: conversationHistory });
+      }
+
     const data = await resp.json().catch(() => ({}));
+    if (data?.conversation_id) {
+      conversationIdRef.current = data.conversation_id;
+    }
 
     if (!resp.ok) {
       // Try to extract error text from backend JSON response
@@ -993,6 +710,9 @@ export default function App() {
       if (topic.trim()) {
         formData.append("topic", topic.trim());
       }
+      if (conversationIdRef.current) {
+        formData.append("conversation_id", conversationIdRef.current);
+      }
 
       const resp = await fetch(`${API_BASE_URL}/api/analyze-document`, {
         method: "POST",
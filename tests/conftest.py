@@ -0,0 +1,32 @@
+import os
+import sys
+import types
+
+import pytest
+
+# app.py refuses to start without Azure credentials; the tests never reach Azure
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "test-key")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com/")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace app.py's time module with a clock that only moves on clock.advance()"""
+    import app
+
+    now = [1000.0]
+
+    def advance(seconds):
+        now[0] += seconds
+
+    fake = types.SimpleNamespace(
+        monotonic=lambda: now[0],
+        perf_counter=lambda: now[0],
+        time=lambda: now[0],
+        sleep=advance,
+        advance=advance,
+    )
+    monkeypatch.setattr(app, "time", fake)
+    return fake
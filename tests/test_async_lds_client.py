@@ -0,0 +1,78 @@
+import asyncio
+
+import httpx
+
+import app
+import asgi
+
+
+def test_identical_requests_share_one_upstream_call(monkeypatch):
+    client = asgi.AsyncLDSClient({}, timeouts={"default": 5})
+    calls = []
+
+    async def fake_send(method, url, body, timeout):
+        calls.append((method, url, body))
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json=[{"id": 1}])
+
+    monkeypatch.setattr(client, "_send", fake_send)
+    before = app.lds_client.stats()
+
+    async def run():
+        same = [client.request("POST", "https://lds.example/subjects", route="subjects", json={"locale": "en"})
+                for _ in range(5)]
+        other = client.request("POST", "https://lds.example/subjects", route="subjects", json={"locale": "zh-HK"})
+        return await asyncio.gather(*same, other)
+
+    responses = asyncio.run(run())
+    after = app.lds_client.stats()
+
+    assert len(calls) == 2
+    assert all(resp.json() == [{"id": 1}] for resp in responses)
+    assert after["requests"] - before["requests"] == 2
+    assert after["routes"]["subjects"]["requests"] - before["routes"].get("subjects", {}).get("requests", 0) == 2
+    assert after["single_flight"]["coalesced"] - before["single_flight"]["coalesced"] == 4
+    assert after["single_flight"]["in_flight"] == 0
+
+
+def test_waiters_share_the_leaders_error(monkeypatch):
+    client = asgi.AsyncLDSClient({}, timeouts={"default": 5})
+    calls = []
+
+    async def failing_send(method, url, body, timeout):
+        calls.append(url)
+        await asyncio.sleep(0.05)
+        raise httpx.ConnectError("connection refused")
+
+    monkeypatch.setattr(client, "_send", failing_send)
+
+    async def run():
+        return await asyncio.gather(
+            *(client.request("POST", "https://lds.example/grades", route="grades") for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(isinstance(result, httpx.ConnectError) for result in results)
+
+
+def test_waiter_retries_when_the_leader_is_cancelled():
+    flight = app.AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await waiter
+
+    assert asyncio.run(run()) == 2
+    assert flight.stats() == {"leaders": 2, "coalesced": 1, "in_flight": 0}
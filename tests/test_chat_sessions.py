@@ -0,0 +1,17 @@
+import app
+
+
+def test_build_chat_messages_returns_history_snapshot(monkeypatch):
+    monkeypatch.setattr(app.conversation_store, "put", lambda conversation_id, session: None)
+    session = app.new_session([
+        {"role": "user", "content": "I teach grade 5 science"},
+        {"role": "assistant", "content": "Which topic?"},
+    ])
+
+    _, conversation_history = app.build_chat_messages({}, "Plants", session)
+    before = list(conversation_history)
+    app.record_session_turn("c" * 32, session, "Plants", "What should students be able to do?")
+
+    assert conversation_history == before
+    assert conversation_history is not session["history"]
+    assert len(session["history"]) == len(before) + 2
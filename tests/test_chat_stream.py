@@ -0,0 +1,159 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import app
+import asgi
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+class APITimeoutError(Exception):
+    pass
+
+
+def chunk(content=None, tool_call=None):
+    delta = SimpleNamespace(content=content, tool_calls=[tool_call] if tool_call else None)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+def tool_call_chunk():
+    function = SimpleNamespace(name="ILO_get_category", arguments='{"locale": "en"}')
+    return chunk(tool_call=SimpleNamespace(index=0, id="call-1", function=function))
+
+
+def answer_chunks(text):
+    body = json.dumps({"chat_message_reply": {"text": text}, "actions": []})
+    return [chunk(body[:20]), chunk(body[20:])]
+
+
+def parse_events(raw):
+    events = []
+    for block in raw.strip().split("\n\n"):
+        name, data = block.split("\n", 1)
+        events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+@pytest.fixture
+def azure(monkeypatch):
+    """Fake Azure deployment: `answers` is a list of chunk lists or exceptions, one per call"""
+    fake = SimpleNamespace(answers=[], sent=[])
+
+    def fake_send(params, adapted):
+        fake.sent.append(adapted)
+        answer = fake.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return iter(answer)
+
+    monkeypatch.setattr(app, "deployment_capabilities", app.DeploymentCapabilities("test-deployment", "2024-01-01"))
+    monkeypatch.setattr(app, "send_chat_completion", fake_send)
+    monkeypatch.setattr(app, "call_lds_api", lambda name, args: [{"id": 1, "name": "Knowledge"}])
+    monkeypatch.setattr(app, "generate_suggested_questions", lambda *args: [])
+    return fake
+
+
+def run_stream(user_msg="hi"):
+    messages = [{"role": "user", "content": user_msg}]
+    with app.app.test_request_context("/api/chat", method="POST"):
+        return parse_events("".join(app.stream_chat_events(messages, user_msg, [])))
+
+
+def test_first_call_is_single_pass(azure):
+    azure.answers = [answer_chunks("Hello there")]
+    events = run_stream()
+
+    assert azure.sent[0]["response_format"] == app.CHATBOT_SCHEMA
+    assert azure.sent[0]["tools"] == app.TOOLS
+    assert "".join(data["text"] for name, data in events if name == "delta") == "Hello there"
+    assert ("actions", {"chat_message_reply": {"text": "Hello there"}, "actions": []}) in events
+
+
+def test_rejected_single_pass_falls_back_to_tools_only(azure):
+    rejection = BadRequest("response_format is not supported with tools")
+    azure.answers = [rejection, rejection, answer_chunks("Hello there")]
+    events = run_stream()
+
+    assert [sent["response_format"]["type"] for sent in azure.sent[:2]] == ["json_schema", "json_object"]
+    assert "response_format" not in azure.sent[2] and azure.sent[2]["tools"] == app.TOOLS
+    assert not app.deployment_capabilities.supports("single_pass")
+    assert events[-2][0] == "actions"
+
+
+def test_final_call_is_not_retried_after_a_timeout(azure):
+    azure.answers = [[tool_call_chunk()], APITimeoutError("Request timed out")]
+    events = run_stream()
+
+    assert len(azure.sent) == 2
+    assert [name for name, _ in events] == ["error", "done"]
+
+
+def test_final_call_falls_back_to_json_object_on_a_rejection(azure):
+    azure.answers = [[tool_call_chunk()], BadRequest("json_schema is not supported"), answer_chunks("Done")]
+    events = run_stream()
+
+    assert [sent["response_format"]["type"] for sent in azure.sent[1:]] == ["json_schema", "json_object"]
+    assert not app.deployment_capabilities.supports("json_schema")
+    assert events[-2] == ("actions", {"chat_message_reply": {"text": "Done"}, "actions": []})
+
+
+def test_text_before_a_tool_call_is_withdrawn(azure):
+    azure.answers = [[chunk("Let me check the categories."), tool_call_chunk()], answer_chunks("Three categories.")]
+    events = run_stream()
+
+    names = [name for name, _ in events]
+    assert names.index("reset") < names.index("actions")
+    after_reset = events[names.index("reset") + 1:]
+    streamed = "".join(data["text"] for name, data in after_reset if name == "delta")
+    actions = dict(events)["actions"]
+    assert streamed == actions["chat_message_reply"]["text"] == "Three categories."
+    assert "tools" not in azure.sent[1]
+
+
+def test_async_stream_sends_the_same_events(azure, monkeypatch):
+    async def fake_send_async(params, adapted):
+        stream = app.send_chat_completion(params, adapted)
+
+        async def chunks():
+            for item in stream:
+                yield item
+        return chunks()
+
+    async def fake_tool(name, args):
+        return [{"id": 1, "name": "Knowledge"}]
+
+    async def no_suggestions(*args):
+        return []
+
+    monkeypatch.setattr(asgi, "send_chat_completion", fake_send_async)
+    monkeypatch.setattr(asgi, "call_lds_api", fake_tool)
+    monkeypatch.setattr(asgi, "generate_suggested_questions", no_suggestions)
+    azure.answers = [[chunk("Let me check."), tool_call_chunk()], answer_chunks("Three categories.")]
+
+    async def run():
+        messages = [{"role": "user", "content": "hi"}]
+        return "".join([event async for event in asgi.stream_chat_events(messages, "hi", [])])
+
+    events = parse_events(asyncio.run(run()))
+    names = [name for name, _ in events]
+    assert [name for i, name in enumerate(names) if i == 0 or name != names[i - 1]] == [
+        "delta", "reset", "delta", "actions", "done"
+    ]
+    assert azure.sent[0]["response_format"] == app.CHATBOT_SCHEMA
+    assert dict(events)["actions"]["chat_message_reply"]["text"] == "Three categories."
+
+
+@pytest.mark.parametrize("data, accept, expected", [
+    ({"stream": True}, "", True),
+    ({}, "text/event-stream", True),
+    ({}, "application/json, text/event-stream;q=0.9", True),
+    ({}, None, False),
+    ({"stream": False}, "application/json", False),
+])
+def test_wants_event_stream(data, accept, expected):
+    assert app.wants_event_stream(data, accept) is expected
@@ -0,0 +1,126 @@
+import pytest
+
+import app
+
+
+def make_breaker(**overrides):
+    config = dict(window=4, min_calls=4, failure_rate=0.5, slow_call_s=2.0, open_seconds=10.0, half_open_calls=1)
+    config.update(overrides)
+    return app.CircuitBreaker("test", **config)
+
+
+def call(breaker, clock, failure=None, seconds=0.1):
+    started = breaker.before_call()
+    clock.advance(seconds)
+    breaker.after_call(started, failure)
+
+
+def trip(breaker, clock):
+    for _ in range(breaker.min_calls):
+        call(breaker, clock, failure="http 500")
+    assert breaker.state == "open"
+
+
+def test_trips_on_error_rate(clock):
+    breaker = make_breaker()
+    call(breaker, clock)
+    call(breaker, clock)
+    call(breaker, clock, failure="http 502")
+    assert breaker.state == "closed"  # fewer than min_calls outcomes
+
+    call(breaker, clock, failure="timeout")
+    assert breaker.state == "open"  # 2 of 4 failed
+    with pytest.raises(app.CircuitOpen) as excinfo:
+        breaker.before_call()
+    assert excinfo.value.retry_after == 10
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_below_error_rate_stays_closed(clock):
+    breaker = make_breaker()
+    for failure in (None, None, None, "http 500", None, None, None):
+        call(breaker, clock, failure=failure)
+    assert breaker.state == "closed"
+
+
+def test_trips_on_slow_calls(clock):
+    breaker = make_breaker()
+    call(breaker, clock, seconds=0.5)
+    call(breaker, clock, seconds=0.5)
+    call(breaker, clock, seconds=2.5)
+    call(breaker, clock, seconds=3.0)
+
+    stats = breaker.stats()
+    assert breaker.state == "open"
+    assert stats["slow_calls"] == 2
+    assert stats["last_failure"]["reason"].startswith("slower than 2s")
+
+
+def test_allows_exactly_one_half_open_probe(clock):
+    breaker = make_breaker()
+    trip(breaker, clock)
+
+    clock.advance(9.9)
+    with pytest.raises(app.CircuitOpen):
+        breaker.before_call()
+
+    clock.advance(0.2)
+    started = breaker.before_call()
+    assert breaker.state == "half_open"
+    with pytest.raises(app.CircuitOpen):
+        breaker.before_call()  # the probe is still running
+
+    breaker.after_call(started, "http 503")
+    assert breaker.state == "open"  # a failed probe opens it again
+    with pytest.raises(app.CircuitOpen):
+        breaker.before_call()
+
+
+def test_cancelled_probe_frees_its_slot(clock):
+    breaker = make_breaker()
+    trip(breaker, clock)
+    clock.advance(10.1)
+
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+    assert breaker.state == "half_open"
+
+
+def test_closes_after_a_successful_probe(clock):
+    breaker = make_breaker()
+    trip(breaker, clock)
+    clock.advance(10.1)
+
+    call(breaker, clock)
+    assert breaker.state == "closed"
+    assert breaker.stats()["recent_calls"] == 0
+    call(breaker, clock, failure="http 500")
+    assert breaker.state == "closed"  # the old window was cleared
+
+
+def test_open_lds_breaker_serves_last_good_option_list(clock, monkeypatch):
+    breaker = make_breaker()
+    cache = app.TTLCache(ttl=60, stale_ttl=0)
+    sent = []
+
+    def send_lds_request(session, method, url, body, timeout):
+        sent.append(url)
+        raise AssertionError("LDS called while its circuit is open")
+
+    monkeypatch.setattr(app, "lds_breaker", breaker)
+    monkeypatch.setattr(app, "lds_option_cache", cache)
+    monkeypatch.setattr(app, "send_lds_request", send_lds_request)
+
+    subjects = [{"id": 1, "name": "Mathematics"}]
+    cache.put(("subjects", "en"), subjects)
+    clock.advance(120)  # expired: a lookup misses and goes to LDS
+    trip(breaker, clock)
+
+    assert app.get_lds_option_list("subjects", "en") == subjects
+    assert sent == []
+    assert breaker.stats()["rejected"] == 1
+    assert cache.stats()["fallbacks"] == 1
+
+    with pytest.raises(app.CircuitOpen):
+        app.get_lds_option_list("grade_levels", "en")  # nothing to fall back on
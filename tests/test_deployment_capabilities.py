@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import app
+import asgi
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+SCHEMA = {"type": "json_schema", "json_schema": {"name": "reply", "schema": {"type": "object"}}}
+TOOLS = [{"type": "function", "function": {"name": "ILO_get_category", "parameters": {"type": "object"}}}]
+
+
+def completion(content='{"ok": true}'):
+    message = SimpleNamespace(content=content, tool_calls=None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def capabilities(monkeypatch):
+    caps = app.DeploymentCapabilities("test-deployment", "2024-01-01")
+    monkeypatch.setattr(app, "deployment_capabilities", caps)
+    return caps
+
+
+def test_learn_ignores_rejection_of_tools_with_response_format(capabilities):
+    error = BadRequest("response_format is not supported with tools")
+    for response_format in (SCHEMA, {"type": "json_object"}):
+        params = {"messages": [], "response_format": response_format, "tools": TOOLS, "tool_choice": "auto"}
+        assert capabilities.learn(params, error) is False
+    assert capabilities.snapshot()["known"] == {}
+
+
+def test_learn_json_schema_rejected_alone(capabilities):
+    params = {"messages": [], "response_format": SCHEMA}
+    assert capabilities.learn(params, BadRequest("response_format json_schema is not supported"))
+    assert not capabilities.supports("json_schema")
+    assert capabilities.supports("tools")
+    assert capabilities.adapt(params)["response_format"] == {"type": "json_object"}
+
+
+def test_learn_tools_rejected_alone(capabilities):
+    params = {"messages": [], "tools": TOOLS, "tool_choice": "auto"}
+    assert capabilities.learn(params, BadRequest("tools are not supported by this model"))
+    assert not capabilities.supports("tools")
+    assert capabilities.supports("json_schema")
+    adapted = capabilities.adapt(params)
+    assert "tools" not in adapted and "tool_choice" not in adapted
+
+
+def test_learn_ignores_transient_and_prompt_errors(capabilities):
+    params = {"messages": [], "response_format": SCHEMA}
+    assert not capabilities.learn(params, ConnectionError("response_format"))
+    assert not capabilities.learn(params, BadRequest("response_format: content_filter triggered"))
+    assert capabilities.snapshot()["known"] == {}
+
+
+def test_rejected_combination_marks_only_single_pass(capabilities, monkeypatch):
+    sent = []
+
+    def fake_send(params, adapted):
+        sent.append(adapted)
+        if adapted.get("tools") and adapted.get("response_format"):
+            raise BadRequest("response_format is not supported with tools")
+        return completion()
+
+    monkeypatch.setattr(app, "send_chat_completion", fake_send)
+    monkeypatch.setattr(app, "CHAT_EXECUTION_MODE", "single_pass")
+    msg = app.run_chat_with_optional_tools(
+        [{"role": "user", "content": "hi"}], response_format=SCHEMA, tools=TOOLS
+    )
+
+    assert msg["content"] == '{"ok": true}'
+    assert not capabilities.supports("single_pass")
+    assert capabilities.supports("json_schema")
+    assert capabilities.supports("tools")
+    # 2-stage: stage 1 still offers the tools, the schema pass keeps json_schema
+    assert sent[-2].get("tools") and "response_format" not in sent[-2]
+    assert sent[-1]["response_format"] == SCHEMA and "tools" not in sent[-1]
+
+
+def test_async_path_learns_the_same(capabilities, monkeypatch):
+    def fake_send(params, adapted):
+        if adapted.get("tools") and adapted.get("response_format"):
+            raise BadRequest("response_format is not supported with tools")
+        return completion()
+
+    async def fake_send_async(params, adapted):
+        return fake_send(params, adapted)
+
+    monkeypatch.setattr(app, "send_chat_completion", fake_send)
+    monkeypatch.setattr(asgi, "send_chat_completion", fake_send_async)
+    monkeypatch.setattr(app, "CHAT_EXECUTION_MODE", "single_pass")
+    msg = asyncio.run(asgi.run_chat_with_optional_tools(
+        [{"role": "user", "content": "hi"}], response_format=SCHEMA, tools=TOOLS
+    ))
+
+    assert msg["content"] == '{"ok": true}'
+    assert not capabilities.supports("single_pass")
+    assert capabilities.supports("json_schema")
+    assert capabilities.supports("tools")
@@ -0,0 +1,104 @@
+import io
+import zipfile
+
+import pytest
+
+import document_parser
+
+W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+MC = 'xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006"'
+WPS = 'xmlns:wps="http://schemas.microsoft.com/office/word/2010/wordprocessingShape"'
+V = 'xmlns:v="urn:schemas-microsoft-com:vml"'
+
+
+def docx(body):
+    """A minimal .docx whose word/document.xml has `body` as its w:body"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as package:
+        package.writestr("[Content_Types].xml", "<Types/>")
+        package.writestr(
+            "word/document.xml",
+            f'<?xml version="1.0" encoding="UTF-8"?><w:document {W} {MC} {WPS} {V}><w:body>{body}</w:body></w:document>',
+        )
+    buffer.seek(0)
+    return buffer
+
+
+def paragraph(text):
+    return f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>"
+
+
+def test_plain_paragraphs():
+    body = (
+        paragraph("Lesson plan")
+        + '<w:p><w:r><w:t xml:space="preserve">Week 1: </w:t></w:r><w:r><w:t>plants</w:t><w:tab/><w:t>(2h)</w:t></w:r></w:p>'
+        + "<w:p/>"
+        + "<w:p><w:r><w:t>line one</w:t><w:br/><w:t>line two</w:t></w:r></w:p>"
+    )
+    text, error = document_parser.extract_text(docx(body), "plan.docx")
+    assert error is None
+    assert text == "Lesson plan\nWeek 1: plants\t(2h)\n\nline one\nline two\n"
+
+
+def test_table_cells_are_included():
+    body = (
+        paragraph("Before")
+        + "<w:tbl><w:tr>"
+        + f"<w:tc>{paragraph('Outcome')}</w:tc><w:tc>{paragraph('Assessment')}</w:tc>"
+        + "</w:tr></w:tbl>"
+        + paragraph("After")
+    )
+    text, error = document_parser.extract_text(docx(body), "plan.docx")
+    assert error is None
+    assert text == "Before\nOutcome\nAssessment\nAfter\n"
+
+
+def test_text_box_is_read_once_from_alternate_content():
+    text_box = (
+        "<mc:AlternateContent>"
+        f"<mc:Choice Requires=\"wps\"><wps:txbx><w:txbxContent>{paragraph('Boxed note')}</w:txbxContent></wps:txbx></mc:Choice>"
+        f"<mc:Fallback><v:textbox><w:txbxContent>{paragraph('Boxed note')}</w:txbxContent></v:textbox></mc:Fallback>"
+        "</mc:AlternateContent>"
+    )
+    body = f"<w:p><w:r><w:t>See box</w:t></w:r><w:r>{text_box}</w:r></w:p>" + paragraph("End")
+    text, error = document_parser.extract_text(docx(body), "plan.docx")
+    assert error is None
+    assert text.count("Boxed note") == 1
+    assert text == "Boxed note\nSee box\nEnd\n"
+
+
+def test_reading_stops_past_max_chars():
+    body = "".join(paragraph(f"paragraph {i:03d}") for i in range(100))
+    text, error = document_parser.extract_text(docx(body), "plan.docx", max_chars=30)
+    assert error is None
+    # Paragraphs are 14 characters: reading stops at the first one that crosses the budget
+    assert text == "paragraph 000\nparagraph 001\nparagraph 002\n"
+
+
+def test_missing_document_part_is_an_error():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as package:
+        package.writestr("[Content_Types].xml", "<Types/>")
+    buffer.seek(0)
+    text, error = document_parser.extract_text(buffer, "plan.docx")
+    assert text is None
+    assert error.startswith("DOCX 解析錯誤")
+
+
+def test_matches_python_docx_paragraphs():
+    docx_lib = pytest.importorskip("docx")
+    document = docx_lib.Document()
+    for text in ("Unit 3: Forces", "Students explain balanced forces.", ""):
+        document.add_paragraph(text)
+    table = document.add_table(rows=1, cols=2)
+    table.cell(0, 0).text = "Push"
+    table.cell(0, 1).text = "Pull"
+    buffer = io.BytesIO()
+    document.save(buffer)
+    buffer.seek(0)
+
+    text, error = document_parser.extract_text(buffer, "unit.docx")
+    assert error is None
+    # python-docx's document.paragraphs (body only), then the table cells
+    expected = [p.text for p in document.paragraphs] + ["Push", "Pull"]
+    assert text.splitlines() == expected
@@ -0,0 +1,17 @@
+import app
+
+
+def test_normalise_ilo_inputs_keeps_line_breaks():
+    data = {"topic": "  Photosynthesis ", "description": "Week 1:\tlight  reactions \r\n\nWeek 2: Calvin cycle\n"}
+    normalised = app.normalise_ilo_inputs(data)
+    assert normalised["topic"] == "Photosynthesis"
+    assert normalised["description"] == "Week 1: light reactions\n\nWeek 2: Calvin cycle"
+    assert normalised["grade"] == "Secondary School"
+
+
+def test_ilo_cache_key_ignores_spacing_but_not_line_breaks():
+    base = {"topic": "Photosynthesis", "description": "Week 1: light reactions\nWeek 2: Calvin cycle"}
+    spaced = dict(base, topic=" Photosynthesis  ", description="Week 1:  light reactions \nWeek 2: Calvin cycle")
+    joined = dict(base, description="Week 1: light reactions Week 2: Calvin cycle")
+    assert app.ilo_cache_key(base) == app.ilo_cache_key(spaced)
+    assert app.ilo_cache_key(base) != app.ilo_cache_key(joined)
@@ -0,0 +1,120 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import app
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for the background thread"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def lds(monkeypatch):
+    """get_lds_option_list() against a fresh cache and a fake LDS whose answers the test sets"""
+    cache = app.TTLCache(ttl=60, stale_ttl=30)
+    lds = SimpleNamespace(cache=cache, calls=[], answer=None)
+
+    def fetch_lds_option_list(route, locale):
+        lds.calls.append((route, locale))
+        if isinstance(lds.answer, Exception):
+            raise lds.answer
+        return lds.answer
+
+    monkeypatch.setattr(app, "lds_option_cache", cache)
+    monkeypatch.setattr(app, "fetch_lds_option_list", fetch_lds_option_list)
+    return lds
+
+
+def test_stale_list_is_served_once_and_refreshed_in_background(clock, lds):
+    lds.answer = ["v1"]
+    assert app.get_lds_option_list("subjects", "en") == ["v1"]
+    assert app.get_lds_option_list("subjects", "en") == ["v1"]
+    assert len(lds.calls) == 1
+
+    lds.answer = ["v2"]
+    clock.advance(70)  # past the ttl, within stale_ttl
+    assert app.get_lds_option_list("subjects", "en") == ["v1"]
+    wait_until(lambda: lds.cache.stats()["refreshes"] == 1)
+    assert app.get_lds_option_list("subjects", "en") == ["v2"]
+
+    stats = lds.cache.stats()
+    assert (stats["hits"], stats["stale"], stats["misses"]) == (2, 1, 1)
+    assert len(lds.calls) == 2
+
+
+def test_last_good_list_is_kept_while_lds_is_down(clock, lds):
+    lds.answer = ["v1"]
+    app.get_lds_option_list("subjects", "en")
+
+    lds.answer = requests.exceptions.ConnectionError("LDS down")
+    clock.advance(70)
+    assert app.get_lds_option_list("subjects", "en") == ["v1"]
+    wait_until(lambda: lds.cache.stats()["refresh_errors"] == 1)
+
+    clock.advance(60)  # expired: a miss that goes to LDS and fails
+    assert app.get_lds_option_list("subjects", "en") == ["v1"]
+    assert lds.cache.stats()["fallbacks"] == 1
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        app.get_lds_option_list("subjects", "zh-HK")  # never fetched: nothing to fall back on
+
+
+def test_single_flight_threads_share_one_call():
+    flight = app.SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fetch():
+        calls.append(threading.current_thread().name)
+        release.wait(2)
+        return ["subjects"]
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do("subjects", fetch))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: flight.stats()["coalesced"] == 4)
+    release.set()
+    for thread in threads:
+        thread.join(2)
+
+    assert len(calls) == 1
+    assert results == [["subjects"]] * 5
+    assert flight.stats() == {"leaders": 1, "coalesced": 4, "in_flight": 0}
+
+    flight.do("subjects", fetch)  # finished calls are not reused
+    assert len(calls) == 2
+
+
+def test_single_flight_waiters_share_the_leaders_error():
+    flight = app.SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fetch():
+        release.wait(2)
+        raise requests.exceptions.Timeout("LDS timed out")
+
+    def caller():
+        try:
+            flight.do("subjects", fetch)
+        except requests.exceptions.Timeout as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=caller) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: flight.stats()["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(2)
+
+    assert len(errors) == 3
+    assert errors[0] is errors[1] is errors[2]
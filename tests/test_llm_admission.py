@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def make_admission(max_concurrency=1, queue_size=8, timeouts=None):
+    return app.LLMAdmission(max_concurrency, queue_size, timeouts or {"chat": 5, "suggestions": 5, "document": 5},
+                            app.LLM_PRIORITIES)
+
+
+def queued(admission):
+    return sum(admission.stats()["queued"].values())
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for the admission queue"
+        time.sleep(0.005)
+
+
+def test_waiters_are_admitted_by_priority():
+    admission = make_admission()
+    started = admission.acquire("chat")
+    admitted = []
+    errors = []
+
+    def waiter(priority):
+        try:
+            admission.acquire(priority)
+        except app.LLMOverloaded as e:
+            errors.append(e)
+            return
+        admitted.append(priority)
+        admission.release()
+
+    threads = []
+    for priority in ("document", "suggestions", "document", "chat", "suggestions", "chat"):
+        thread = threading.Thread(target=waiter, args=(priority,))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: queued(admission) == len(threads))
+
+    admission.release(started)
+    for thread in threads:
+        thread.join(2)
+
+    assert errors == []
+    assert admitted == ["chat", "chat", "suggestions", "suggestions", "document", "document"]
+    stats = admission.stats()
+    assert stats["in_flight"] == 0
+    assert stats["priorities"]["chat"]["admitted"] == 3
+
+
+def test_async_waiters_are_admitted_by_priority():
+    admission = make_admission()
+
+    async def run():
+        started = await admission.acquire_async("chat")
+        admitted = []
+
+        async def waiter(priority):
+            await admission.acquire_async(priority)
+            admitted.append(priority)
+            admission.release()
+
+        tasks = []
+        for priority in ("document", "suggestions", "chat"):
+            tasks.append(asyncio.create_task(waiter(priority)))
+            while queued(admission) < len(tasks):
+                await asyncio.sleep(0)
+
+        admission.release(started)
+        await asyncio.wait_for(asyncio.gather(*tasks), 2)
+        return admitted
+
+    assert asyncio.run(run()) == ["chat", "suggestions", "document"]
+    assert admission.stats()["in_flight"] == 0
+
+
+def test_full_queue_rejects_with_429():
+    admission = make_admission(queue_size=1)
+    started = admission.acquire("chat")
+    waiter = threading.Thread(target=lambda: admission.release(admission.acquire("chat")))
+    waiter.start()
+    wait_until(lambda: queued(admission) == 1)
+
+    with pytest.raises(app.LLMOverloaded) as excinfo:
+        admission.acquire("chat")
+    assert excinfo.value.status == 429
+    assert excinfo.value.retry_after >= 1
+    assert admission.stats()["priorities"]["chat"]["rejected"] == 1
+
+    admission.release(started)
+    waiter.join(2)
+    assert admission.stats()["in_flight"] == 0
+
+
+def test_full_queue_evicts_a_lower_priority_waiter():
+    admission = make_admission(queue_size=1)
+    started = admission.acquire("chat")
+    evicted = []
+
+    def document_waiter():
+        try:
+            admission.acquire("document")
+        except app.LLMOverloaded as e:
+            evicted.append(e.status)
+
+    thread = threading.Thread(target=document_waiter)
+    thread.start()
+    wait_until(lambda: queued(admission) == 1)
+
+    chat = threading.Thread(target=lambda: admission.release(admission.acquire("chat")))
+    chat.start()
+    thread.join(2)
+    assert evicted == [429]
+
+    admission.release(started)
+    chat.join(2)
+    stats = admission.stats()
+    assert stats["priorities"]["document"]["evicted"] == 1
+    assert stats["priorities"]["chat"]["admitted"] == 2
+
+
+def test_queue_wait_deadline_returns_503():
+    admission = make_admission(timeouts={"chat": 5, "suggestions": 5, "document": 0.05})
+    started = admission.acquire("chat")
+
+    with pytest.raises(app.LLMOverloaded) as excinfo:
+        admission.acquire("document")
+    assert excinfo.value.status == 503
+    assert excinfo.value.retry_after >= 1
+
+    stats = admission.stats()
+    assert stats["priorities"]["document"]["timed_out"] == 1
+    assert stats["queued"]["document"] == 0
+
+    admission.release(started)
+    assert admission.stats()["in_flight"] == 0  # the timed out ticket is not handed the slot
+
+
+def test_async_queue_wait_deadline_returns_503():
+    admission = make_admission()
+
+    async def run():
+        started = await admission.acquire_async("chat")
+        try:
+            await admission.acquire_async("suggestions", timeout=0.05)
+        finally:
+            admission.release(started)
+
+    with pytest.raises(app.LLMOverloaded) as excinfo:
+        asyncio.run(run())
+    assert excinfo.value.status == 503
+    assert admission.stats()["in_flight"] == 0
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_overloaded_response_carries_retry_after(status):
+    with app.app.test_request_context("/chat", method="POST"):
+        response = app.llm_overloaded(app.LLMOverloaded(status, 7, "LLM queue full"))
+    assert response.status_code == status
+    assert response.headers["Retry-After"] == "7"
+    assert response.get_json()["retry_after"] == 7
@@ -0,0 +1,13 @@
+from types import SimpleNamespace
+
+import app
+
+
+def test_bootstrap_server_timing_includes_lds_stage(monkeypatch):
+    monkeypatch.setattr(app, "lds_option_cache", app.TTLCache(60, 60))
+    monkeypatch.setattr(app, "send_lds_request", lambda *args: SimpleNamespace(status_code=200, json=lambda: []))
+
+    resp = app.app.test_client().get("/api/bootstrap")
+
+    assert resp.status_code == 200
+    assert "lds;" in resp.headers["Server-Timing"]
@@ -0,0 +1,160 @@
+"""
+Token usage report from the usage ledger the app (and batch_runner.py) writes to USAGE_LEDGER_DB.
+
+    python usage_report.py                          # tokens per route
+    python usage_report.py --by route,stage         # ... split by stage (e.g. suggestions vs. the answer)
+    python usage_report.py --by day --since 2026-10-01
+    python usage_report.py --by request --route /api/chat --limit 20
+    python usage_report.py --prices '{"prompt": 2.0, "cached": 0.5, "completion": 8.0}'
+
+Groups: request, route, stage, conversation, day, model (comma-separated to combine).
+--prices (USD per million tokens; default $USAGE_TOKEN_PRICES) adds a cost column.
+Workers append to the ledger every USAGE_FLUSH_SECONDS, so the last few seconds of a
+running app may not be in the report yet.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+
+# Same default as app.USAGE_LEDGER_DB (not imported: the report does not need the app)
+DEFAULT_LEDGER_DB = os.getenv("USAGE_LEDGER_DB", os.path.join(tempfile.gettempdir(), "lds_token_usage.sqlite3"))
+
+GROUPS = {
+    "request": "request_id",
+    "route": "route",
+    "stage": "stage",
+    "conversation": "conversation_id",
+    "day": "date(ts, 'unixepoch', 'localtime')",
+    "model": "model",
+}
+TOKEN_FIELDS = ("prompt_tokens", "cached_tokens", "completion_tokens", "total_tokens")
+
+
+def parse_day(value):
+    """Local midnight of a YYYY-MM-DD date as a Unix timestamp"""
+    try:
+        return time.mktime(time.strptime(value, "%Y-%m-%d"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM-DD, got {value!r}")
+
+
+def parse_groups(value):
+    groups = [g.strip() for g in value.split(",") if g.strip()]
+    unknown = [g for g in groups if g not in GROUPS]
+    if not groups or unknown:
+        raise argparse.ArgumentTypeError(f"expected a comma-separated list of {', '.join(GROUPS)}")
+    return groups
+
+
+def query(path, groups, since=None, until=None, route=None, limit=None):
+    """One dict per group: the group columns, calls and summed token counts"""
+    if not os.path.exists(path):
+        raise OSError(f"no usage ledger at {path}")
+    where, params = [], []
+    if since is not None:
+        where.append("ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("ts < ?")
+        params.append(until)
+    if route:
+        where.append("route = ?")
+        params.append(route)
+    columns = ", ".join(f"{GROUPS[g]} AS {g}" for g in groups)
+    sums = ", ".join(f"SUM({field}) AS {field}" for field in TOKEN_FIELDS)
+    sql = f"SELECT {columns}, COUNT(*) AS calls, {sums} FROM token_usage"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" GROUP BY {', '.join(groups)}"
+    # Days read best in date order; everything else biggest first
+    sql += " ORDER BY day" if groups == ["day"] else " ORDER BY total_tokens DESC"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def add_costs(rows, prices):
+    """cost_usd per row from {"prompt", "cached", "completion"} USD per million tokens"""
+    prompt_price = float(prices.get("prompt", 0))
+    cached_price = float(prices.get("cached", prompt_price))
+    completion_price = float(prices.get("completion", 0))
+    for row in rows:
+        row["cost_usd"] = round((
+            (row["prompt_tokens"] - row["cached_tokens"]) * prompt_price
+            + row["cached_tokens"] * cached_price
+            + row["completion_tokens"] * completion_price
+        ) / 1_000_000, 4)
+
+
+def format_table(rows, groups):
+    """Plain-text table with each row's share of the listed tokens and a total line"""
+    grand_total = sum(row["total_tokens"] for row in rows) or 1
+    headers = groups + ["calls", "prompt", "cached", "completion", "total", "share"]
+    with_cost = bool(rows) and "cost_usd" in rows[0]
+    if with_cost:
+        headers.append("cost_usd")
+
+    def cells(row, label=None):
+        keys = [label] + [""] * (len(groups) - 1) if label else [str(row[g] if row[g] is not None else "-") for g in groups]
+        values = [row["calls"]] + [row[field] for field in TOKEN_FIELDS]
+        out = keys + [f"{v:,}" for v in values] + [f"{row['total_tokens'] / grand_total:.1%}"]
+        if with_cost:
+            out.append(f"{row['cost_usd']:.4f}")
+        return out
+
+    table = [cells(row) for row in rows]
+    totals = {field: sum(row[field] for row in rows) for field in ("calls",) + TOKEN_FIELDS}
+    if with_cost:
+        totals["cost_usd"] = sum(row["cost_usd"] for row in rows)
+    table.append(cells(totals, label="TOTAL"))
+    widths = [max(len(h), *(len(r[i]) for r in table)) for i, h in enumerate(headers)]
+    numeric = range(len(groups), len(headers))
+    lines = []
+    for row in [headers] + table:
+        lines.append("  ".join(c.rjust(w) if i in numeric else c.ljust(w) for i, (c, w) in enumerate(zip(row, widths))))
+    lines.insert(1, "  ".join("-" * w for w in widths))
+    lines.insert(len(lines) - 1, lines[1])
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report Azure OpenAI token usage from the usage ledger")
+    parser.add_argument("--db", default=DEFAULT_LEDGER_DB, help=f"ledger file (default: {DEFAULT_LEDGER_DB})")
+    parser.add_argument("--by", type=parse_groups, default=["route"], help=f"group by ({', '.join(GROUPS)}; default: route)")
+    parser.add_argument("--since", type=parse_day, help="from this day (YYYY-MM-DD, local time)")
+    parser.add_argument("--until", type=parse_day, help="before this day (YYYY-MM-DD, local time)")
+    parser.add_argument("--route", help="only calls made by this route, e.g. /api/chat")
+    parser.add_argument("--limit", type=int, help="show only the first N groups")
+    parser.add_argument("--prices", default=os.getenv("USAGE_TOKEN_PRICES"),
+                        help='JSON of USD per million tokens: {"prompt", "cached", "completion"}')
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    try:
+        rows = query(args.db, args.by, args.since, args.until, args.route, args.limit)
+        if args.prices:
+            add_costs(rows, json.loads(args.prices))
+    except (OSError, sqlite3.Error, ValueError, AttributeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(rows, indent=2, ensure_ascii=False))
+    elif not rows:
+        print("No usage recorded for this selection")
+    else:
+        print(format_table(rows, args.by))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())